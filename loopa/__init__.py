@@ -34,8 +34,16 @@ loopa: Arduino-esque event loop app framework, and other utilities.
 from . import exceptions
 from . import utils
 from . import core
+from . import pool
+from . import process
+from . import queues
+from . import metrics
 
 from .core import *
+from .pool import *
+from .process import *
+from .queues import *
+from .metrics import *
 
 
 # ###############################################
@@ -54,11 +62,27 @@ logging.getLogger(__name__).addHandler(NullHandler())
 __all__ = [
     'ManagedTask',
     'TaskLooper',
+    'TickLooper',
+    'WakeLooper',
     'TaskCommander',
     'NoopLoop',
+    'LoopPool',
+    'ProcessTask',
+    'ShardedCommander',
+    'DualQueue',
+    'Histogram',
+    'TaskMetrics',
+    'CPUAccount',
+    'LagMonitor',
+    'SlowCallbackDetector',
+    'SamplingProfiler',
     'exceptions',
     'utils',
-    'core'
+    'core',
+    'pool',
+    'process',
+    'queues',
+    'metrics',
 ]
 
 
@@ -35,12 +35,21 @@ import logging
 import asyncio
 import threading
 import weakref
+import time
 import traceback
 import collections
 import inspect
 
 # In-package deps
 from .utils import await_coroutine_threadsafe
+from .utils import all_tasks
+from .utils import current_task
+from .utils import format_task_stack
+from .utils import call_soon_coalesced
+from .metrics import TaskMetrics
+from .metrics import CPUAccount
+from .metrics import LagMonitor
+from .metrics import SlowCallbackDetector
 # from .exceptions import LoopaException
 
 
@@ -52,6 +61,8 @@ from .utils import await_coroutine_threadsafe
 __all__ = [
     'ManagedTask',
     'TaskLooper',
+    'TickLooper',
+    'WakeLooper',
     'TaskCommander',
     'Aengel',
     'NoopLoop'
@@ -72,6 +83,12 @@ _TaskDef = collections.namedtuple(
 )
 
 
+_StopRecord = collections.namedtuple(
+    typename = '_StopRecord',
+    field_names = ('duration', 'timed_out', 'diagnostics'),
+)
+
+
 class _ThreadHelper(threading.Thread):
     ''' Helper class to allow us to pass args and kwargs to the thread
     later than otherwise intended.
@@ -112,8 +129,11 @@ class ManagedTask:
     '''
     
     def __init__(self, *args, threaded=False, debug=False, aengel=None,
-                 reusable_loop=False, start_timeout=None, thread_args=tuple(),
-                 thread_kwargs={}, **kwargs):
+                 reusable_loop=False, start_timeout=None, stop_timeout=None,
+                 death_timeout=1, metrics=False, lag_monitor=None,
+                 slow_callback_detector=None, cpu_account=None,
+                 thread_args=tuple(), thread_kwargs={}, loop=None,
+                 **kwargs):
         ''' Creates a ManagedTask.
         
         *args and **kwargs will be passed to the threading.Thread
@@ -121,12 +141,46 @@ class ManagedTask:
         
         Loop init arguments should be passed through the start() method.
         
+        loop is the event loop to run a non-threaded ManagedTask within,
+        defaulting to the current thread's event loop. Threaded
+        ManagedTasks always create their own.
+        
         if executor is None, defaults to the normal executor.
         
         if reusable_loop=True, the ManagedTask can be run more than
         once, but you're responsible for manually calling finalize() to
         clean up the loop. Except this doesn't work at the moment,
         because the internal thread is not reusable.
+        
+        stop_timeout is the maximum number of seconds to wait for the
+        task to finish after it has been stopped or cancelled (for
+        example, while running a TaskLooper's loop_stop). None waits
+        indefinitely. If the deadline passes, shutdown escalates:
+            1.  the stuck task's name and coroutine stack are logged
+            2.  the task is cancelled again, which also interrupts any
+                shielded cleanup (like loop_stop), and we wait for up
+                to death_timeout seconds
+            3.  the task is abandoned
+        Before a non-reusable loop is closed, any orphaned tasks still
+        running within it are cancelled, and we wait for up to
+        death_timeout seconds for them to finish.
+        
+        If metrics=True, runtime metrics are recorded in self.metrics
+        (see loopa.metrics.TaskMetrics). Otherwise, self.metrics is None.
+        
+        lag_monitor may be a loopa.metrics.LagMonitor (or True, for one
+        with the default settings), which is then run for as long as we
+        run our event loop. It is not used within a TaskCommander, since
+        the commander runs the loop instead; give the commander one.
+        slow_callback_detector works the same way, with a
+        loopa.metrics.SlowCallbackDetector. Both are cheap enough for
+        production use, unlike debug=True.
+        
+        cpu_account may be a loopa.metrics.CPUAccount (or True, for one
+        without a budget), in which case the CPU time used by the task
+        itself is accounted for there. Unlike the lag monitor, this works
+        just as well within a TaskCommander, where it tells you which of
+        the commander's tasks is using up the loop.
         '''
         super().__init__(*args, **kwargs)
             
@@ -136,6 +190,34 @@ class ManagedTask:
         self._debug = bool(debug)
         self.reusable_loop = bool(reusable_loop)
         self._start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self._death_timeout = death_timeout
+        # Set if the last time we were stopped, we didn't stop in time, along
+        # with whatever diagnostic info we could gather about why.
+        self._stop_timed_out = False
+        self._stop_diagnostics = None
+        
+        if metrics:
+            self.metrics = TaskMetrics()
+        else:
+            self.metrics = None
+            
+        if lag_monitor is True:
+            lag_monitor = LagMonitor()
+        self.lag_monitor = lag_monitor or None
+        
+        if slow_callback_detector is True:
+            slow_callback_detector = SlowCallbackDetector()
+        self.slow_callback_detector = slow_callback_detector or None
+        
+        if cpu_account is True:
+            cpu_account = CPUAccount()
+        self.cpu_account = cpu_account or None
+        
+        # This is the asyncio.Task wrapping our actual asyncio.Task, and the
+        # future we use to tell it that we've been stopped.
+        self._looper_future = None
+        self._stop_signal = None
         
         # This is our actual asyncio.Task
         self._task = None
@@ -143,9 +225,21 @@ class ManagedTask:
         # These flags control blocking when threaded
         self._startup_complete_flag = threading.Event()
         self._shutdown_complete_flag = threading.Event()
+        # A short-lived task can start and finish (clearing the startup flag)
+        # before start() gets around to checking it, so start() also waits
+        # on a one-shot event that is never cleared.
+        self._start_waiter = None
+        # Set while _run is executing (whether or not the loop is running)
+        self._in_run = False
+        # Set by a threadsafe stop that arrives before we've finished
+        # starting up, so that we can act on it once we have.
+        self._stop_pending = False
         
         # And deal with threading
-        if threaded:
+        if threaded and loop is not None:
+            raise ValueError('Threaded ManagedTasks create their own loop.')
+            
+        elif threaded:
             self.threaded = True
             self._loop = asyncio.new_event_loop()
             
@@ -173,7 +267,9 @@ class ManagedTask:
             
         else:
             self.threaded = False
-            self._loop = asyncio.get_event_loop()
+            if loop is None:
+                loop = asyncio.get_event_loop()
+            self._loop = loop
             # Declare the thread as nothing.
             self._thread = None
             
@@ -197,8 +293,9 @@ class ManagedTask:
             )
             # Update the thread's target and stuff and then run it
             self._thread.set_target(self._run, args, kwargs)
+            self._start_waiter = threading.Event()
             self._thread.start()
-            self._startup_complete_flag.wait(timeout=self._start_timeout)
+            self._start_waiter.wait(timeout=self._start_timeout)
         
         else:
             # This is redundant, but do it anyways in case other code changes
@@ -212,6 +309,8 @@ class ManagedTask:
         '''
         self._loop.set_debug(self._debug)
         self._shutdown_complete_flag.clear()
+        self._stop_pending = False
+        self._in_run = True
         
         try:
             try:
@@ -219,6 +318,11 @@ class ManagedTask:
                 # event loop
                 if self.threaded:
                     asyncio.set_event_loop(self._loop)
+                    
+                if self.lag_monitor is not None:
+                    self.lag_monitor.start(self._loop)
+                if self.slow_callback_detector is not None:
+                    self.slow_callback_detector.start(self._loop)
                 
                 # Start the task.
                 self._looper_future = asyncio.ensure_future(
@@ -229,10 +333,16 @@ class ManagedTask:
                 self._loop.run_until_complete(self._looper_future)
                 
             finally:
+                if self.lag_monitor is not None:
+                    self.lag_monitor.stop()
+                if self.slow_callback_detector is not None:
+                    self.slow_callback_detector.stop()
+                    
                 # Just in case we're reusable, reset the _thread so start()
                 # generates a new one on next call.
                 self._thread = None
                 if not self.reusable_loop:
+                    self._sweep_loop()
                     self.finalize()
         
         # Careful: stop_threadsafe could be waiting on shutdown_complete.
@@ -243,7 +353,16 @@ class ManagedTask:
             # a parent commander)
             self._exiting_task = None
             self._startup_complete_flag.clear()
+            self._in_run = False
             self._shutdown_complete_flag.set()
+            self._release_start_waiter()
+        
+    def _release_start_waiter(self):
+        ''' Unblocks a threaded start() call, if one is waiting.
+        '''
+        start_waiter = self._start_waiter
+        if start_waiter is not None:
+            start_waiter.set()
         
     def stop(self):
         ''' ONLY TO BE CALLED FROM WITHIN OUR RUNNING TASKS! Do NOT call
@@ -255,18 +374,47 @@ class ManagedTask:
         '''
         if not self._startup_complete_flag.is_set():
             raise RuntimeError('Cannot stop before startup is complete.')
+            
+        # Stopping more than once must not re-cancel the task, or we'll
+        # interrupt its cleanup.
+        elif self._stop_signal.done():
+            return
         
         logger.debug('Cancelling task via stop: ' + repr(self))
         self._task.cancel()
+        # Let the wrapper know, so that it can enforce the shutdown deadline.
+        self._stop_signal.set_result(None)
         
     def stop_threadsafe_nowait(self):
         ''' Stops us from within a different thread without waiting for
-        closure.
+        closure. A stop that arrives while we're still starting up is
+        delivered as soon as startup completes.
         '''
         if self._loop.is_running():
-            self._loop.call_soon_threadsafe(self.stop)
+            call_soon_coalesced(self._loop, self._stop_when_started)
+        
+        # _run is either still starting up, or already finalizing the loop
+        # (in which case it will set the shutdown flag itself once it's done).
+        # Either way, remember the stop for _execute_task. If the loop got
+        # going while we weren't looking, _execute_task might have already
+        # checked, so make sure it gets delivered.
+        elif self._in_run:
+            self._stop_pending = True
+            if self._loop.is_running():
+                call_soon_coalesced(self._loop, self._stop_when_started)
+        
         else:
             self._shutdown_complete_flag.set()
+            
+    def _stop_when_started(self):
+        ''' Stops us if we've finished starting up, or otherwise leaves a
+        pending stop for _execute_task to deliver once we have.
+        '''
+        if self._startup_complete_flag.is_set():
+            self._stop_pending = False
+            self.stop()
+        else:
+            self._stop_pending = True
         
     def stop_threadsafe(self, timeout=None):
         ''' Stops us from within a different thread.
@@ -283,28 +431,68 @@ class ManagedTask:
     async def _execute_task(self, args, kwargs):
         ''' Actually executes the task at hand.
         '''
+        self._stop_timed_out = False
+        self._stop_diagnostics = None
+        # If we're a standalone task, this is the same as what _run created.
+        # If we're within a TaskCommander, this is the commander's future.
+        self._looper_future = current_task(self._loop)
+        self._stop_signal = self._loop.create_future()
+        
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.runs += 1
+            metrics.task_duration = None
+            started = time.perf_counter()
+        
         try:
             try:
-                self._task = asyncio.ensure_future(
-                    self.task_run(*args, **kwargs)
-                )
+                coro = self.task_run(*args, **kwargs)
+                if self.cpu_account is not None:
+                    coro = self.cpu_account.wrap(coro)
+                self._task = asyncio.ensure_future(coro)
             
             finally:
                 # Don't wait to set the startup flag until we return control to
                 # the loop, because we already "started" the tasks.
                 self._startup_complete_flag.set()
+                self._release_start_waiter()
+            
+            # Deliver any threadsafe stop that arrived during startup.
+            if self._stop_pending:
+                self._stop_pending = False
+                self.stop()
             
             # Raise the task's exception or return its result. More likely
             # than not, this will only happen if the worker finishes first.
             # asyncio handles raising the exception for us here.
+            # Note that asyncio.wait won't propagate our own cancellation to
+            # the task; we handle that ourselves.
             try:
-                result = await asyncio.wait_for(self._task, timeout=None)
+                await asyncio.wait(
+                    fs = [self._task, self._stop_signal],
+                    return_when = asyncio.FIRST_COMPLETED
+                )
+                
+                # We were stopped, and the task has already been cancelled.
+                # Wait for it to exit, but only as long as we've been told to.
+                if not self._task.done():
+                    await self._await_task_exit()
+                
+                if self._task.done():
+                    result = self._task.result()
+                else:
+                    result = None
             
             except asyncio.CancelledError:
-                logger.debug('Cancelling task: ' + repr(self))
-                self._task.cancel()
                 result = None
                 
+                # If we (as opposed to the task itself) were cancelled, the
+                # task may not have finished yet. Same as above.
+                if not self._task.done():
+                    logger.debug('Cancelling task: ' + repr(self))
+                    self._task.cancel()
+                    await self._await_task_exit()
+                
             return result
             
         # Reset the termination flag on the way out, just in case.
@@ -312,9 +500,102 @@ class ManagedTask:
         # loop itself will stop running when this coro completes! So we need
         # to wait for any waiters to clear.
         finally:
+            if metrics is not None:
+                metrics.task_duration = time.perf_counter() - started
+                task = self._task
+                if (task is not None and task.done() and
+                    not task.cancelled() and task.exception() is not None):
+                    metrics.exceptions += 1
+                
+            self._stop_pending = False
             self._exiting_task.set()
             self._task = None
             
+    async def _await_task_exit(self):
+        ''' Waits for self._task to finish after cancellation, escalating
+        if it takes longer than self.stop_timeout.
+        '''
+        done, pending = await asyncio.wait(
+            [self._task],
+            timeout = self.stop_timeout
+        )
+        
+        if not pending:
+            return
+            
+        self._stop_timed_out = True
+        self._stop_diagnostics = self._diagnose_stop()
+        logger.warning(
+            'Task failed to stop within ' + str(self.stop_timeout) + 's. ' +
+            'Re-cancelling: ' + repr(self) + '\n' + self._stop_diagnostics
+        )
+        
+        self._task.cancel()
+        done, pending = await asyncio.wait(
+            [self._task],
+            timeout = self._death_timeout
+        )
+        
+        if pending:
+            logger.error(
+                'Abandoning task that survived repeated cancellation: ' +
+                repr(self)
+            )
+            
+    def _stuck_tasks(self):
+        ''' Returns all of the asyncio tasks that could be preventing us
+        from stopping. May be extended via super().
+        '''
+        if self._task is None:
+            return []
+        else:
+            return [self._task]
+            
+    def _diagnose_stop(self):
+        ''' Formats the stacks of all of our potentially stuck tasks.
+        '''
+        return ''.join(
+            format_task_stack(task) for task in self._stuck_tasks()
+            if not task.done()
+        )
+        
+    def _sweep_loop(self):
+        ''' Runs _kill_tasks within our loop. Swallows (but logs) any
+        errors, since we're about to close the loop anyways.
+        '''
+        try:
+            self._loop.run_until_complete(self._kill_tasks())
+        
+        except Exception:
+            logger.error(
+                'Error while killing remaining tasks: ' + repr(self) + '\n' +
+                ''.join(traceback.format_exc())
+            )
+            
+    async def _kill_tasks(self):
+        ''' Kill all remaining tasks. Call during shutdown. Will log any
+        and all remaining tasks.
+        '''
+        sweeper = current_task(self._loop)
+        remaining = all_tasks(self._loop)
+        remaining.discard(sweeper)
+        
+        for task in remaining:
+            logger.info('Task remains while closing loop: ' + repr(task))
+            task.cancel()
+        
+        if remaining:
+            done, pending = await asyncio.wait(
+                remaining,
+                timeout = self._death_timeout
+            )
+            
+            for task in pending:
+                logger.error(
+                    'Task survived cancellation while closing loop:\n' +
+                    format_task_stack(task)
+                )
+            
     def _abort(self):
         ''' Performs any needed cancellation propagation (etc).
         Must only be called from within the event loop.
@@ -341,14 +622,52 @@ class TaskLooper(ManagedTask):
     Optionally, async def loop_stop may be defined for cleanup.
     '''
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, batch_iterations=1, batch_duration=None,
+                 **kwargs):
         ''' Add a loop_init event to self.
+        
+        batch_iterations and batch_duration control how often we yield
+        to the event loop between loop_run calls. By default, control is
+        returned to the loop before every single iteration. Batched mode
+        instead calls loop_run up to batch_iterations times, or until
+        batch_duration seconds have elapsed (whichever comes first),
+        before yielding. Either may be None to disable that limit, but
+        not both.
         '''
+        if batch_iterations is None and batch_duration is None:
+            raise ValueError(
+                'Batched iteration requires batch_iterations, ' +
+                'batch_duration, or both.'
+            )
+        
+        elif batch_iterations is not None and int(batch_iterations) < 1:
+            raise ValueError('batch_iterations must be at least 1.')
+            
+        elif batch_duration is not None and batch_duration <= 0:
+            raise ValueError('batch_duration must be positive.')
+        
         super().__init__(*args, **kwargs)
         # Use the explicit loop! We may be in a different thread than the
         # eventual start() call.
         self._init_complete = asyncio.Event(loop=self._loop)
         
+        if batch_iterations is not None:
+            batch_iterations = int(batch_iterations)
+        self._batch_iterations = batch_iterations
+        self._batch_duration = batch_duration
+        # Set by stop() so that a batch can end early, even though the
+        # cancellation itself can only be delivered once we yield.
+        self._stop_requested = False
+        # The task running loop_stop, if any.
+        self._stopping = None
+        
+    def stop(self):
+        ''' In addition to super(), make sure any batch in progress
+        ends after the current iteration.
+        '''
+        super().stop()
+        self._stop_requested = True
+        
     async def loop_init(self):
         ''' Endpoint for cooperative multiple inheritance.
         '''
@@ -364,30 +683,128 @@ class TaskLooper(ManagedTask):
         '''
         pass
         
+    def _stuck_tasks(self):
+        ''' Also include loop_stop, which runs in its own task.
+        '''
+        stuck = super()._stuck_tasks()
+        if self._stopping is not None:
+            stuck.append(self._stopping)
+        return stuck
+        
+    async def _metered_run(self):
+        ''' Calls loop_run, and records it in our metrics and/or CPU
+        account. Also warns about (and throttles, if so configured) a
+        looper that keeps going over its CPU budget.
+        '''
+        metrics = self.metrics
+        account = self.cpu_account
+        
+        if account is None:
+            started = time.perf_counter()
+            await self.loop_run()
+            metrics.record_iteration(started)
+            return
+            
+        started = time.perf_counter()
+        cpu_started = account.now()
+        await self.loop_run()
+        cpu_time = account.now() - cpu_started
+        if metrics is not None:
+            metrics.record_iteration(started)
+        
+        flagged = account.over_budget
+        delay = account.record_iteration(cpu_time)
+        if account.over_budget and not flagged:
+            logger.warning(
+                'Task over its CPU budget of ' + str(account.budget) +
+                's for ' + str(account.patience) + ' iterations in a ' +
+                'row (last: ' + str(cpu_time) + 's): ' + repr(self)
+            )
+            
+        if delay:
+            await asyncio.sleep(delay)
+        
+    async def _loop_forever(self):
+        ''' Repeatedly calls loop_run until cancelled, yielding to the
+        event loop between iterations (or between batches of iterations,
+        if batching is enabled).
+        '''
+        batch_iterations = self._batch_iterations
+        batch_duration = self._batch_duration
+        metered = self.metrics is not None or self.cpu_account is not None
+        
+        # Unbatched operation.
+        if batch_iterations == 1:
+            while True:
+                # We need to guarantee that we give control back to the
+                # event loop at least once (even if running all synchronous
+                # code) to catch any cancellations.
+                await asyncio.sleep(0)
+                
+                if metered:
+                    await self._metered_run()
+                else:
+                    await self.loop_run()
+                
+        clock = self._loop.time
+        deadline = None
+        
+        while True:
+            # Same as above, but only once per batch. Any stop() or
+            # cancellation that arrived during the batch is delivered here.
+            await asyncio.sleep(0)
+            
+            if batch_duration is not None:
+                deadline = clock() + batch_duration
+            
+            iterations = 0
+            while not self._stop_requested:
+                if metered:
+                    await self._metered_run()
+                else:
+                    await self.loop_run()
+                iterations += 1
+                
+                if batch_iterations is not None:
+                    if iterations >= batch_iterations:
+                        break
+                
+                if deadline is not None and clock() >= deadline:
+                    break
+        
     async def task_run(self, *args, **kwargs):
         ''' Wraps up all of the loop stuff.
         '''
+        self._stop_requested = False
+        self._stopping = None
+        metrics = self.metrics
+        
         try:
             logger.debug('Loop init starting: ' + repr(self))
+            started = time.perf_counter()
             await self.loop_init(*args, **kwargs)
+            if metrics is not None:
+                metrics.init_duration = time.perf_counter() - started
             logger.debug('Loop init finished: ' + repr(self))
             self._init_complete.set()
             
             try:
-                while True:
-                    # We need to guarantee that we give control back to the
-                    # event loop at least once (even if running all synchronous
-                    # code) to catch any cancellations.
-                    # TODO: is there a better way than this?
-                    await asyncio.sleep(0)
-                    await self.loop_run()
+                await self._loop_forever()
             
             finally:
                 # Clear init.
                 self._init_complete.clear()
                 logger.debug('Loop stop starting: ' + repr(self))
-                # Prevent cancellation of the loop stop.
-                await asyncio.shield(self.loop_stop())
+                # Prevent cancellation of the loop stop (unless our shutdown
+                # deadline passes, and we're cancelled again).
+                started = time.perf_counter()
+                coro = self.loop_stop()
+                if self.cpu_account is not None:
+                    coro = self.cpu_account.wrap(coro)
+                self._stopping = asyncio.ensure_future(coro)
+                await asyncio.shield(self._stopping)
+                if metrics is not None:
+                    metrics.stop_duration = time.perf_counter() - started
                 logger.debug('Loop stop finished: ' + repr(self))
                 
         except asyncio.CancelledError:
@@ -410,20 +827,236 @@ class TaskLooper(ManagedTask):
         await self._init_complete.wait()
         
         
+class TickLooper(TaskLooper):
+    ''' A TaskLooper that calls loop_run at a fixed rate, instead of
+    as quickly as possible. Ticks are anchored to the loop's clock (and
+    not to the end of the previous iteration), so the time spent within
+    loop_run does not cause the tick rate to drift.
+    
+    If loop_run takes longer than a full period, the overrun policy
+    decides what happens to the ticks that were passed over:
+        'skip'      Drop them, and resume on the next tick deadline
+                    (default)
+        'catchup'   Run them back-to-back until we're back on schedule
+    Either way, they're counted in self.ticks_missed.
+    '''
+    OVERRUN_POLICIES = {'skip', 'catchup'}
+    
+    def __init__(self, *args, rate=None, period=None, overrun='skip',
+                 **kwargs):
+        ''' Rate is in Hz; period is in seconds. Exactly one must be
+        defined.
+        '''
+        if (rate is None) == (period is None):
+            raise ValueError('Must define exactly one of rate or period.')
+        
+        elif rate is not None:
+            if rate <= 0:
+                raise ValueError('Rate must be positive.')
+            period = 1 / rate
+            
+        elif period <= 0:
+            raise ValueError('Period must be positive.')
+            
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError(
+                'Unknown overrun policy ' + repr(overrun) + '. Must be one ' +
+                'of ' + repr(sorted(self.OVERRUN_POLICIES))
+            )
+        
+        super().__init__(*args, **kwargs)
+        self.period = period
+        self.overrun = overrun
+        self.ticks = 0
+        self.ticks_missed = 0
+        
+    @property
+    def rate(self):
+        ''' The target tick rate, in Hz.
+        '''
+        return 1 / self.period
+        
+    async def _loop_forever(self):
+        ''' Calls loop_run once per tick until cancelled.
+        '''
+        clock = self._loop.time
+        period = self.period
+        skip = self.overrun == 'skip'
+        metered = self.metrics is not None or self.cpu_account is not None
+        
+        self.ticks = 0
+        self.ticks_missed = 0
+        next_tick = clock()
+        
+        while True:
+            # If we've fallen a full period (or more) behind, we've missed
+            # ticks. Anything less than that is merely late.
+            behind = clock() - next_tick
+            if behind >= period:
+                if skip:
+                    missed = int(behind // period)
+                    next_tick += missed * period
+                else:
+                    missed = 1
+                self.ticks_missed += missed
+            
+            # Note that we need to yield to the event loop even if we're late,
+            # so that we can catch any cancellations.
+            await asyncio.sleep(max(next_tick - clock(), 0))
+            
+            if metered:
+                await self._metered_run()
+            else:
+                await self.loop_run()
+            self.ticks += 1
+            next_tick += period
+        
+        
+class _WakingQueue(asyncio.Queue):
+    ''' An asyncio.Queue that wakes up a WakeLooper every time an item
+    is put into it.
+    '''
+    
+    def __init__(self, looper, *args, **kwargs):
+        super().__init__(*args, loop=looper._loop, **kwargs)
+        self._looper = looper
+        
+    def _put(self, item):
+        super()._put(item)
+        self._looper.wake()
+        
+        
+class WakeLooper(TaskLooper):
+    ''' A TaskLooper that, instead of continuously polling loop_run,
+    parks between iterations until it is explicitly woken up. While
+    parked, it uses no CPU at all.
+    
+    Wake it up with any of:
+        wake()              from within the event loop
+        wake_threadsafe()   from any other thread (or any other event
+                            loop, since it never blocks)
+        wake_on_event()     whenever an asyncio.Event is set
+        wake_queue()        whenever an item is put into the queue
+    
+    Wakeups are coalesced: any number of wakeups that arrive before the
+    next iteration starts result in exactly one call to loop_run. The
+    looper starts parked, but a wakeup that arrives before start()
+    is remembered.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wake_pending = False
+        self._wake_waiter = None
+        self._wake_events = []
+        # This is None unless we are currently running.
+        self._wake_watchers = None
+        
+    def wake(self):
+        ''' Wakes up the looper. ONLY TO BE CALLED FROM WITHIN THE EVENT
+        LOOP. For anything else, use wake_threadsafe().
+        '''
+        self._wake_pending = True
+        waiter = self._wake_waiter
+        
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+            
+    def wake_threadsafe(self):
+        ''' Wakes up the looper from a different thread or event loop.
+        Always returns immediately.
+        '''
+        call_soon_coalesced(self._loop, self.wake)
+        
+    def wake_on_event(self, event):
+        ''' Wakes the looper whenever the asyncio.Event is set. The
+        event is cleared every time it wakes us, so it can be re-used.
+        '''
+        self._wake_events.append(event)
+        
+        # If we're already running, start watching immediately.
+        if self._wake_watchers is not None:
+            self._wake_watchers.append(self._watch_event(event))
+            
+    def wake_queue(self, maxsize=0):
+        ''' Creates an asyncio.Queue that wakes the looper whenever
+        anything is put into it. Since the queue is bound to our loop,
+        create it only after registering the looper with any
+        TaskCommander (loop_init is a great place).
+        '''
+        return _WakingQueue(self, maxsize=maxsize)
+        
+    def _watch_event(self, event):
+        ''' Creates a task to wake us up whenever the event is set.
+        '''
+        async def watcher():
+            while True:
+                await event.wait()
+                event.clear()
+                self.wake()
+        
+        return asyncio.ensure_future(watcher(), loop=self._loop)
+        
+    async def _loop_forever(self):
+        ''' Parks until woken, and then calls loop_run. Repeats until
+        cancelled.
+        '''
+        self._wake_watchers = [
+            self._watch_event(event) for event in self._wake_events
+        ]
+        metered = self.metrics is not None or self.cpu_account is not None
+        
+        try:
+            while True:
+                if self._wake_pending:
+                    # We still need to yield to the event loop, so that we can
+                    # catch any cancellations.
+                    await asyncio.sleep(0)
+                
+                else:
+                    self._wake_waiter = self._loop.create_future()
+                    try:
+                        await self._wake_waiter
+                    finally:
+                        self._wake_waiter = None
+                
+                # Clear this before running, so that anything that wakes us
+                # during loop_run will result in another iteration.
+                self._wake_pending = False
+                
+                if metered:
+                    await self._metered_run()
+                else:
+                    await self.loop_run()
+                
+        finally:
+            for watcher in self._wake_watchers:
+                watcher.cancel()
+            self._wake_watchers = None
+        
+        
 class TaskCommander(ManagedTask):
     ''' Sets up a ManagedTask to run tasks instead of just a single
     coro.
     
-    TODO: support addition of tasks while running.
-    TODO: support removal of tasks while running.
+    Tasks may be added and removed while the commander is running,
+    through add_task() and remove_task() (or their threadsafe variants).
+    
     TODO: support garbage collection of completed tasks.
     TODO: consider creating managed tasks and task loopers through the
           commander instead of independently?
     '''
     
-    def __init__(self, *args, suppress_child_exceptions=False, **kwargs):
+    def __init__(self, *args, suppress_child_exceptions=False,
+                 parallel_startup=False, **kwargs):
         ''' In addition to super(), we also need to add in some variable
         inits.
+        
+        By default, tasks are started strictly in order, and each task's
+        init must complete before the next task is started. If
+        parallel_startup=True, task order only matters where explicitly
+        declared through register_task's depends_on; everything else is
+        started (and initialized) concurrently.
         '''
         super().__init__(*args, **kwargs)
         
@@ -439,21 +1072,59 @@ class TaskCommander(ManagedTask):
         self._results = {}
         # Lookup to see which ones are taskloopers
         self._mgmts_with_init = set()
+        # Lookup for task -> explicitly declared startup dependencies
+        self._depends_on = {}
+        self.parallel_startup = bool(parallel_startup)
+        # Futures for all started tasks, in the order they were started. This
+        # is None unless we're running.
+        self._running = None
+        # This is created within task_run, so that it's bound to the correct
+        # loop even if we are ourselves a child of a different commander.
+        self._roster_changed = None
         
         # Notify that all mgmts have completed their inits.
         self._init_complete = asyncio.Event(loop=self._loop)
         self._stop_complete = asyncio.Event(loop=self._loop)
         
+        # Lookup for task -> _StopRecord, from the most recent shutdown.
+        self.stop_report = {}
+        
         # This determines if a completed task that ended in an exception is
         # just logged, or if it will bubble up and end the entire commander
         self.suppress_child_exceptions = suppress_child_exceptions
         
     def register_task(self, task, *args, before_task=None, after_task=None,
-                      **kwargs):
+                      depends_on=None, **kwargs):
         ''' Registers a task to start when the TaskCommander is run.
         Since the task's _loop is replaced, this is an irreversable
         action.
+        
+        depends_on is an iterable of already-registered tasks. The task
+        will not be started until all of them have been started, and
+        have completed their inits (if any).
+        
+        Tasks registered while we're running would never be started, so
+        that raises RuntimeError; use add_task instead.
+        '''
+        if self._running is not None:
+            raise RuntimeError(
+                'Tasks cannot be registered with a running TaskCommander. ' +
+                'Use add_task instead.'
+            )
+            
+        self._register_task(task, args, kwargs, before_task, after_task,
+                            depends_on)
+        
+    def _register_task(self, task, args, kwargs, before_task=None,
+                       after_task=None, depends_on=None):
+        ''' Validates and registers a task, whether or not we're
+        running.
         '''
+        if depends_on is None:
+            depends_on = frozenset()
+        else:
+            depends_on = frozenset(depends_on)
+        
         if not isinstance(task, ManagedTask):
             raise TypeError('Task must be a ManagedTask instance.')
             
@@ -469,23 +1140,40 @@ class TaskCommander(ManagedTask):
                 'both!'
             )
         
+        elif not depends_on.issubset(self._invocations):
+            raise ValueError('Tasks can only depend upon registered tasks.')
+        
         else:
-            self._insert_task(task, before_task, after_task, args, kwargs)
+            self._insert_task(task, before_task, after_task, depends_on,
+                              args, kwargs)
         
-    def _insert_task(self, task, before_task, after_task, args, kwargs):
+    def _insert_task(self, task, before_task, after_task, depends_on, args,
+                     kwargs):
         ''' Perform actual task insertion.
         '''
+        to_start = list(self._to_start)
+        
         if before_task is not None:
-            target_index = self._to_start.index(before_task)
-            self._to_start.insert(target_index, task)
+            target_index = to_start.index(before_task)
+            to_start.insert(target_index, task)
             
         elif after_task is not None:
-            target_index = self._to_start.index(after_task) + 1
-            self._to_start.insert(target_index, task)
+            target_index = to_start.index(after_task) + 1
+            to_start.insert(target_index, task)
             
         else:
-            self._to_start.append(task)
+            to_start.append(task)
             
+        # Make sure the insertion didn't create any dependency cycles before
+        # committing to anything.
+        depends_on_all = dict(self._depends_on)
+        depends_on_all[task] = depends_on
+        self._check_acyclic(
+            self._resolve_dependencies(to_start, depends_on_all)
+        )
+            
+        self._to_start = to_start
+        self._depends_on = depends_on_all
         self._invocations[task] = _TaskDef(args, kwargs)
         
         # Wait to do this until after inserting task, so that any errors will
@@ -499,53 +1187,262 @@ class TaskCommander(ManagedTask):
         task._exiting_task = asyncio.Event(loop=self._loop)
         task._loop = self._loop
         
+    def _resolve_dependencies(self, to_start, depends_on):
+        ''' Returns a lookup for task -> all tasks that must be started
+        before it, including the implicit ordering dependencies from
+        sequential startup.
+        '''
+        dependencies = {}
+        previous = None
+        
+        for mgmt in to_start:
+            dependencies[mgmt] = set(depends_on.get(mgmt, ()))
+            
+            if previous is not None and not self.parallel_startup:
+                dependencies[mgmt].add(previous)
+            previous = mgmt
+            
+        return dependencies
+        
+    @staticmethod
+    def _check_acyclic(dependencies):
+        ''' Raises ValueError if the dependencies contain a cycle.
+        '''
+        remaining = {mgmt: set(deps) for mgmt, deps in dependencies.items()}
+        
+        while remaining:
+            ready = [mgmt for mgmt, deps in remaining.items() if not deps]
+            
+            if not ready:
+                raise ValueError(
+                    'Circular startup dependency between tasks: ' +
+                    repr(list(remaining))
+                )
+            
+            for mgmt in ready:
+                del remaining[mgmt]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        
     async def _forward_harch(self):
-        ''' Get them juices flowing! Start all tasks.
+        ''' Get them juices flowing! Start all tasks, each as soon as
+        all of its dependencies have completed their inits.
         '''
-        tasks_available = []
-        for mgmt in self._to_start:
-            args, kwargs = self._invocations[mgmt]
-            task = asyncio.ensure_future(
-                mgmt._execute_task(args, kwargs)
+        # Copy this, in case anything is added while we're starting up.
+        to_start = list(self._to_start)
+        dependencies = self._resolve_dependencies(to_start, self._depends_on)
+        starters = {}
+        
+        # Note that none of these will actually run until we yield to the
+        # event loop, so all of the starters will exist by then.
+        for mgmt in to_start:
+            starters[mgmt] = asyncio.ensure_future(
+                self._start_after(mgmt, dependencies[mgmt], starters)
             )
-            self._futures_by_mgmts[mgmt] = task
-            self._mgmts_by_future[task] = mgmt
-            tasks_available.append(task)
+        
+        if starters:
+            await asyncio.gather(*starters.values())
+        
+        return self._running
+        
+    async def _start_after(self, mgmt, dependencies, starters):
+        ''' Waits for all of the dependencies' starters to finish, and
+        then starts mgmt.
+        '''
+        if dependencies:
+            await asyncio.wait([starters[dep] for dep in dependencies])
             
-            # If it has an init, wait for that init to complete before
-            # starting the next task.
-            if mgmt in self._mgmts_with_init:
-                await mgmt._init_complete.wait()
+        return (await self._start_task(mgmt))
+        
+    async def _start_task(self, mgmt):
+        ''' Starts a single registered task, and then waits for its init
+        to complete (if it has one). Returns the task's future, or None
+        if the task was removed before it could be started.
+        '''
+        if self._running is None:
+            raise RuntimeError('TaskCommander is not running.')
         
-        return tasks_available
+        # remove_task can get to a task that is still waiting on its startup
+        # dependencies. If so, it has already forgotten the task.
+        elif mgmt not in self._invocations:
+            logger.debug('Skipping start of removed task: ' + repr(mgmt))
+            return None
+        
+        args, kwargs = self._invocations[mgmt]
+        task = asyncio.ensure_future(
+            mgmt._execute_task(args, kwargs)
+        )
+        self._futures_by_mgmts[mgmt] = task
+        self._mgmts_by_future[task] = mgmt
+        self._running.append(task)
+        
+        # If it has an init, wait for that init to complete before returning.
+        # But don't wait forever if the task dies before finishing init.
+        if mgmt in self._mgmts_with_init:
+            init_waiter = asyncio.ensure_future(mgmt._init_complete.wait())
+            try:
+                await asyncio.wait(
+                    fs = [init_waiter, task],
+                    return_when = asyncio.FIRST_COMPLETED
+                )
+            finally:
+                init_waiter.cancel()
+        
+        return task
+        
+    async def add_task(self, task, *args, before_task=None,
+                       after_task=None, depends_on=None, **kwargs):
+        ''' Adds a task to the TaskCommander. If we're running, the task
+        is started immediately (once our own init has completed), and
+        this returns once the task's init has completed. Otherwise, this
+        is equivalent to register_task. Argspec is otherwise identical
+        to register_task.
+        '''
+        self._register_task(task, args, kwargs, before_task, after_task,
+                            depends_on)
+        
+        if self._running is not None:
+            await self._init_complete.wait()
+            await self._start_task(task)
+            self._roster_changed.set()
+            
+    async def remove_task(self, task):
+        ''' Removes a task from the TaskCommander. If we're running, the
+        task is stopped, and this waits for it to exit. Returns the
+        task's result (None if it was cancelled), or raises its
+        exception.
+        '''
+        if task not in self._invocations:
+            raise ValueError('Unknown task: ' + repr(task))
+            
+        future = None
+        if self._running is not None:
+            future = self._futures_by_mgmts.get(task)
+            
+        # Not started (yet). If our startup is still in progress, forgetting
+        # the task also tells its pending starter to skip it.
+        if future is None:
+            self._forget_task(task)
+            return None
+        
+        try:
+            logger.debug(repr(self) + ' removing task: ' + repr(task))
+            future.cancel()
+            await task._exiting_task.wait()
+            await asyncio.wait([future])
+            task._startup_complete_flag.clear()
+            
+        # No matter what, purge the task from all of our lookups. If we're
+        # halting at the same time, the halt may have beaten us to it.
+        finally:
+            self._forget_task(task)
+            self._futures_by_mgmts.pop(task, None)
+            self._mgmts_by_future.pop(future, None)
+            if self._running is not None and future in self._running:
+                self._running.remove(future)
+            self._roster_changed.set()
+        
+        if future.cancelled():
+            return None
+        else:
+            return future.result()
+            
+    def _forget_task(self, task):
+        ''' Removes a registered task from all of the registration
+        lookups.
+        '''
+        self._to_start.remove(task)
+        del self._invocations[task]
+        del self._depends_on[task]
+        self._mgmts_with_init.discard(task)
+        self._results.pop(task, None)
+        
+        # Anything that depended upon the task no longer can.
+        self._depends_on = {
+            mgmt: dependencies - {task}
+            for mgmt, dependencies in self._depends_on.items()
+        }
+            
+    def add_task_threadsafe(self, task, *args, **kwargs):
+        ''' Threadsafe version of add_task. Blocks until the task has
+        completed its init.
+        '''
+        if self._loop.is_running():
+            return await_coroutine_threadsafe(
+                coro = self.add_task(task, *args, **kwargs),
+                loop = self._loop
+            )
+        else:
+            self.register_task(task, *args, **kwargs)
+            
+    def remove_task_threadsafe(self, task):
+        ''' Threadsafe version of remove_task. Blocks until the task
+        has exited.
+        '''
+        if self._loop.is_running():
+            return await_coroutine_threadsafe(
+                coro = self.remove_task(task),
+                loop = self._loop
+            )
+        elif task not in self._invocations:
+            raise ValueError('Unknown task: ' + repr(task))
+        else:
+            self._forget_task(task)
         
     async def _company_halt(self, tasks):
-        ''' Stop all of the remaining running tasks in tasks. Performed
-        in reverse order to starting.
+        ''' Stop all of the remaining running tasks in tasks. Tasks are
+        stopped concurrently, except that no task is stopped until every
+        task depending upon it has exited (ie, in reverse order to
+        starting).
+        
+        How long each task took to exit is recorded in self.stop_report.
         '''
+        self.stop_report = {}
+        
         try:
             logger.debug('Stopping all remaining tasks: ' + repr(self))
-            for task in reversed(tasks):
-                task.cancel()
-                
-                # Wait for the task to exit and then clear all startup flags.
-                mgmt = self._mgmts_by_future[task]
-                logger.debug(repr(self) + ' awaiting task exit: ' + repr(mgmt))
-                await mgmt._exiting_task.wait()
-                mgmt._startup_complete_flag.clear()
+            mgmts = {self._mgmts_by_future[task] for task in tasks}
+            to_stop = [mgmt for mgmt in self._to_start if mgmt in mgmts]
+            dependents = {mgmt: set() for mgmt in to_stop}
+            
+            dependencies = self._resolve_dependencies(
+                to_stop,
+                self._depends_on
+            )
+            for mgmt, mgmt_dependencies in dependencies.items():
+                for dependency in mgmt_dependencies:
+                    dependents[dependency].add(mgmt)
+            
+            # As with startup, these won't run until we yield to the loop.
+            stoppers = {}
+            for mgmt in to_stop:
+                stoppers[mgmt] = asyncio.ensure_future(
+                    self._stop_after(mgmt, dependents[mgmt], stoppers)
+                )
+            
+            if stoppers:
+                await asyncio.gather(*stoppers.values())
             
             # Wait until all tasks have finished closure.
             # Only wait if we have things to wait for, or this will error out.
             if tasks:
-                # And wait for them all to complete (note that this will
-                # delay shutdown!)
+                # And wait for them all to complete. Note that this will delay
+                # shutdown, but each task enforces its own stop_timeout, and
+                # our own stop_timeout will interrupt this if needed.
                 await asyncio.wait(
                     fs = tasks,
                     return_when = asyncio.ALL_COMPLETED,
-                    # TODO: figure out some way to forcibly close stuff
                     timeout = None
                 )
         
+        except asyncio.CancelledError:
+            logger.error(
+                'Stopping remaining tasks interrupted; abandoning: ' +
+                repr([mgmt for mgmt in self._futures_by_mgmts
+                      if mgmt not in self.stop_report])
+            )
+            raise
+        
         except Exception:
             logger.error(
                 'Error while stopping remaining tasks: ' + repr(self) + '\n' +
@@ -554,6 +1451,13 @@ class TaskCommander(ManagedTask):
         
         # Reset everything so it's possible to run again.
         finally:
+            for mgmt, record in self.stop_report.items():
+                logger.debug(
+                    repr(mgmt) + ' stopped in ' +
+                    '{:.3f}s'.format(record.duration) +
+                    (' (TIMED OUT)' if record.timed_out else '')
+                )
+            
             results = self._results
             self._results = {}
             self._futures_by_mgmts = {}
@@ -561,13 +1465,37 @@ class TaskCommander(ManagedTask):
             
         return results
         
+    async def _stop_after(self, mgmt, dependents, stoppers):
+        ''' Waits for all of the dependents' stoppers to finish, and
+        then stops mgmt.
+        '''
+        if dependents:
+            await asyncio.wait([stoppers[dep] for dep in dependents])
+            
+        task = self._futures_by_mgmts[mgmt]
+        started = self._loop.time()
+        task.cancel()
+        
+        # Wait for the task to exit and then clear all startup flags.
+        logger.debug(repr(self) + ' awaiting task exit: ' + repr(mgmt))
+        await mgmt._exiting_task.wait()
+        mgmt._startup_complete_flag.clear()
+        
+        self.stop_report[mgmt] = _StopRecord(
+            duration = self._loop.time() - started,
+            timed_out = mgmt._stop_timed_out,
+            diagnostics = mgmt._stop_diagnostics
+        )
+        
     async def task_run(self):
         ''' Runs all of the TaskCommander's tasks.
         '''
+        self._running = []
+        self._roster_changed = asyncio.Event(loop=self._loop)
+        
         try:
             # Get all of the tasks started.
-            all_tasks = await self._forward_harch()
-            incomplete_tasks = set(all_tasks)
+            await self._forward_harch()
             
             # Perform any post-tasklooper-init, pre-init-complete actions.
             await self.setup()
@@ -578,21 +1506,37 @@ class TaskCommander(ManagedTask):
 
             # Wait for all tasks to complete (unless cancelled), but process
             # any issues as they happen.
-            finished = None
+            handled = set()
+            incomplete_tasks = set(self._running)
                 
-            # Wait until the first successful task completion
+            # Wait until the first successful task completion, or until a task
+            # is added or removed.
             while incomplete_tasks:
-                finished, pending = await asyncio.wait(
-                    fs = incomplete_tasks,
-                    return_when = asyncio.FIRST_COMPLETED
+                roster_changed = asyncio.ensure_future(
+                    self._roster_changed.wait()
                 )
+                
+                try:
+                    finished, pending = await asyncio.wait(
+                        fs = incomplete_tasks | {roster_changed},
+                        return_when = asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    roster_changed.cancel()
             
                 # It IS possible to return more than one complete task, even
                 # though we've used FIRST_COMPLETED
                 for finished_task in finished:
-                    logger.debug('Task finished: ' + repr(finished_task))
-                    self._handle_completed(finished_task)
-                    incomplete_tasks.remove(finished_task)
+                    # Removed tasks are handled by remove_task, so ignore them.
+                    if finished_task in self._mgmts_by_future:
+                        logger.debug('Task finished: ' + repr(finished_task))
+                        handled.add(finished_task)
+                        self._handle_completed(finished_task)
+                
+                self._roster_changed.clear()
+                incomplete_tasks = {
+                    task for task in self._running if task not in handled
+                }
                     
         except asyncio.CancelledError:
             # Don't log the traceback itself.
@@ -618,7 +1562,10 @@ class TaskCommander(ManagedTask):
             # already cancelled or finished above, but who have not yet
             # completed shutdown, and the loop itself stopping.
             finally:
-                results = await self._company_halt(all_tasks)
+                # Stop accepting new tasks before halting.
+                running = self._running
+                self._running = None
+                results = await self._company_halt(running)
 
         # This may or may not be useful. In particular, it will only be reached
         # if all tasks finish before cancellation.
@@ -658,20 +1605,47 @@ class TaskCommander(ManagedTask):
         except asyncio.CancelledError:
             logger.info('Task completion cancelled: ' + repr(mgmt))
             
-    async def _kill_tasks(self):
-        ''' Kill all remaining tasks. Call during shutdown. Will log any
-        and all remaining tasks.
+    def metrics_snapshot(self):
+        ''' Returns a dict with a snapshot (see TaskMetrics.snapshot) of
+        every registered task that has metrics enabled, by task, under
+        'tasks', and all of them aggregated together under 'total'.
+        If we have a lag monitor, its snapshot (see LagMonitor.snapshot)
+        is under 'lag', and if we have a slow callback detector, its
+        records are under 'slow_callbacks' (otherwise, those are None).
+        Snapshots of the CPU accounts (see CPUAccount.snapshot) of every
+        registered task that has one are under 'cpu', by task.
+        Can be called from any thread.
         '''
-        all_tasks = asyncio.Task.all_tasks()
-        
-        for task in all_tasks:
-            if task is not self._looper_future:
-                logger.info('Task remains while closing loop: ' + repr(task))
-                task.cancel()
+        tasks = list(self._to_start)
+        snapshots = {
+            mgmt: mgmt.metrics.snapshot()
+            for mgmt in tasks
+            if mgmt.metrics is not None
+        }
+        cpu = {
+            mgmt: mgmt.cpu_account.snapshot()
+            for mgmt in tasks
+            if mgmt.cpu_account is not None
+        }
         
-        if len(all_tasks) > 0:
-            await asyncio.wait(all_tasks, timeout=self._death_timeout)
+        if self.lag_monitor is None:
+            lag = None
+        else:
+            lag = self.lag_monitor.snapshot()
             
+        if self.slow_callback_detector is None:
+            slow_callbacks = None
+        else:
+            slow_callbacks = list(self.slow_callback_detector.records)
+        
+        return {
+            'tasks': snapshots,
+            'total': TaskMetrics.aggregate(snapshots.values()),
+            'lag': lag,
+            'slow_callbacks': slow_callbacks,
+            'cpu': cpu
+        }
+        
     async def await_init(self):
         ''' Awaits for all TaskLooper (or similar) loop_inits to finish.
         '''
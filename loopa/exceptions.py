@@ -41,6 +41,7 @@ __all__ = [
     # Base class for all of the above
     'LoopaException',
     # Others
+    'QueueClosed',
 ]
 
 
@@ -50,3 +51,10 @@ class LoopaException(Exception):
     with a single except.
     '''
     pass
+    
+    
+class QueueClosed(LoopaException):
+    ''' Raised when putting into a closed DualQueue, or getting from one
+    that is both closed and empty.
+    '''
+    pass
@@ -0,0 +1,1120 @@
+'''
+LICENSING
+-------------------------------------------------
+
+loopa: Arduino-esque event loop app framework, and other utilities.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+# External deps
+import os
+import sys
+import math
+import time
+import array
+import logging
+import functools
+import threading
+import traceback
+import collections
+import collections.abc
+
+# In-package deps
+from .utils import current_task
+
+
+# ###############################################
+# Boilerplate
+# ###############################################
+
+# Control * imports.
+__all__ = [
+    'Histogram',
+    'TaskMetrics',
+    'CPUAccount',
+    'LagMonitor',
+    'SlowCallbackDetector',
+    'SlowCallback',
+    'SamplingProfiler',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+# ###############################################
+# Library
+# ###############################################
+
+
+_frexp = math.frexp
+
+# CPU time used by the calling thread. Note that time.thread_time is 3.7+.
+try:
+    _thread_time = time.thread_time
+except AttributeError:
+    try:
+        _thread_time = functools.partial(
+            time.clock_gettime,
+            time.CLOCK_THREAD_CPUTIME_ID
+        )
+    # Not perfect, since it also counts every other thread, but better than
+    # nothing.
+    except AttributeError:
+        _thread_time = time.process_time
+
+
+class Histogram:
+    ''' A compact histogram of durations (in seconds), with logarithmic
+    buckets: every power of two is split into SUBBUCKETS buckets, so
+    any quantile is accurate to within about 1 / (2 * SUBBUCKETS) of
+    its value. Durations from about a microsecond (2 ** (MIN_EXP - 1))
+    up to about two minutes (2 ** (MAX_EXP - 1)) get their own buckets;
+    anything outside that is lumped into the first or last one. The
+    exact count, total, min, and max are kept separately.
+    
+    Recording is not threadsafe, but reading (including copy()) from
+    other threads is fine: at worst, a copy may be a single recording
+    out of date in some of its fields.
+    '''
+    SUBBUCKETS = 4
+    MIN_EXP = -19
+    MAX_EXP = 8
+    
+    def __init__(self):
+        size = (self.MAX_EXP - self.MIN_EXP) * self.SUBBUCKETS
+        self.buckets = array.array('Q', bytes(8 * size))
+        self.count = 0
+        self.total = 0.0
+        # Use infinities internally, so that record() can skip the checks
+        self._min = math.inf
+        self._max = -math.inf
+        # Precomputed for record()
+        self._last = size - 1
+        self._offset = -(self.MIN_EXP + 1) * self.SUBBUCKETS
+        self._scale = 2 * self.SUBBUCKETS
+        
+    def __repr__(self):
+        if not self.count:
+            return '<' + type(self).__name__ + ' count=0>'
+            
+        return (
+            '<' + type(self).__name__ + ' count=' + str(self.count) +
+            ' mean=' + _format_duration(self.mean) +
+            ' p50=' + _format_duration(self.quantile(.5)) +
+            ' p99=' + _format_duration(self.quantile(.99)) +
+            ' max=' + _format_duration(self.max) + '>'
+        )
+        
+    def record(self, value):
+        ''' Records a single duration. This is on the hot path of every
+        instrumented loop_run, so it's kept as lean as possible.
+        '''
+        self.count += 1
+        self.total += value
+        
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+        
+        if value > 0:
+            mantissa, exponent = _frexp(value)
+            # The mantissa is within [.5, 1), so this is the same as
+            # (exponent - MIN_EXP) * SUBBUCKETS + (mantissa - .5) * scale
+            index = (exponent * self.SUBBUCKETS + int(mantissa * self._scale) +
+                     self._offset)
+            
+            if index < 0:
+                index = 0
+            elif index > self._last:
+                index = self._last
+        
+        else:
+            index = 0
+            
+        self.buckets[index] += 1
+        
+    @property
+    def min(self):
+        if self.count:
+            return self._min
+        else:
+            return None
+            
+    @property
+    def max(self):
+        if self.count:
+            return self._max
+        else:
+            return None
+        
+    @property
+    def mean(self):
+        if self.count:
+            return self.total / self.count
+        else:
+            return None
+            
+    def upper_bound(self, index):
+        ''' Returns the (exclusive) upper bound of the bucket at index.
+        '''
+        exponent, sub = divmod(index, self.SUBBUCKETS)
+        return math.ldexp(
+            .5 + (sub + 1) / (2 * self.SUBBUCKETS),
+            exponent + self.MIN_EXP
+        )
+        
+    def quantile(self, q):
+        ''' Estimates the q-th quantile (for example, .99 for the 99th
+        percentile), as the upper bound of the bucket it falls within
+        (but never more than the max). Returns None if there's nothing
+        recorded.
+        '''
+        if not self.count:
+            return None
+            
+        target = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                # The last bucket also holds everything beyond it
+                if index == self._last:
+                    break
+                return min(self.upper_bound(index), self._max)
+        
+        return self._max
+        
+    def merge(self, other):
+        ''' Adds everything recorded in other to us.
+        '''
+        for index, count in enumerate(other.buckets):
+            if count:
+                self.buckets[index] += count
+                
+        self.count += other.count
+        self.total += other.total
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        
+    def copy(self):
+        duplicate = type(self)()
+        duplicate.buckets = array.array('Q', self.buckets)
+        duplicate.count = self.count
+        duplicate.total = self.total
+        duplicate._min = self._min
+        duplicate._max = self._max
+        return duplicate
+        
+        
+def _format_duration(seconds):
+    if seconds >= 1:
+        return '{:.3g}s'.format(seconds)
+    elif seconds >= 1e-3:
+        return '{:.3g}ms'.format(seconds * 1e3)
+    else:
+        return '{:.3g}us'.format(seconds * 1e6)
+        
+        
+class TaskMetrics:
+    ''' Runtime metrics for a ManagedTask. Enable them by passing
+    metrics=True when creating the task.
+    
+    runs                Number of times the task has been started
+    exceptions          Number of runs that ended in an exception (not
+                        counting cancellation)
+    task_duration       How long the most recent run took, in seconds
+                        (None while running)
+    
+    And, for TaskLoopers:
+    
+    iterations          Number of loop_run calls that completed
+    run_durations       Histogram of loop_run durations
+    init_duration       How long the most recent loop_init took
+    stop_duration       How long the most recent loop_stop took
+    last_iteration      When the most recent loop_run finished, as per
+                        time.perf_counter (see since_last_iteration)
+    
+    Metrics are recorded within the task's event loop, but can be read
+    from any thread; use snapshot() for a (nearly) consistent copy.
+    '''
+    
+    def __init__(self):
+        self.runs = 0
+        self.exceptions = 0
+        self.task_duration = None
+        self.iterations = 0
+        self.run_durations = Histogram()
+        self.init_duration = None
+        self.stop_duration = None
+        self.last_iteration = None
+        
+    def __repr__(self):
+        return (
+            type(self).__name__ + '(runs=' + str(self.runs) +
+            ', exceptions=' + str(self.exceptions) +
+            ', iterations=' + str(self.iterations) +
+            ', run_durations=' + repr(self.run_durations) + ')'
+        )
+        
+    def record_iteration(self, started):
+        ''' Records a loop_run call that started at started (as per
+        time.perf_counter) and just finished.
+        '''
+        finished = time.perf_counter()
+        self.iterations += 1
+        self.run_durations.record(finished - started)
+        self.last_iteration = finished
+        
+    @property
+    def since_last_iteration(self):
+        ''' Seconds since loop_run last finished, or None if it never
+        has.
+        '''
+        if self.last_iteration is None:
+            return None
+        else:
+            return time.perf_counter() - self.last_iteration
+            
+    def snapshot(self):
+        ''' Returns a copy of the metrics (with since_last_iteration
+        frozen at the time of the snapshot) as a dict.
+        '''
+        return {
+            'runs': self.runs,
+            'exceptions': self.exceptions,
+            'task_duration': self.task_duration,
+            'iterations': self.iterations,
+            'run_durations': self.run_durations.copy(),
+            'init_duration': self.init_duration,
+            'stop_duration': self.stop_duration,
+            'since_last_iteration': self.since_last_iteration,
+        }
+        
+    @staticmethod
+    def aggregate(snapshots):
+        ''' Combines several snapshots into one. Counts and histograms
+        are summed; durations are the longest of any of them, and
+        since_last_iteration is the most recent.
+        '''
+        total = TaskMetrics().snapshot()
+        
+        for snapshot in snapshots:
+            for key in ('runs', 'exceptions', 'iterations'):
+                total[key] += snapshot[key]
+            
+            total['run_durations'].merge(snapshot['run_durations'])
+            
+            for key in ('task_duration', 'init_duration', 'stop_duration'):
+                if snapshot[key] is not None:
+                    total[key] = max(total[key] or 0, snapshot[key])
+                    
+            since = snapshot['since_last_iteration']
+            if since is not None:
+                if total['since_last_iteration'] is None:
+                    total['since_last_iteration'] = since
+                else:
+                    total['since_last_iteration'] = min(
+                        total['since_last_iteration'],
+                        since
+                    )
+                    
+        return total
+        
+        
+class CPUAccount:
+    ''' Per-task CPU time accounting, for finding out which of the
+    tasks sharing an event loop is hogging it. Enable it by passing
+    cpu_account=True (or a CPUAccount) when creating a ManagedTask.
+    
+    The thread CPU time is measured around every step of the task (in
+    other words, every time the event loop resumes it), so time spent
+    waiting, or running other tasks, is never counted.
+    
+    cpu_time            Total CPU time used by the task, in seconds
+    steps               Number of steps taken
+    step_times          Histogram of CPU time per step
+    
+    And, for TaskLoopers:
+    
+    iteration_times     Histogram of CPU time per loop_run call
+    
+    If budget is set, every loop_run call that uses more than budget
+    seconds of CPU time counts as an overrun. After patience overruns
+    in a row, the task is flagged as over_budget (which the task logs),
+    until its next iteration that stays within the budget. If throttle
+    is true, whenever a flagged task overruns, it then sleeps for
+    however much CPU time it went over by, to give the rest of the loop
+    a chance to catch up.
+    
+    overruns            Total number of iterations that went over budget
+    over_budget         Whether the task is currently flagged
+    throttled           Total time spent sleeping while throttled
+    
+    Accounting is done within the task's event loop, but can be read
+    from any thread; use snapshot() for a (nearly) consistent copy.
+    '''
+    
+    def __init__(self, budget=None, patience=3, throttle=False):
+        if budget is not None and budget <= 0:
+            raise ValueError('CPU budget must be positive.')
+        if patience < 1:
+            raise ValueError('CPU budget patience must be at least 1.')
+        if throttle and budget is None:
+            raise ValueError('Throttling requires a CPU budget.')
+            
+        self.budget = budget
+        self.patience = int(patience)
+        self.throttle = bool(throttle)
+        
+        self.cpu_time = 0.0
+        self.steps = 0
+        self.step_times = Histogram()
+        self.iteration_times = Histogram()
+        self.overruns = 0
+        self.over_budget = False
+        self.throttled = 0.0
+        # Consecutive overruns so far
+        self._strikes = 0
+        # The thread time when the current step started, or None
+        self._step_started = None
+        # When we started keeping the books, for share()
+        self._started = None
+        
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ +
+            ' cpu_time=' + _format_duration(self.cpu_time) +
+            ' steps=' + str(self.steps) +
+            ' overruns=' + str(self.overruns) + '>'
+        )
+        
+    def wrap(self, coro):
+        ''' Wraps the coroutine, so that its steps are accounted for
+        here, once it's been wrapped in a task.
+        '''
+        if self._started is None:
+            self._started = time.perf_counter()
+        return _MeteredCoroutine(coro, self)
+        
+    def now(self):
+        ''' Returns the total CPU time used so far, including the
+        current step (if called from within it).
+        '''
+        started = self._step_started
+        if started is None:
+            return self.cpu_time
+        else:
+            return self.cpu_time + _thread_time() - started
+            
+    def share(self):
+        ''' Returns the fraction of the wall-clock time since the task
+        first started that it has spent using the CPU.
+        '''
+        if self._started is None:
+            return 0.0
+            
+        elapsed = time.perf_counter() - self._started
+        if elapsed <= 0:
+            return 0.0
+        else:
+            return self.cpu_time / elapsed
+        
+    def record_iteration(self, cpu_time):
+        ''' Records a loop_run call that used cpu_time seconds of CPU
+        time, and returns how long the task should now sleep for, if it
+        is being throttled (otherwise, 0).
+        '''
+        self.iteration_times.record(cpu_time)
+        budget = self.budget
+        
+        if budget is None or cpu_time <= budget:
+            self._strikes = 0
+            self.over_budget = False
+            return 0
+            
+        self.overruns += 1
+        self._strikes += 1
+        if self._strikes >= self.patience:
+            self.over_budget = True
+            
+        if self.throttle and self.over_budget:
+            delay = cpu_time - budget
+            self.throttled += delay
+            return delay
+        else:
+            return 0
+            
+    def snapshot(self):
+        ''' Returns a copy of the accounts (with share() frozen at the
+        time of the snapshot) as a dict.
+        '''
+        return {
+            'cpu_time': self.cpu_time,
+            'steps': self.steps,
+            'step_times': self.step_times.copy(),
+            'iteration_times': self.iteration_times.copy(),
+            'share': self.share(),
+            'overruns': self.overruns,
+            'over_budget': self.over_budget,
+            'throttled': self.throttled,
+        }
+        
+        
+class _MeteredCoroutine(collections.abc.Coroutine):
+    ''' Passes everything through to the wrapped coroutine, while
+    charging the CPU time of each step to a CPUAccount. Looks enough
+    like the real thing for asyncio's (and our) introspection.
+    '''
+    
+    def __init__(self, coro, account):
+        self._coro = coro
+        self._account = account
+        self.__name__ = getattr(coro, '__name__', type(coro).__name__)
+        self.__qualname__ = getattr(coro, '__qualname__', self.__name__)
+        
+    def __repr__(self):
+        return '<metered ' + repr(self._coro) + '>'
+        
+    def send(self, value):
+        account = self._account
+        account._step_started = started = _thread_time()
+        try:
+            return self._coro.send(value)
+        finally:
+            self._charge(account, started)
+            
+    def throw(self, *args):
+        account = self._account
+        account._step_started = started = _thread_time()
+        try:
+            return self._coro.throw(*args)
+        finally:
+            self._charge(account, started)
+            
+    @staticmethod
+    def _charge(account, started):
+        elapsed = _thread_time() - started
+        account._step_started = None
+        account.cpu_time += elapsed
+        account.steps += 1
+        account.step_times.record(elapsed)
+        
+    def close(self):
+        return self._coro.close()
+        
+    def __await__(self):
+        return self
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        return self.send(None)
+        
+    @property
+    def cr_await(self):
+        return self._coro.cr_await
+        
+    @property
+    def cr_code(self):
+        return self._coro.cr_code
+        
+    @property
+    def cr_frame(self):
+        return self._coro.cr_frame
+        
+    @property
+    def cr_running(self):
+        return self._coro.cr_running
+        
+        
+class LagMonitor:
+    ''' Measures how late an event loop is running its timers, which is
+    how long anything scheduled within the loop has to wait behind
+    whatever else is running. Every interval seconds, a plain timer
+    callback (not a task) is scheduled, and the lag is however late it
+    fires.
+    
+    lag         Exponentially-weighted moving average of the lag, so that
+                a single slow callback doesn't dominate (smoothing is the
+                weight of each new sample)
+    last        The most recent sample
+    samples     The total number of samples taken
+    
+    The most recent window samples are kept for percentile() and max.
+    Everything can be read from any thread.
+    
+    Callbacks added through add_threshold are called (within the loop)
+    as callback(monitor, lag) whenever a sample first reaches their
+    threshold, and not again until a sample has dropped back below it.
+    
+    A ManagedTask with lag_monitor set starts and stops it along with
+    the loop it runs. Otherwise, call start() and stop() within the loop
+    yourself.
+    '''
+    
+    def __init__(self, interval=.1, window=100, smoothing=.25):
+        if interval <= 0:
+            raise ValueError('Lag monitor interval must be positive.')
+        if window < 1:
+            raise ValueError('Lag monitor window must be at least 1.')
+            
+        self.interval = interval
+        self.smoothing = smoothing
+        self.lag = 0.0
+        self.last = None
+        self.samples = 0
+        self._window = collections.deque(maxlen=window)
+        # Mutable [threshold, callback, exceeded]
+        self._thresholds = []
+        self._loop = None
+        self._handle = None
+        
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ + ' interval=' + str(self.interval) +
+            ' lag=' + _format_duration(self.lag) +
+            ' samples=' + str(self.samples) + '>'
+        )
+        
+    @property
+    def running(self):
+        return self._handle is not None
+        
+    def add_threshold(self, threshold, callback):
+        ''' Calls callback(monitor, lag) whenever the lag reaches
+        threshold (in seconds). Should be called before the monitor is
+        started, or from within its loop.
+        '''
+        self._thresholds.append([threshold, callback, False])
+        
+    def start(self, loop):
+        ''' Starts monitoring loop. Must be called from within loop's
+        thread.
+        '''
+        if self._handle is not None:
+            raise RuntimeError('Lag monitor is already running.')
+            
+        self._loop = loop
+        self._schedule()
+        
+    def stop(self):
+        ''' Stops monitoring. Must be called from within the loop's
+        thread. Idempotent.
+        '''
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            
+    def _schedule(self):
+        expected = self._loop.time() + self.interval
+        self._handle = self._loop.call_at(expected, self._fire, expected)
+        
+    def _fire(self, expected):
+        lag = max(self._loop.time() - expected, 0)
+        self.last = lag
+        self.samples += 1
+        self._window.append(lag)
+        self.lag += self.smoothing * (lag - self.lag)
+        
+        for threshold in self._thresholds:
+            if lag >= threshold[0]:
+                if not threshold[2]:
+                    threshold[2] = True
+                    self._call_threshold(threshold[1], lag)
+                    
+            else:
+                threshold[2] = False
+                
+        self._schedule()
+        
+    def _call_threshold(self, callback, lag):
+        try:
+            callback(self, lag)
+        except Exception:
+            logger.error(
+                'Error in lag threshold callback ' + repr(callback) +
+                ' w/ traceback:\n' + ''.join(traceback.format_exc())
+            )
+            
+    def percentile(self, q):
+        ''' Returns the q-th quantile (for example, .99) of the lag over
+        the window, or None if there are no samples yet.
+        '''
+        return _nearest_rank(sorted(self._window), q)
+        
+    @property
+    def max(self):
+        ''' The maximum lag over the window, or None if there are no
+        samples yet.
+        '''
+        return max(self._window, default=None)
+        
+    def snapshot(self):
+        ''' Returns the current state of the monitor as a dict.
+        '''
+        window = sorted(self._window)
+        return {
+            'lag': self.lag,
+            'last': self.last,
+            'samples': self.samples,
+            'p50': _nearest_rank(window, .5),
+            'p90': _nearest_rank(window, .9),
+            'p99': _nearest_rank(window, .99),
+            'max': window[-1] if window else None,
+        }
+        
+        
+def _nearest_rank(ordered, q):
+    ''' Returns the q-th quantile of the already-sorted samples, or None
+    if there aren't any.
+    '''
+    if ordered:
+        return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+    else:
+        return None
+
+
+SlowCallback = collections.namedtuple(
+    'SlowCallback',
+    ['started', 'duration', 'coroutine', 'owner', 'stack']
+)
+SlowCallback.__doc__ = ''' A single slow loop step, as recorded by a
+SlowCallbackDetector.
+
+started     When the loop was last known to be responsive, just before
+            the step, as per time.monotonic
+duration    Roughly how long the step blocked the loop, in seconds
+coroutine   Qualified name of the coroutine of the task that was running
+            (None if the step wasn't part of a task)
+owner       The object (usually a ManagedTask) whose method that
+            coroutine is, if any
+stack       The loop thread's stack, sampled while the step was running
+'''
+
+
+class SlowCallbackDetector:
+    ''' Detects loop steps (a callback, or a task running until its next
+    await) that block the loop for longer than threshold seconds, like
+    asyncio's debug mode does with slow_callback_duration, but cheaply
+    enough to leave on in production.
+    
+    A heartbeat callback within the loop notes the time every
+    threshold / 2 seconds, and a watchdog thread checks on it just as
+    often. If the heartbeat goes stale, the watchdog samples the loop
+    thread's stack and the task that's running, and once the loop comes
+    back (if the step took at least threshold), it adds a SlowCallback
+    to the ring buffer in self.records (which keeps the most recent
+    capacity of them). self.count is the total number detected. Steps
+    that are only slightly over threshold may slip between checks;
+    anything over about 1.5 * threshold is always caught.
+    
+    Slow steps are also logged as a warning, but at most once every
+    log_interval seconds; each log line summarizes everything detected
+    since the previous one.
+    
+    A ManagedTask with slow_callback_detector set starts and stops it
+    along with the loop it runs. Otherwise, call start() and stop()
+    within the loop yourself.
+    '''
+    
+    def __init__(self, threshold=.1, capacity=100, log_interval=60,
+                 stack_limit=20):
+        if threshold <= 0:
+            raise ValueError('Slow callback threshold must be positive.')
+            
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.stack_limit = stack_limit
+        self.records = collections.deque(maxlen=capacity)
+        self.count = 0
+        
+        self._interval = threshold / 2
+        self._loop = None
+        self._loop_thread = None
+        self._handle = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        # Updated by the heartbeat (within the loop); read by the watchdog
+        self._last_beat = None
+        # Logging state; only touched by the watchdog
+        self._last_log = None
+        self._unlogged = []
+        
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ + ' threshold=' +
+            _format_duration(self.threshold) + ' count=' + str(self.count) +
+            '>'
+        )
+        
+    @property
+    def running(self):
+        return self._handle is not None
+        
+    def start(self, loop):
+        ''' Starts watching loop. Must be called from within loop's
+        thread.
+        '''
+        if self._handle is not None:
+            raise RuntimeError('Slow callback detector is already running.')
+            
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._heartbeat()
+        
+        self._watchdog = threading.Thread(
+            target = self._watch,
+            daemon = True,
+            name = 'loopa-watchdog'
+        )
+        self._watchdog.start()
+        
+    def stop(self):
+        ''' Stops watching. Must be called from within the loop's thread.
+        Idempotent.
+        '''
+        if self._handle is None:
+            return
+            
+        self._handle.cancel()
+        self._handle = None
+        self._stopped.set()
+        self._watchdog.join()
+        self._watchdog = None
+        
+    def _heartbeat(self):
+        self._last_beat = time.monotonic()
+        self._handle = self._loop.call_later(self._interval, self._heartbeat)
+        
+    def _watch(self):
+        ''' Runs within the watchdog thread.
+        '''
+        # The sample of the step currently blocking the loop, if any
+        pending = None
+        
+        while not self._stopped.wait(self._interval):
+            beat = self._last_beat
+            now = time.monotonic()
+            
+            # Either something is still blocking the loop, or something new
+            # is. This catches steps as short as about threshold / 2 (the
+            # heartbeat can be up to that late anyways), which are then
+            # filtered out once we know how long they took.
+            if now - beat > self.threshold:
+                if pending is None or pending['beat'] != beat:
+                    if pending is not None:
+                        self._finish(pending, beat)
+                    pending = self._sample(beat)
+                    
+            elif pending is not None:
+                self._finish(pending, beat)
+                pending = None
+                
+            self._maybe_log(now)
+            
+        if pending is not None:
+            self._finish(pending, time.monotonic())
+        self._maybe_log(time.monotonic(), force=True)
+        
+    def _sample(self, beat):
+        ''' Samples whatever is currently blocking the loop.
+        '''
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            stack = ''
+        else:
+            stack = ''.join(traceback.format_stack(frame, self.stack_limit))
+        # Don't hold on to the frame (and everything it references)
+        del frame
+        
+        task = current_task(self._loop)
+        coroutine = None
+        owner = None
+        if task is not None:
+            coro = task._coro
+            coroutine = getattr(coro, '__qualname__', repr(coro))
+            coro_frame = getattr(coro, 'cr_frame', None)
+            if coro_frame is not None:
+                owner = coro_frame.f_locals.get('self')
+        
+        return {
+            'beat': beat,
+            'coroutine': coroutine,
+            'owner': owner,
+            'stack': stack,
+        }
+        
+    def _finish(self, pending, resumed):
+        ''' Records a sampled step, now that the loop has moved on (as
+        of resumed).
+        '''
+        # The heartbeat would have been this late anyways.
+        duration = resumed - pending['beat'] - self._interval
+        if duration < self.threshold:
+            return
+        
+        record = SlowCallback(
+            started = pending['beat'],
+            duration = duration,
+            coroutine = pending['coroutine'],
+            owner = pending['owner'],
+            stack = pending['stack']
+        )
+        self.records.append(record)
+        self.count += 1
+        self._unlogged.append(record)
+        
+    def _maybe_log(self, now, force=False):
+        if not self._unlogged:
+            return
+        
+        if (not force and self._last_log is not None and
+            now - self._last_log < self.log_interval):
+            return
+            
+        worst = max(self._unlogged, key=lambda record: record.duration)
+        logger.warning(
+            str(len(self._unlogged)) + ' slow loop step(s) over ' +
+            _format_duration(self.threshold) + ' since last report. ' +
+            'Slowest: ' + _format_duration(worst.duration) + ' in ' +
+            str(worst.coroutine) + ' (' + repr(worst.owner) + '), ' +
+            'sampled at:\n' + worst.stack
+        )
+        self._unlogged = []
+        self._last_log = now
+        
+        
+class SamplingProfiler:
+    ''' A statistical profiler for event loop threads. A background
+    thread samples the stack of every attached loop's thread, rate times
+    per second, and counts how often each stack is seen. Since nothing
+    runs within the loops themselves, it can be attached to (and
+    detached from) running loops at any time.
+    
+    Each sample is tagged with its loop's label and, if a task is
+    running, the object whose method that task's coroutine is (usually
+    a ManagedTask) and the coroutine's name. Samples taken while a loop
+    is waiting for something to do end in its selector's select().
+    
+    Note that (like any profiler running within the process) samples
+    can only be taken when the loop thread lets go of the GIL, which it
+    does whenever it blocks (for example, in select()), and otherwise
+    at least every sys.getswitchinterval() seconds. Code that holds on
+    to the GIL for less than that between blocking calls is therefore
+    under-represented.
+    
+    Memory is bounded by max_stacks (the number of distinct stacks kept;
+    any new ones beyond that are counted under a single '[other]' stack)
+    and max_depth (the number of innermost frames kept per sample).
+    
+    collapsed() and write_collapsed() export the counts in the collapsed
+    stack format used by flamegraph.pl, speedscope, etc.
+    '''
+    
+    def __init__(self, rate=100, max_stacks=10000, max_depth=64):
+        if rate <= 0:
+            raise ValueError('Sampling rate must be positive.')
+            
+        self.interval = 1 / rate
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.counts = collections.Counter()
+        self.samples = 0
+        # Lookup for loop -> label
+        self._loops = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        
+    def __enter__(self):
+        self.start()
+        return self
+        
+    def __exit__(self, *args):
+        self.stop()
+        
+    @property
+    def running(self):
+        return self._thread is not None
+        
+    def attach(self, target, label=None):
+        ''' Starts sampling target, which may be an event loop, a
+        ManagedTask (including a TaskCommander), or a LoopPool (which
+        attaches all of its loops). Tasks within a TaskCommander share
+        its loop, so attaching one of them samples all of them; the
+        owner tag tells them apart.
+        
+        label defaults to the repr of the task, or the pool and index.
+        Threadsafe.
+        '''
+        loops = getattr(target, 'loops', None)
+        if loops is not None:
+            for index, loop in enumerate(loops):
+                if label is None:
+                    loop_label = repr(target) + '-' + str(index)
+                else:
+                    loop_label = label + '-' + str(index)
+                self.attach(loop, loop_label)
+            return
+            
+        loop = getattr(target, '_loop', target)
+        if label is None:
+            label = repr(target)
+        
+        with self._lock:
+            self._loops[loop] = _sanitize_frame(label)
+            
+    def detach(self, target):
+        ''' Stops sampling target. Threadsafe.
+        '''
+        loops = getattr(target, 'loops', None)
+        if loops is None:
+            loops = [getattr(target, '_loop', target)]
+            
+        with self._lock:
+            for loop in loops:
+                self._loops.pop(loop, None)
+        
+    def start(self):
+        ''' Starts sampling, in a daemon thread.
+        '''
+        if self._thread is not None:
+            raise RuntimeError('Profiler is already running.')
+            
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target = self._sampler,
+            daemon = True,
+            name = 'loopa-profiler'
+        )
+        self._thread.start()
+        
+    def stop(self):
+        ''' Stops sampling. The counts so far are kept.
+        '''
+        if self._thread is None:
+            return
+            
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        
+    def clear(self):
+        ''' Discards the counts so far.
+        '''
+        with self._lock:
+            self.counts.clear()
+            self.samples = 0
+        
+    def _sampler(self):
+        ''' Runs within the profiler thread.
+        '''
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                loops = list(self._loops.items())
+                
+            frames = sys._current_frames()
+            
+            for loop, label in loops:
+                # This is None unless the loop is running.
+                thread_id = loop._thread_id
+                if thread_id is None:
+                    continue
+                    
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self._record(self._collapse(loop, label, frame))
+            
+            # Don't hold on to the frames (and everything they reference)
+            del frames
+            
+    def _collapse(self, loop, label, frame):
+        ''' Returns the collapsed stack for frame, tagged for loop.
+        '''
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(_sanitize_frame(
+                code.co_name + ' (' + os.path.basename(code.co_filename) +
+                ':' + str(code.co_firstlineno) + ')'
+            ))
+            frame = frame.f_back
+            
+        tags = [label]
+        task = current_task(loop)
+        if task is not None:
+            coro = task._coro
+            coro_frame = getattr(coro, 'cr_frame', None)
+            if coro_frame is not None:
+                owner = coro_frame.f_locals.get('self')
+                if owner is not None:
+                    tags.append(_sanitize_frame(
+                        type(owner).__name__ + '@' + hex(id(owner))
+                    ))
+            tags.append(_sanitize_frame(
+                'task:' + getattr(coro, '__qualname__', type(coro).__name__)
+            ))
+            
+        names.reverse()
+        return ';'.join(tags + names)
+        
+    def _record(self, stack):
+        with self._lock:
+            self.samples += 1
+            if stack in self.counts or len(self.counts) < self.max_stacks:
+                self.counts[stack] += 1
+            else:
+                self.counts['[other]'] += 1
+                
+    def collapsed(self):
+        ''' Returns the counts in collapsed stack format: one line per
+        stack, with frames separated by semicolons (outermost first),
+        followed by a space and the count.
+        '''
+        with self._lock:
+            counts = sorted(self.counts.items())
+            
+        return ''.join(
+            stack + ' ' + str(count) + '\n' for stack, count in counts
+        )
+        
+    def write_collapsed(self, path):
+        ''' Writes collapsed() to the file at path.
+        '''
+        with open(path, 'w') as file:
+            file.write(self.collapsed())
+            
+            
+def _sanitize_frame(name):
+    ''' Semicolons separate frames in collapsed stacks (and newlines
+    separate stacks), so neither can appear within a frame.
+    '''
+    return name.replace(';', ':').replace('\n', ' ')
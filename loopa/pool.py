@@ -0,0 +1,296 @@
+'''
+LICENSING
+-------------------------------------------------
+
+loopa: Arduino-esque event loop app framework, and other utilities.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+# External deps
+import logging
+import itertools
+import threading
+import traceback
+
+# In-package deps
+from .core import ManagedTask
+from .core import TaskCommander
+from .metrics import LagMonitor
+
+
+# ###############################################
+# Boilerplate
+# ###############################################
+
+# Control * imports.
+__all__ = [
+    'LoopPool',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+# ###############################################
+# Etc
+# ###############################################
+
+
+class _KeepAlive(ManagedTask):
+    ''' Keeps a pool worker alive even when it has no tasks.
+    '''
+    
+    async def task_run(self):
+        await self._loop.create_future()
+        
+        
+class _PoolWorker(TaskCommander):
+    ''' A threaded TaskCommander that runs until explicitly stopped,
+    even if it has no other tasks, and monitors its loop's lag.
+    '''
+    
+    def __init__(self, *args, probe_interval=.1, **kwargs):
+        super().__init__(
+            *args,
+            threaded = True,
+            parallel_startup = True,
+            lag_monitor = LagMonitor(interval=probe_interval),
+            **kwargs
+        )
+        # Bind this to our own loop directly; we're probably being created
+        # from a different thread, which may not even have a loop.
+        self.register_task(_KeepAlive(loop=self._loop))
+        
+    @property
+    def task_count(self):
+        ''' The number of tasks (excluding the keepalive) registered.
+        '''
+        return len(self._to_start) - 1
+        
+        
+# ###############################################
+# Lib
+# ###############################################
+
+
+class LoopPool:
+    ''' Owns a fixed number of event loops, each running in its own
+    thread, and places ManagedTasks (TaskLoopers, etc) across them.
+    This sits between running everything on a single loop and giving
+    every task its own thread.
+    
+    Tasks are placed according to the placement strategy:
+        'round_robin'   Cycle through the loops in order (default)
+        'least_loaded'  Pick the loop with the least lag (ie, the loop
+                        that is running its timers closest to on time),
+                        breaking ties by the number of tasks
+        callable        Called as placement(pool, task); must return the
+                        index of the loop to use
+    Individual placements may override this through affinity.
+    
+    Each loop is run by a TaskCommander, so tasks get the same init and
+    shutdown handling as any other commander's tasks.
+    '''
+    PLACEMENTS = {'round_robin', 'least_loaded'}
+    # Loops whose lags are closer together than this are considered equally
+    # loaded, so that timer jitter doesn't dominate placement.
+    LAG_RESOLUTION = .001
+    
+    def __init__(self, workers, placement='round_robin', aengel=None,
+                 suppress_child_exceptions=True, stop_timeout=None,
+                 probe_interval=.1, name='loopa-pool'):
+        ''' Creates (but does not start) the pool.
+        
+        Unlike a standalone TaskCommander, suppress_child_exceptions
+        defaults to True, so that one failing task doesn't take down
+        every other task sharing its loop.
+        
+        If aengel is defined, the pool will automatically be stopped
+        when the main thread exits.
+        '''
+        workers = int(workers)
+        if workers < 1:
+            raise ValueError('LoopPool requires at least one worker.')
+        
+        if not callable(placement) and placement not in self.PLACEMENTS:
+            raise ValueError(
+                'Unknown placement ' + repr(placement) + '. Must be ' +
+                'callable or one of ' + repr(sorted(self.PLACEMENTS))
+            )
+        
+        self.placement = placement
+        self._round_robin = itertools.cycle(range(workers))
+        # Lookup for task -> worker index
+        self._placements = {}
+        self._placement_lock = threading.Lock()
+        
+        self._workers = [
+            _PoolWorker(
+                suppress_child_exceptions = suppress_child_exceptions,
+                stop_timeout = stop_timeout,
+                probe_interval = probe_interval,
+                thread_kwargs = {'name': name + '-' + str(ii)}
+            )
+            for ii in range(workers)
+        ]
+        
+        if aengel is not None:
+            aengel.prepend_guardling(self)
+            
+    def __len__(self):
+        return len(self._workers)
+        
+    @property
+    def loops(self):
+        ''' The event loops belonging to the pool, by index.
+        '''
+        return [worker._loop for worker in self._workers]
+        
+    @property
+    def lags(self):
+        ''' The smoothed timer lag (in seconds) of each loop, by index.
+        '''
+        return [worker.lag_monitor.lag for worker in self._workers]
+        
+    @property
+    def lag_snapshots(self):
+        ''' A full snapshot (see LagMonitor.snapshot) of the timer lag of
+        each loop, by index.
+        '''
+        return [worker.lag_monitor.snapshot() for worker in self._workers]
+        
+    @property
+    def task_counts(self):
+        ''' The number of tasks placed on each loop, by index.
+        '''
+        return [worker.task_count for worker in self._workers]
+        
+    def start(self):
+        ''' Starts all of the pool's loops. Returns once they're all
+        running.
+        '''
+        for worker in self._workers:
+            worker.start()
+            
+    def stop_threadsafe_nowait(self):
+        ''' Stops all of the pool's loops, without waiting for them to
+        finish.
+        '''
+        for worker in self._workers:
+            try:
+                worker.stop_threadsafe_nowait()
+            except Exception:
+                logger.error(
+                    'Swallowed exception while stopping pool worker ' +
+                    repr(worker) + '.\n' + ''.join(traceback.format_exc())
+                )
+            
+    def stop_threadsafe(self, timeout=None):
+        ''' Stops all of the pool's loops, and waits for them to finish.
+        The timeout applies to each loop individually.
+        '''
+        self.stop_threadsafe_nowait()
+        for worker in self._workers:
+            worker._shutdown_complete_flag.wait(timeout=timeout)
+            
+    def _select_worker(self, task):
+        ''' Applies the placement strategy to choose a worker index.
+        '''
+        if callable(self.placement):
+            index = self.placement(self, task)
+            
+        elif self.placement == 'least_loaded':
+            lags = self.lags
+            counts = self.task_counts
+            index = min(
+                range(len(self._workers)),
+                key = lambda ii: (
+                    int(lags[ii] / self.LAG_RESOLUTION),
+                    counts[ii]
+                )
+            )
+        
+        else:
+            index = next(self._round_robin)
+            
+        return index
+        
+    def add_task(self, task, *args, affinity=None, **kwargs):
+        ''' Places the task on one of the pool's loops and starts it,
+        returning the index of the loop it was placed on. Blocks until
+        the task has completed its init (if any). The task must not be
+        threaded. Must not be called from within one of the pool's own
+        loops.
+        
+        If affinity is not None, it is the index of the loop to use,
+        overriding the placement strategy. *args and **kwargs are passed
+        on to the worker TaskCommander's add_task.
+        '''
+        with self._placement_lock:
+            if task in self._placements:
+                raise ValueError('Task has already been placed: ' + repr(task))
+            
+            if affinity is None:
+                index = self._select_worker(task)
+                
+            # Don't let negative indices wrap around.
+            elif not 0 <= affinity < len(self._workers):
+                raise ValueError(
+                    'Affinity must be within [0, ' +
+                    str(len(self._workers)) + '): ' + repr(affinity)
+                )
+                
+            else:
+                index = affinity
+                
+            worker = self._workers[index]
+            self._placements[task] = index
+            
+        try:
+            worker.add_task_threadsafe(task, *args, **kwargs)
+            
+        except Exception:
+            with self._placement_lock:
+                del self._placements[task]
+            raise
+            
+        return index
+        
+    def remove_task(self, task):
+        ''' Stops the task and removes it from the pool. Blocks until it
+        has exited. Returns its result, or raises its exception, exactly
+        like TaskCommander.remove_task.
+        '''
+        with self._placement_lock:
+            index = self._placements.pop(task)
+            
+        return self._workers[index].remove_task_threadsafe(task)
+        
+    def placement_of(self, task):
+        ''' Returns the index of the loop that the task was placed on.
+        '''
+        return self._placements[task]
@@ -0,0 +1,658 @@
+'''
+LICENSING
+-------------------------------------------------
+
+loopa: Arduino-esque event loop app framework, and other utilities.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+# External deps
+import logging
+import asyncio
+import itertools
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+
+# In-package deps
+from .core import ManagedTask
+from .core import TaskCommander
+from .utils import wrap_threaded_future
+
+
+# ###############################################
+# Boilerplate
+# ###############################################
+
+# Control * imports.
+__all__ = [
+    'ProcessTask',
+    'ShardedCommander',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+# ###############################################
+# Etc
+# ###############################################
+
+
+# Forking is serialized, so that no child can inherit the child end of a
+# different child's pipe (which would keep that pipe open after its child
+# exits).
+_fork_lock = threading.Lock()
+# The parent ends of all open pipes. Each child closes all of them, so that
+# it only holds open its own pipe, and therefore sees EOF if the parent dies.
+_parent_conns = set()
+
+
+# ###############################################
+# Lib
+# ###############################################
+
+
+class ProcessTask(ManagedTask):
+    ''' A ManagedTask that runs its task_run in a child process, with
+    its own event loop, instead of in a thread. Use it for tasks that
+    do enough CPU work to starve other loops within the same process.
+    
+    Can be combined with other ManagedTasks through cooperative multiple
+    inheritance, so long as ProcessTask comes first:
+    
+        class Cruncher(ProcessTask, TaskLooper):
+            ...
+    
+    start(), stop_threadsafe() and stop_threadsafe_nowait() behave as
+    they do for a threaded ManagedTask. The task's result (or exception)
+    is sent back to the parent process, and is available through
+    result(). Everything passed to start() is inherited by the child,
+    but results and exceptions must be picklable.
+    
+    Because the task (and its event loop) is inherited by the child
+    process, this requires the 'fork' multiprocessing start method.
+    Stopping from within the child process, through stop(), works as
+    usual.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        ''' Always creates a private event loop for the task, since it
+        will eventually be run in a different process.
+        '''
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError(
+                'ProcessTask requires the fork multiprocessing start method.'
+            )
+            
+        kwargs['threaded'] = True
+        super().__init__(*args, **kwargs)
+        
+        self._mp_context = multiprocessing.get_context('fork')
+        self._process = None
+        # Our end of the pipe to the other process (whichever side we're on).
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._in_child = False
+        # This is set once the child has either finished its init or exited.
+        self._process_init_flag = threading.Event()
+        self._process_initialized = False
+        self._process_result = None
+        self._process_exc = None
+        # Whether the child sent its result (or exception) before exiting.
+        self._process_reported = False
+        
+    @property
+    def pid(self):
+        ''' The child process's PID, or None if not started.
+        '''
+        if self._process is None:
+            return None
+        else:
+            return self._process.pid
+        
+    def start(self, *args, **kwargs):
+        ''' Starts the child process. Returns once the task has been
+        started within the child, or once start_timeout elapses.
+        '''
+        if self._process is not None:
+            raise RuntimeError('ProcessTask is already running.')
+        
+        self._shutdown_complete_flag.clear()
+        self._process_init_flag.clear()
+        self._process_initialized = False
+        self._process_result = None
+        self._process_exc = None
+        self._process_reported = False
+        
+        parent_conn, child_conn = self._mp_context.Pipe()
+        self._process = self._mp_context.Process(
+            target = self._child_main,
+            args = (child_conn, args, kwargs),
+            daemon = False
+        )
+        
+        with _fork_lock:
+            _parent_conns.add(parent_conn)
+            self._process.start()
+            # Drop our copy of the child's end, so that we get EOF if it dies.
+            child_conn.close()
+            
+        self._conn = parent_conn
+        
+        # This is non-daemonic so that the child is always reaped, even if
+        # the main thread exits first.
+        self._thread = threading.Thread(
+            target = self._watch_child,
+            daemon = False,
+            name = 'loopa-process-' + str(self._process.pid)
+        )
+        self._start_waiter = threading.Event()
+        self._thread.start()
+        self._start_waiter.wait(timeout=self._start_timeout)
+        
+    def stop_threadsafe_nowait(self):
+        ''' Stops us from within a different thread (or, from the
+        parent, a different process) without waiting for closure.
+        '''
+        if self._in_child:
+            super().stop_threadsafe_nowait()
+            
+        elif self._conn is None:
+            self._shutdown_complete_flag.set()
+            
+        else:
+            try:
+                self._send('stop')
+            # The child has already exited (or is in the process of exiting)
+            except (OSError, EOFError):
+                pass
+                
+    def result(self, timeout=None):
+        ''' Waits for the child process to finish, and then returns the
+        task's result, or raises its exception. Raises TimeoutError if
+        it doesn't finish within timeout.
+        '''
+        if not self._shutdown_complete_flag.wait(timeout=timeout):
+            raise TimeoutError('ProcessTask has not finished.')
+        
+        if self._process_exc is not None:
+            raise self._process_exc
+        else:
+            return self._process_result
+            
+    def wait_init_threadsafe(self, timeout=None):
+        ''' Waits for the task's await_init to complete within the child
+        (or for the child to exit). Returns True if the init completed,
+        or False if timed out, if the child exited first, or if the task
+        has no await_init. Returns immediately if there is no child
+        (because we were never started, or have already finished).
+        '''
+        # The result is already final if the child has exited (and if we
+        # were never started, there's nothing to wait for).
+        if self._process is None:
+            return self._process_initialized
+            
+        self._process_init_flag.wait(timeout=timeout)
+        return self._process_initialized
+        
+    def _send(self, *msg):
+        ''' Sends a message through the pipe to the other process.
+        '''
+        with self._conn_lock:
+            self._conn.send(msg)
+            
+    def _watch_child(self):
+        ''' Runs in the parent. Handles messages from the child until it
+        exits, and then reaps it.
+        '''
+        try:
+            while True:
+                try:
+                    msg, *payload = self._conn.recv()
+                except EOFError:
+                    break
+                    
+                if msg == 'started':
+                    self._startup_complete_flag.set()
+                    self._release_start_waiter()
+                
+                elif msg == 'init':
+                    self._process_initialized = True
+                    self._process_init_flag.set()
+                
+                # These are always the last thing the child sends. Don't wait
+                # for EOF, in case the child is slow to exit.
+                elif msg == 'result':
+                    self._process_result, = payload
+                    self._process_reported = True
+                    break
+                    
+                elif msg == 'error':
+                    self._process_exc, = payload
+                    self._process_reported = True
+                    break
+            
+            self._process.join()
+            # The exit code only matters if the child died before it could
+            # tell us how the task went; otherwise, trust what it sent.
+            if self._process.exitcode and not self._process_reported:
+                self._process_exc = RuntimeError(
+                    'ProcessTask exited with code ' +
+                    str(self._process.exitcode)
+                )
+        
+        # Same as ManagedTask._run: make sure stop_threadsafe can always
+        # return.
+        finally:
+            with self._conn_lock:
+                _parent_conns.discard(self._conn)
+                self._conn.close()
+                self._conn = None
+            self._process = None
+            self._thread = None
+            
+            # The child is gone, so it's now safe to close our copy of the
+            # loop.
+            try:
+                if not self.reusable_loop:
+                    self.finalize()
+            finally:
+                self._startup_complete_flag.clear()
+                self._process_init_flag.set()
+                self._shutdown_complete_flag.set()
+                self._release_start_waiter()
+        
+    def _child_main(self, conn, args, kwargs):
+        ''' Runs in the child. Runs the task, and sends its result back
+        to the parent.
+        '''
+        self._in_child = True
+        self._conn = conn
+        
+        for parent_conn in _parent_conns:
+            parent_conn.close()
+        _parent_conns.clear()
+        
+        threading.Thread(
+            target = self._child_listen,
+            daemon = True,
+            name = 'loopa-process-listener'
+        ).start()
+        
+        try:
+            self._run(args, kwargs)
+            result = self._looper_future.result()
+            self._send('result', result)
+            
+        except BaseException as exc:
+            logger.debug(
+                'Error within ProcessTask ' + repr(self) + ' w/ traceback:\n' +
+                ''.join(traceback.format_exc())
+            )
+            try:
+                self._send('error', exc)
+            # Probably not picklable. Send something that is.
+            except Exception:
+                self._send('error', RuntimeError(
+                    'Unpicklable exception within ProcessTask:\n' +
+                    ''.join(traceback.format_exc())
+                ))
+                
+        finally:
+            conn.close()
+            
+    def _child_listen(self):
+        ''' Runs in the child. Stops the task when the parent tells us
+        to, or if the parent goes away.
+        '''
+        try:
+            while self._conn.recv() != ('stop',):
+                pass
+        except (OSError, EOFError):
+            pass
+        
+        self.stop_threadsafe_nowait()
+        
+    async def _execute_task(self, args, kwargs):
+        ''' Within the child, also tells the parent when we've started,
+        and (if the task has one) when await_init completes.
+        '''
+        if not self._in_child:
+            return (await super()._execute_task(args, kwargs))
+        
+        # This won't run until super() yields to the loop, by which point the
+        # task has been started.
+        notifier = asyncio.ensure_future(self._notify_parent())
+        try:
+            return (await super()._execute_task(args, kwargs))
+        finally:
+            notifier.cancel()
+        
+    async def _notify_parent(self):
+        ''' Runs in the child. See _execute_task.
+        '''
+        try:
+            self._send('started')
+            
+            if hasattr(self, 'await_init'):
+                await self.await_init()
+                self._send('init')
+        
+        # The pipe closed before init completed, so the parent will find out
+        # through EOF instead.
+        except (OSError, EOFError):
+            pass
+        
+        
+class _CommanderShard(ProcessTask, TaskCommander):
+    ''' One of a ShardedCommander's shards: a TaskCommander running in
+    its own process. Its result is a lookup for (the index of each task
+    within the shard) -> (that task's result), since the tasks
+    themselves can't be sent back to the parent.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._halt_results = {}
+        
+    async def _company_halt(self, tasks):
+        ''' Hold on to the results, so that we can return them even if
+        we were cancelled.
+        '''
+        self._halt_results = await super()._company_halt(tasks)
+        return self._halt_results
+        
+    async def task_run(self):
+        ''' Runs all of the shard's tasks, and then returns the results
+        of any of them that finished.
+        '''
+        try:
+            await super().task_run()
+        # Being stopped is the normal way for a shard to finish.
+        except asyncio.CancelledError:
+            pass
+        
+        return {
+            self._to_start.index(mgmt): result
+            for mgmt, result in self._halt_results.items()
+        }
+        
+        
+class _ShardProxy(ManagedTask):
+    ''' Represents a single _CommanderShard within the ShardedCommander
+    that owns it. Starts and stops the shard's process, and reports
+    the shard's init (or failure) as its own.
+    '''
+    
+    def __init__(self, shard, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard = shard
+        # Lookup for task index -> result, from the last time we ran.
+        self.shard_results = {}
+        self._init_complete = asyncio.Event(loop=self._loop)
+        self._stop_complete = asyncio.Event(loop=self._loop)
+        
+    async def task_run(self):
+        ''' Runs the shard until it finishes (or until we're stopped).
+        All of the shard's blocking methods are run in the executor.
+        '''
+        loop = self._loop
+        shard = self.shard
+        self.shard_results = {}
+        starting = self._fork_shard()
+        
+        try:
+            # If we're cancelled while the shard is still starting, we need to
+            # wait for it to finish starting before we can stop it.
+            await asyncio.shield(starting)
+            
+            if (await loop.run_in_executor(None, shard.wait_init_threadsafe)):
+                self._init_complete.set()
+            
+            await loop.run_in_executor(
+                None,
+                shard._shutdown_complete_flag.wait
+            )
+            
+        # Cancellation lands here too.
+        finally:
+            await asyncio.wait([starting])
+            # If the shard failed to start, there's nothing to stop, so just
+            # raise the error.
+            starting.result()
+            shard.stop_threadsafe_nowait()
+            await loop.run_in_executor(
+                None,
+                shard._shutdown_complete_flag.wait
+            )
+            self._init_complete.clear()
+            # If the shard failed, this raises its exception, which is then
+            # handled like any other child's exception.
+            self.shard_results = shard.result()
+            
+        return self.shard_results
+        
+    def _fork_shard(self):
+        ''' Starts the shard from a dedicated thread, and returns an
+        async future for its completion. Forking from within an executor
+        thread would make that thread the child's main thread, which the
+        executor's own exit hooks (3.9+) then try to join, failing the
+        child even though the shard finished cleanly.
+        '''
+        fut = concurrent.futures.Future()
+        
+        def target(shard=self.shard):
+            fut.set_running_or_notify_cancel()
+            try:
+                fut.set_result(shard.start())
+            except BaseException as exc:
+                fut.set_exception(exc)
+        
+        threading.Thread(
+            target = target,
+            daemon = True,
+            name = 'loopa-fork'
+        ).start()
+        return wrap_threaded_future(fut, loop=self._loop)
+        
+    async def await_init(self):
+        await self._init_complete.wait()
+        
+        
+class ShardedCommander(TaskCommander):
+    ''' A TaskCommander that shards its tasks across a number of child
+    processes, each running its own TaskCommander (and event loop).
+    Use it to spread CPU-heavy tasks across multiple cores.
+    
+    Tasks are assigned to shards through register_task, either
+    explicitly (shard=index), by key (key=hashable; tasks with equal
+    keys always share a shard), or round-robin if neither is given.
+    Tasks must be registered before starting the commander; tasks
+    cannot be added to (or removed from) a running ShardedCommander,
+    and add_task and remove_task (and their threadsafe versions) raise
+    RuntimeError if it is.
+    
+    await_init completes once every shard's tasks have completed their
+    inits, and setup() and teardown() are run within the parent, once
+    for the whole commander. suppress_child_exceptions and
+    parallel_startup are applied within each shard; if a child's
+    exception isn't suppressed, it ends the whole commander, just like
+    a normal TaskCommander. The results of any tasks that finish are
+    sent back from the shards, and are returned by _company_halt
+    exactly as if the tasks had run within this process (so they must
+    be picklable).
+    
+    This is built on ProcessTask, and therefore requires the 'fork'
+    multiprocessing start method.
+    '''
+    
+    def __init__(self, shards, *args, suppress_child_exceptions=False,
+                 parallel_startup=False, shard_stop_timeout=None,
+                 **kwargs):
+        ''' Creates (but does not start) the shards.
+        
+        shard_stop_timeout is each shard's own stop_timeout, which it
+        applies to each of its tasks.
+        '''
+        shards = int(shards)
+        if shards < 1:
+            raise ValueError('ShardedCommander requires at least one shard.')
+        
+        # The shards are independent of one another, so always start them
+        # concurrently.
+        super().__init__(
+            *args,
+            suppress_child_exceptions = suppress_child_exceptions,
+            parallel_startup = True,
+            **kwargs
+        )
+        
+        self._round_robin = itertools.cycle(range(shards))
+        # Lookup for task -> shard index
+        self._shards_by_task = {}
+        self._shards = []
+        self._proxies = []
+        
+        for __ in range(shards):
+            shard = _CommanderShard(
+                suppress_child_exceptions = suppress_child_exceptions,
+                parallel_startup = parallel_startup,
+                stop_timeout = shard_stop_timeout,
+                debug = self._debug
+            )
+            proxy = _ShardProxy(shard)
+            # Note that this is our own register_task, not the sharding one.
+            super().register_task(proxy)
+            self._shards.append(shard)
+            self._proxies.append(proxy)
+            
+    def __len__(self):
+        return len(self._shards)
+        
+    def register_task(self, task, *args, shard=None, key=None, **kwargs):
+        ''' Registers a task to run within one of the shards. If shard is
+        defined, it is the index of the shard to use. Otherwise, if key
+        is defined, the shard is chosen by hashing it. Note that, for
+        example, str hashes are randomized between interpreter runs
+        (see PYTHONHASHSEED).
+        
+        *args and **kwargs (including before_task, after_task, and
+        depends_on, which must refer to tasks in the same shard) are
+        passed on to the shard's register_task.
+        '''
+        if self._running is not None:
+            raise RuntimeError(
+                'Tasks cannot be added to a running ShardedCommander.'
+            )
+        
+        elif task in self._shards_by_task:
+            raise ValueError(
+                'Tasks can only be added once. Create a new instance of the ' +
+                'task to run multiple copies.'
+            )
+        
+        elif shard is not None and key is not None:
+            raise ValueError(
+                'Task may be assigned a shard or a key, but not both!'
+            )
+            
+        elif shard is not None:
+            # Don't let negative indices wrap around.
+            if not 0 <= shard < len(self._shards):
+                raise ValueError(
+                    'Shard index must be within [0, ' +
+                    str(len(self._shards)) + '): ' + repr(shard)
+                )
+            index = shard
+        
+        elif key is not None:
+            index = hash(key) % len(self._shards)
+            
+        else:
+            index = next(self._round_robin)
+            
+        self._shards[index].register_task(task, *args, **kwargs)
+        self._shards_by_task[task] = index
+        
+    async def add_task(self, task, *args, **kwargs):
+        ''' Same as register_task; tasks cannot be added to a running
+        ShardedCommander, since their shard's process has already been
+        forked.
+        '''
+        self.register_task(task, *args, **kwargs)
+        
+    def add_task_threadsafe(self, task, *args, **kwargs):
+        ''' Same as register_task.
+        '''
+        self.register_task(task, *args, **kwargs)
+        
+    async def remove_task(self, task):
+        ''' Removes a task from its shard. Tasks cannot be removed from
+        a running ShardedCommander.
+        '''
+        self._unregister_task(task)
+        
+    def remove_task_threadsafe(self, task):
+        ''' Same as remove_task.
+        '''
+        self._unregister_task(task)
+        
+    def _unregister_task(self, task):
+        ''' Removes a (not yet running) task from its shard.
+        '''
+        if self._running is not None:
+            raise RuntimeError(
+                'Tasks cannot be removed from a running ShardedCommander.'
+            )
+            
+        elif task not in self._shards_by_task:
+            raise ValueError('Unknown task: ' + repr(task))
+            
+        index = self._shards_by_task.pop(task)
+        # The shard's loop isn't running within this process, so this just
+        # forgets the task.
+        self._shards[index].remove_task_threadsafe(task)
+        
+    def shard_of(self, task):
+        ''' Returns the index of the shard that the task was assigned to.
+        '''
+        return self._shards_by_task[task]
+        
+    async def _company_halt(self, tasks):
+        ''' Stops all of the shards, and then translates their results
+        back into a lookup for task -> result.
+        '''
+        await super()._company_halt(tasks)
+        results = {}
+        
+        for shard, proxy in zip(self._shards, self._proxies):
+            for index, result in proxy.shard_results.items():
+                results[shard._to_start[index]] = result
+            
+        return results
@@ -0,0 +1,366 @@
+'''
+LICENSING
+-------------------------------------------------
+
+loopa: Arduino-esque event loop app framework, and other utilities.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+# External deps
+import time
+import queue
+import logging
+import threading
+import collections
+
+# In-package deps
+from .exceptions import QueueClosed
+from .utils import running_loop
+
+
+# ###############################################
+# Boilerplate
+# ###############################################
+
+# Control * imports.
+__all__ = [
+    'DualQueue',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+# ###############################################
+# Library
+# ###############################################
+
+
+class DualQueue:
+    ''' A FIFO queue between plain threads and coroutines within a
+    single event loop. The *_threadsafe methods block the calling
+    thread; the coroutine methods must be awaited within the loop.
+    Either side may put, get, or both.
+    
+    If maxsize is greater than zero, the queue is bounded, and putters
+    (on both sides) wait for space: that is, backpressure works in both
+    directions. get_many and put_many (and their threadsafe versions)
+    move items in batches, taking the lock once per batch.
+    
+    Waking up the loop from another thread is relatively expensive,
+    so it only happens when a coroutine is actually waiting, and any
+    number of puts (or gets) before the loop gets around to it share
+    a single wakeup.
+    
+    If no loop is given, the queue binds to the first loop that awaits
+    it, so it can be created (and even filled) before the loop it will
+    feed exists -- for example, for a threaded TaskLooper that has yet
+    to start.
+    
+    Once closed, puts raise QueueClosed; gets continue to return
+    anything already in the queue, and then raise QueueClosed too.
+    '''
+    
+    def __init__(self, maxsize=0, *, loop=None):
+        self.maxsize = maxsize
+        self._loop = loop
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # Futures (within the loop) of coroutines waiting to get or put
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+        self._wakeup_pending = False
+        self._closed = False
+        
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ + ' maxsize=' + str(self.maxsize) +
+            ' qsize=' + str(len(self._items)) +
+            (' closed' if self._closed else '') + '>'
+        )
+        
+    @property
+    def closed(self):
+        return self._closed
+        
+    def qsize(self):
+        return len(self._items)
+        
+    def empty(self):
+        return not self._items
+        
+    def full(self):
+        return 0 < self.maxsize <= len(self._items)
+        
+    def close(self):
+        ''' Closes the queue, waking everything waiting on it (on either
+        side). Threadsafe, and idempotent.
+        '''
+        with self._lock:
+            self._closed = True
+            self._notify()
+            
+    def put_nowait(self, item):
+        ''' Adds item without waiting, or raises queue.Full. Callable
+        from anywhere.
+        '''
+        with self._lock:
+            self._check_closed()
+            if self.full():
+                raise queue.Full()
+                
+            self._items.append(item)
+            self._notify()
+            
+    def get_nowait(self):
+        ''' Removes and returns an item without waiting, or raises
+        queue.Empty. Callable from anywhere.
+        '''
+        with self._lock:
+            if not self._items:
+                self._check_closed()
+                raise queue.Empty()
+                
+            item = self._items.popleft()
+            self._notify()
+            return item
+            
+    def put_threadsafe(self, item, timeout=None):
+        ''' Adds item, blocking the current thread while the queue is
+        full. Raises queue.Full if timeout expires first.
+        '''
+        self.put_many_threadsafe((item,), timeout)
+        
+    def get_threadsafe(self, timeout=None):
+        ''' Removes and returns an item, blocking the current thread
+        while the queue is empty. Raises queue.Empty if timeout expires
+        first.
+        '''
+        return self.get_many_threadsafe(1, timeout)[0]
+        
+    def put_many_threadsafe(self, items, timeout=None):
+        ''' Adds all of items, in order, blocking the current thread
+        whenever the queue is full. Raises queue.Full if timeout expires
+        first, in which case only some of the items will have been
+        added.
+        '''
+        pending = collections.deque(items)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self._not_full:
+            while True:
+                self._check_closed()
+                self._push(pending)
+                if not pending:
+                    return
+                    
+                if deadline is None:
+                    self._not_full.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Full()
+                    self._not_full.wait(remaining)
+                    
+    def get_many_threadsafe(self, max_items, timeout=None):
+        ''' Removes and returns a list of up to max_items, blocking the
+        current thread while the queue is empty. Raises queue.Empty if
+        timeout expires first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self._not_empty:
+            while not self._items:
+                self._check_closed()
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty()
+                    self._not_empty.wait(remaining)
+                    
+            return self._pop(max_items)
+            
+    async def put(self, item):
+        ''' Adds item, waiting while the queue is full.
+        '''
+        await self.put_many((item,))
+        
+    async def get(self):
+        ''' Removes and returns an item, waiting while the queue is
+        empty.
+        '''
+        return (await self.get_many(1))[0]
+        
+    async def put_many(self, items):
+        ''' Adds all of items, in order, waiting whenever the queue is
+        full.
+        '''
+        loop = self._bind()
+        pending = collections.deque(items)
+        
+        while True:
+            with self._lock:
+                self._check_closed()
+                self._push(pending)
+                if not pending:
+                    return
+                    
+                waiter = loop.create_future()
+                self._putters.append(waiter)
+                
+            await self._park(waiter, self._putters)
+            
+    async def get_many(self, max_items):
+        ''' Removes and returns a list of up to max_items, waiting while
+        the queue is empty.
+        '''
+        loop = self._bind()
+        
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._pop(max_items)
+                    
+                self._check_closed()
+                waiter = loop.create_future()
+                self._getters.append(waiter)
+                
+            await self._park(waiter, self._getters)
+            
+    def _bind(self):
+        ''' Binds the queue to the running loop, if it isn't already,
+        and returns the loop.
+        '''
+        loop = running_loop()
+        
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    self._loop = loop
+                    
+        if loop is not self._loop:
+            raise RuntimeError('DualQueue is bound to a different loop.')
+            
+        return loop
+        
+    async def _park(self, waiter, waiters):
+        ''' Waits for waiter (which is in waiters) to be released.
+        '''
+        try:
+            await waiter
+            
+        except BaseException:
+            with self._lock:
+                try:
+                    waiters.remove(waiter)
+                # We were already released, but won't be using it, so pass
+                # it on to the next in line.
+                except ValueError:
+                    self._release_waiters()
+            raise
+            
+    def _check_closed(self):
+        if self._closed:
+            raise QueueClosed()
+            
+    def _push(self, pending):
+        ''' Must be called with the lock held. Moves as much of pending
+        into the queue as fits.
+        '''
+        if self.maxsize > 0:
+            count = min(self.maxsize - len(self._items), len(pending))
+        else:
+            count = len(pending)
+            
+        if count > 0:
+            self._items.extend(pending.popleft() for __ in range(count))
+            self._notify()
+            
+    def _pop(self, max_items):
+        ''' Must be called with the lock held, and the queue nonempty.
+        '''
+        items = self._items
+        batch = [items.popleft() for __ in range(min(max_items, len(items)))]
+        self._notify()
+        return batch
+        
+    def _notify(self):
+        ''' Must be called with the lock held, whenever the queue
+        changes. Wakes up anyone who might now be able to proceed.
+        '''
+        if self._closed:
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        else:
+            if self._items:
+                self._not_empty.notify(len(self._items))
+            if self.maxsize > 0 and not self.full():
+                self._not_full.notify(self.maxsize - len(self._items))
+                
+        # (The loop can only be waiting if we're bound to it.)
+        if self._getters or self._putters:
+            if running_loop() is self._loop:
+                self._release_waiters()
+            
+            elif not self._wakeup_pending:
+                self._wakeup_pending = True
+                try:
+                    self._loop.call_soon_threadsafe(self._wake_loop)
+                # The loop is closed, so there's nobody left to wake.
+                except RuntimeError:
+                    self._wakeup_pending = False
+                
+    def _wake_loop(self):
+        ''' Called within the loop, by call_soon_threadsafe.
+        '''
+        with self._lock:
+            self._wakeup_pending = False
+            self._release_waiters()
+            
+    def _release_waiters(self):
+        ''' Must be called with the lock held, within the loop. Releases
+        as many waiting coroutines as could proceed. They'll recheck
+        once they run, so releasing too many is harmless.
+        '''
+        if self._closed:
+            getters = len(self._getters)
+            putters = len(self._putters)
+        else:
+            getters = len(self._items)
+            putters = self.maxsize - len(self._items)
+            
+        for waiters, count in ((self._getters, getters),
+                               (self._putters, putters)):
+            while count > 0 and waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    count -= 1
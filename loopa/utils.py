@@ -30,12 +30,21 @@ loopa: Arduino-esque event loop app framework, and other utilities.
 ------------------------------------------------------
 '''
 
+import io
+import time
+import inspect
+import functools
 import logging
+import itertools
 import asyncio
+import weakref
 import threading
 import traceback
+import collections
 import concurrent.futures
 
+from .exceptions import QueueClosed
+
 
 # ###############################################
 # Boilerplate
@@ -69,6 +78,49 @@ def default_to(check, default, comparator=None):
             return check
 
 
+def current_task(loop=None):
+    ''' Returns the task currently running in loop (or None). Wraps
+    the differences between asyncio versions.
+    '''
+    if hasattr(asyncio, 'current_task'):
+        return asyncio.current_task(loop)
+    else:
+        return asyncio.Task.current_task(loop)
+        
+        
+def all_tasks(loop=None):
+    ''' Returns a set of all of the unfinished tasks in loop. Wraps the
+    differences between asyncio versions.
+    '''
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    else:
+        return {task for task in asyncio.Task.all_tasks(loop)
+                if not task.done()}
+        
+        
+def running_loop():
+    ''' Returns the event loop running in the current thread, or None if
+    there is none. Unlike asyncio.get_event_loop, never creates a loop.
+    '''
+    if hasattr(asyncio, 'get_running_loop'):
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+    else:
+        return asyncio._get_running_loop()
+        
+        
+def format_task_stack(task, limit=None):
+    ''' Returns the task's current coroutine stack (and its repr, which
+    includes the coroutine name) as a string.
+    '''
+    buffer = io.StringIO()
+    task.print_stack(limit=limit, file=buffer)
+    return buffer.getvalue()
+
+
 # ###############################################
 # Lib
 # ###############################################
@@ -127,131 +179,373 @@ def make_background_future(*args, **kwargs):
     return task
 
 
-class _WrappedEvent(asyncio.Event):
-    ''' Adds an internal future to the event and gives it any expected
-    methods.
+class _LoopInbox:
+    ''' Collects callbacks for a loop from other threads. Only the first
+    callback after each drain wakes the loop (through its self-pipe);
+    everything else that arrives before the loop gets around to it is
+    run within that same wakeup.
     '''
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.__result = None
-        self.__exc = None
+    def __init__(self):
+        # Note that we can't hold a reference to the loop, or it would
+        # never be collected out of _inboxes.
+        self._lock = threading.Lock()
+        self._callbacks = collections.deque()
+        self._wakeup_pending = False
         
-    def set(self, result, exc):
-        ''' Sets us up with a result and an exception.
+    def call_soon(self, loop, callback, args):
+        if loop.is_closed():
+            raise RuntimeError('Event loop is closed')
+            
+        # Schedule the drain before releasing the lock, so that once any
+        # call returns, its callback is guaranteed to already be scheduled.
+        with self._lock:
+            self._callbacks.append((callback, args))
+            if self._wakeup_pending:
+                return
+                
+            try:
+                loop.call_soon_threadsafe(self._drain, loop)
+            except RuntimeError:
+                self._callbacks.clear()
+                raise
+                
+            self._wakeup_pending = True
+            
+    def _drain(self, loop):
+        ''' Runs within the loop. Runs everything in the inbox.
         '''
-        self.__result = result
-        self.__exc = exc
-        super().set()
+        with self._lock:
+            callbacks = self._callbacks
+            self._callbacks = collections.deque()
+            # Anything that arrives from here on needs a new wakeup.
+            self._wakeup_pending = False
+            
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            # Same as asyncio does for its own callbacks
+            except Exception as exc:
+                loop.call_exception_handler({
+                    'message': 'Exception in callback ' + repr(callback),
+                    'exception': exc,
+                })
+
+
+_inboxes = weakref.WeakKeyDictionary()
+_inboxes_lock = threading.Lock()
+
+
+def call_soon_coalesced(loop, callback, *args):
+    ''' Like loop.call_soon_threadsafe, but coalesces wakeups: any
+    number of calls (from any number of threads) made before the loop
+    next runs them share a single write to the loop's self-pipe. Calls
+    are run in order, but may run before or after callbacks scheduled
+    directly through call_soon_threadsafe. Unlike call_soon_threadsafe,
+    returns no handle.
+    
+    If we're already within loop, this is just loop.call_soon.
+    '''
+    if running_loop() is loop:
+        loop.call_soon(callback, *args)
+        return
         
-    async def wait(self):
-        ''' Waits for self, and then returns our result, or raises our
-        exception.
-        '''
-        await super().wait()
+    inbox = _inboxes.get(loop)
+    if inbox is None:
+        with _inboxes_lock:
+            inbox = _inboxes.get(loop)
+            if inbox is None:
+                inbox = _inboxes[loop] = _LoopInbox()
+    
+    inbox.call_soon(loop, callback, args)
+    
+    
+def run_coroutine_coalesced(coro, loop):
+    ''' Same as asyncio.run_coroutine_threadsafe, except that the loop
+    is woken through call_soon_coalesced.
+    '''
+    if not asyncio.iscoroutine(coro):
+        raise TypeError('A coroutine object is required')
         
-        if self.__exc is not None:
-            raise self.__exc
+    future = concurrent.futures.Future()
+    
+    def callback():
+        try:
+            asyncio.futures._chain_future(
+                asyncio.ensure_future(coro, loop=loop),
+                future
+            )
+        except Exception as exc:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exc)
+            raise
+            
+    call_soon_coalesced(loop, callback)
+    return future
+
+
+def _copy_future_state(source, dest):
+    ''' Copies the outcome of a completed concurrent.futures.Future (or
+    asyncio future) to an asyncio future. Must be called from within
+    dest's event loop.
+    '''
+    # Whoever was waiting on dest has lost interest.
+    if dest.done():
+        return
+        
+    elif source.cancelled():
+        dest.cancel()
+        
+    else:
+        exc = source.exception()
+        if exc is None:
+            dest.set_result(source.result())
         else:
-            return self.__result
+            dest.set_exception(exc)
 
 
-def wrap_threaded_future(fut, loop=None):
-    ''' Wraps a threaded future in an async future.
+def wrap_threaded_future(fut, loop=None, propagate_cancel=False):
+    ''' Wraps a threaded future in an async future. The returned future
+    will have the same result, exception, or cancellation as fut, once
+    it completes.
+    
+    By default (unlike asyncio.wrap_future), nothing is propagated back
+    to fut. The only thing this allocates, besides the returned future,
+    is a single done callback (and, if fut is completed from a different
+    thread, an entry in the loop's inbox; see call_soon_coalesced). If
+    propagate_cancel is True, cancelling the returned future also
+    cancels fut.
     '''
-    # Create an event on our source loop.
     if loop is None:
         loop = asyncio.get_event_loop()
-    source_event = _WrappedEvent()
+    dest = loop.create_future()
     
-    # Create a callback to set the source event's infos
-    def callback(fut, loop=loop, source_event=source_event):
-        exc = None
-        result = None
+    if propagate_cancel:
+        def cancel_callback(dest, source=fut):
+            if dest.cancelled():
+                source.cancel()
         
-        try:
-            exc = fut.exception()
-            
-            # Only get the result if there was no exception, or this will raise
-            # the exception.
-            if exc is None:
-                result = fut.result()
-            
-        except concurrent.futures.CancelledError as cancelled:
-            exc = cancelled
+        dest.add_done_callback(cancel_callback)
+    
+    def callback(source, dest=dest, loop=loop):
+        # If we're already within the destination loop (for example, because
+        # fut was already done), skip the (relatively expensive) threadsafe
+        # handoff.
+        if running_loop() is loop:
+            _copy_future_state(source, dest)
+            return
             
-        finally:
-            # This is what actually passes the values on
-            loop.call_soon_threadsafe(source_event.set, result, exc)
+        try:
+            call_soon_coalesced(loop, _copy_future_state, source, dest)
+        # The destination loop has already been closed, so there's nobody
+        # left to tell.
+        except RuntimeError:
+            pass
         
-    # This will also be called if the fut is cancelled.
+    # This will be called immediately if fut is already done, and otherwise
+    # from whatever thread completes it.
     fut.add_done_callback(callback)
+    return dest
+            
+
+class _FutureWaiter:
+    ''' Lets synchronous code wait on a set of asyncio futures (from any
+    number of loops) and/or concurrent.futures.Futures. Registering the
+    done callbacks takes a single call_soon_coalesced per loop, and
+    every completion is collected through a single condition.
+    '''
     
-    # Now wrap the event's wait into a future and return it
-    return asyncio.ensure_future(source_event.wait())
+    def __init__(self, futs):
+        self.pending = set(futs)
+        self._completed = collections.deque()
+        self._condition = threading.Condition()
+        self._by_loop = {}
+        
+        for fut in self.pending:
+            if isinstance(fut, concurrent.futures.Future):
+                fut.add_done_callback(self._on_done)
+            else:
+                self._by_loop.setdefault(fut._loop, []).append(fut)
+                
+        for loop, futs in self._by_loop.items():
+            self._call_in_loop(loop, self._add_callbacks, futs)
+            
+    def _call_in_loop(self, loop, func, futs):
+        ''' Calls func(futs) within loop, directly if we're already in
+        it.
+        '''
+        if running_loop() is loop:
+            func(futs)
+        else:
+            call_soon_coalesced(loop, func, futs)
+            
+    def _add_callbacks(self, futs):
+        for fut in futs:
+            fut.add_done_callback(self._on_done)
             
+    def _remove_callbacks(self, futs):
+        for fut in futs:
+            fut.remove_done_callback(self._on_done)
+            
+    def _on_done(self, fut):
+        with self._condition:
+            self._completed.append(fut)
+            self._condition.notify()
+            
+    def next_completed(self, deadline=None):
+        ''' Blocks until another future has completed, and returns it.
+        Returns None if there are no pending futures left, or if the
+        deadline (as per time.monotonic) passes first.
+        '''
+        with self._condition:
+            while not self._completed:
+                if not self.pending:
+                    return None
+                
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._condition.wait(remaining):
+                        if not self._completed:
+                            return None
+                    
+            fut = self._completed.popleft()
+            
+        self.pending.discard(fut)
+        return fut
+        
+    def close(self):
+        ''' Removes our callbacks from anything still pending, so that
+        we don't leak them onto long-lived futures.
+        '''
+        pending = self.pending
+        
+        for loop, futs in self._by_loop.items():
+            futs = [fut for fut in futs if fut in pending]
+            if futs and not loop.is_closed():
+                self._call_in_loop(loop, self._remove_callbacks, futs)
+                
+        for fut in pending:
+            if isinstance(fut, concurrent.futures.Future):
+                fut.remove_done_callback(self._on_done)
+                
+                
+def _deadline(timeout):
+    ''' Converts a timeout into a time.monotonic deadline.
+    '''
+    if timeout is None:
+        return None
+    else:
+        return time.monotonic() + timeout
 
-def wait_threadsafe(fut):
-    ''' Wait for the result of an asyncio future from synchronous code.
-    Returns it as soon as available.
+
+def wait_all_threadsafe(futs, timeout=None):
+    ''' Waits, from synchronous code, for all of futs to complete. futs
+    may be asyncio futures (from any number of loops), or
+    concurrent.futures.Futures. Returns (done, pending) sets, exactly
+    like concurrent.futures.wait.
     '''
-    event = threading.Event()
-    results = []
+    futs = set(futs)
+    waiter = _FutureWaiter(futs)
+    deadline = _deadline(timeout)
     
-    # Create a callback to set the event and extract the results
-    def callback(fut, event=event):
-        exc = None
-        result = None
+    try:
+        while waiter.next_completed(deadline) is not None:
+            pass
+    finally:
+        waiter.close()
         
-        try:
-            exc = fut.exception()
+    done = {fut for fut in futs if fut.done()}
+    return done, futs - done
+    
+    
+def wait_any_threadsafe(futs, timeout=None):
+    ''' Waits, from synchronous code, for any of futs to complete. See
+    wait_all_threadsafe. Returns (done, pending) sets.
+    '''
+    futs = set(futs)
+    waiter = _FutureWaiter(futs)
+    
+    try:
+        waiter.next_completed(_deadline(timeout))
+    finally:
+        waiter.close()
+    
+    # More than one may have completed in the meantime.
+    done = {fut for fut in futs if fut.done()}
+    return done, futs - done
+    
+    
+def as_completed_threadsafe(futs, timeout=None):
+    ''' Iterates over futs, from synchronous code, yielding each one as
+    it completes. See wait_all_threadsafe. Raises
+    concurrent.futures.TimeoutError if they haven't all completed
+    within timeout (which applies to the iteration as a whole).
+    '''
+    waiter = _FutureWaiter(futs)
+    deadline = _deadline(timeout)
+    
+    try:
+        while waiter.pending:
+            fut = waiter.next_completed(deadline)
             
-            # Only get the result if there was no exception, or this will raise
-            # the exception.
-            if exc is None:
-                result = exc.result()
+            if fut is None:
+                raise concurrent.futures.TimeoutError(
+                    str(len(waiter.pending)) + ' futures did not complete ' +
+                    'within ' + str(timeout) + 's.'
+                )
+                
+            yield fut
             
-        except concurrent.futures.CancelledError as cancelled:
-            exc = cancelled
+    finally:
+        waiter.close()
             
-        finally:
-            results.append(result)
-            results.append(exc)
-            event.set()
-        
-    # Add the callback to the future (it will always be run from within the
-    # event loop). But make sure to do so in a threadsafe way. Hot damn this is
-    # messy.
-    fut._loop.call_soon_threadsafe(
-        fut.add_done_callback,
-        callback
-    )
+
+def wait_threadsafe(fut, timeout=None):
+    ''' Wait for the result of an asyncio future from synchronous code.
+    Returns it as soon as available (or raises its exception). Raises
+    concurrent.futures.TimeoutError if it doesn't complete within
+    timeout.
+    '''
+    done, __ = wait_all_threadsafe([fut], timeout=timeout)
     
-    # Now wait for completion and return the exception or result.
-    event.wait()
-    result, exc = results
-    if exc:
-        raise exc
-    else:
-        return result
+    if not done:
+        raise concurrent.futures.TimeoutError()
+    
+    return fut.result()
 
         
-async def run_coroutine_loopsafe(coro, loop):
+async def run_coroutine_loopsafe(coro, loop, timeout=None):
     ''' Threadsafe, asyncsafe (ie non-loop-blocking) call to run a coro
     in a different event loop. Returns a future that can be awaited from
     within the current loop.
+    
+    Cancellation is propagated in both directions: cancelling the
+    returned future cancels the coro's task in the other loop, and vice
+    versa. If timeout is not None, it is enforced within the other loop,
+    so that the coro stops running as soon as it expires; the returned
+    future then raises asyncio.TimeoutError.
     '''
+    if timeout is not None:
+        coro = asyncio.wait_for(coro, timeout)
+    
     # This returns a concurrent.futures.Future, so we need to wait for it, but
-    # we cannot block our event loop, soooo...
-    thread_future = asyncio.run_coroutine_threadsafe(coro, loop)
-    return wrap_threaded_future(thread_future)
+    # we cannot block our event loop, soooo... Note that asyncio handles
+    # propagating cancellation between this and the remote task.
+    thread_future = run_coroutine_coalesced(coro, loop)
+    return wrap_threaded_future(thread_future, propagate_cancel=True)
     
     
 async def await_coroutine_loopsafe(coro, loop, timeout=None):
     ''' Wrapper around run_coroutine_loopsafe that actuall returns the
     result of the coro (or raises its exception).
+    
+    The timeout is enforced within both loops. The remote timeout stops
+    the coro itself; the local one is a backstop, in case the remote
+    loop is too busy to enforce it (the coro is cancelled either way).
     '''
-    async_future = run_coroutine_loopsafe(coro, loop)
+    async_future = await run_coroutine_loopsafe(coro, loop, timeout=timeout)
     return (await asyncio.wait_for(async_future, timeout=timeout))
             
             
@@ -264,7 +558,7 @@ def await_coroutine_threadsafe(coro, loop):
     Leaving loop as default None will result in asyncio inferring the
     loop from the default from the current context (aka usually thread).
     '''
-    fut = asyncio.run_coroutine_threadsafe(
+    fut = run_coroutine_coalesced(
         coro = coro,
         loop = loop
     )
@@ -277,6 +571,575 @@ def await_coroutine_threadsafe(coro, loop):
     return fut.result()
 
 
+class _Batch:
+    ''' A batch of coroutines and/or callables submitted to a loop
+    through submit_many_threadsafe. Every item gets its own
+    concurrent.futures.Future, but the whole batch is handed to the
+    loop with a single call_soon_coalesced.
+    '''
+    
+    def __init__(self, items, loop, limit=None):
+        if limit is not None and limit < 1:
+            raise ValueError('Batch concurrency limit must be at least 1.')
+        
+        self.loop = loop
+        self.futures = [concurrent.futures.Future() for __ in items]
+        self.workers = []
+        self._jobs = zip(items, self.futures)
+        self._limit = limit
+        
+    def submit(self):
+        ''' Schedules the batch within its loop. Threadsafe.
+        '''
+        call_soon_coalesced(self.loop, self._start)
+        
+    def cancel(self):
+        ''' Cancels everything in the batch that hasn't finished yet.
+        Threadsafe.
+        '''
+        try:
+            call_soon_coalesced(self.loop, self._cancel)
+        # The loop is closed, so make sure nothing is left waiting.
+        except RuntimeError:
+            self._cancel()
+        
+    def _start(self):
+        ''' Starts the batch's workers. Without a limit, every item
+        gets its own worker.
+        '''
+        workers = len(self.futures)
+        if self._limit is not None:
+            workers = min(workers, self._limit)
+            
+        self.workers = [
+            asyncio.ensure_future(self._work(), loop=self.loop)
+            for __ in range(workers)
+        ]
+        
+    def _cancel(self):
+        ''' Cancels all workers, and any items they haven't gotten to
+        yet.
+        '''
+        for worker in self.workers:
+            worker.cancel()
+        # Don't rely upon the workers to do this, since they may not have
+        # started yet.
+        self._abandon()
+        
+    def _abandon(self):
+        ''' Cancels every remaining item. Shared between all workers,
+        since they all draw from the same iterator.
+        '''
+        for item, fut in self._jobs:
+            _cancel_future(fut)
+            if asyncio.iscoroutine(item):
+                item.close()
+        
+    async def _work(self):
+        ''' Runs items from the batch one at a time until there are
+        none left.
+        '''
+        try:
+            for item, fut in self._jobs:
+                # This was cancelled by the caller before we got to it.
+                if fut.cancelled():
+                    _cancel_future(fut)
+                    if asyncio.iscoroutine(item):
+                        item.close()
+                    continue
+                    
+                await self._run_item(item, fut)
+        
+        except asyncio.CancelledError:
+            self._abandon()
+            raise
+            
+    async def _run_item(self, item, fut):
+        ''' Runs a single item, and settles its future. Only raises if
+        we ourselves (as opposed to the item) are cancelled.
+        '''
+        try:
+            if asyncio.iscoroutine(item):
+                result = item
+            else:
+                result = item()
+        
+        # Prior to 3.8, CancelledError is an Exception; handle it first.
+        except asyncio.CancelledError:
+            _cancel_future(fut)
+            return
+            
+        except Exception as exc:
+            _settle(fut, exception=exc)
+            return
+            
+        if not inspect.isawaitable(result):
+            _settle(fut, result=result)
+            return
+            
+        # Run it as its own task, so that the item being cancelled can be told
+        # apart from us being cancelled (which interrupts the wait instead).
+        inner = asyncio.ensure_future(result, loop=self.loop)
+        fut.add_done_callback(
+            functools.partial(self._cancel_from_caller, inner)
+        )
+        
+        try:
+            await asyncio.wait([inner])
+        except asyncio.CancelledError:
+            inner.cancel()
+            _cancel_future(fut)
+            raise
+        
+        if inner.cancelled():
+            _cancel_future(fut)
+        elif inner.exception() is not None:
+            _settle(fut, exception=inner.exception())
+        else:
+            _settle(fut, result=inner.result())
+            
+    def _cancel_from_caller(self, inner, fut):
+        ''' Passes a cancellation of the item's future (from any thread)
+        on to the item itself.
+        '''
+        if fut.cancelled() and not inner.done():
+            try:
+                call_soon_coalesced(self.loop, inner.cancel)
+            # The loop is closed, so there's nothing left to cancel.
+            except RuntimeError:
+                pass
+                
+
+def _settle(fut, result=None, exception=None):
+    ''' Sets the concurrent.futures.Future's result or exception, unless
+    it has already been cancelled. Like _cancel_future, this must be
+    called exactly once per future.
+    '''
+    if fut.set_running_or_notify_cancel():
+        if exception is None:
+            fut.set_result(result)
+        else:
+            fut.set_exception(exception)
+            
+            
+def _cancel_future(fut):
+    ''' Cancels the concurrent.futures.Future (unless the caller already
+    has), and wakes up anything waiting on it, which cancel() alone
+    doesn't. Must be called exactly once per future.
+    '''
+    fut.cancel()
+    fut.set_running_or_notify_cancel()
+            
+            
+def _outcome(fut):
+    ''' Returns the exception of a finished concurrent.futures.Future
+    (including CancelledError, if it was cancelled), or None.
+    '''
+    if fut.cancelled():
+        return concurrent.futures.CancelledError()
+    else:
+        return fut.exception()
+
+
+def submit_many_threadsafe(items, loop, limit=None):
+    ''' Submits a batch of coroutines and/or callables to run in loop,
+    using a single loop wakeup for the whole batch. Callables are
+    called from within the loop; if they return an awaitable, it is
+    awaited. Returns a list of concurrent.futures.Future, one per item,
+    in the same order as items.
+    
+    If limit is defined, no more than limit items will be run at once.
+    Items may be cancelled through their futures; any that are already
+    running are cancelled within the loop. An item that is cancelled
+    (or raises CancelledError) has its future cancelled, and the rest
+    of the batch carries on.
+    '''
+    batch = _Batch(list(items), loop, limit)
+    batch.submit()
+    return batch.futures
+    
+    
+def gather_threadsafe(items, loop, limit=None, timeout=None,
+                      return_exceptions=False):
+    ''' Runs a batch of coroutines and/or callables in loop, exactly as
+    with submit_many_threadsafe, and then blocks until they have all
+    finished. Returns their results, in the same order as items.
+    
+    If return_exceptions is True, an item's exception is returned in
+    place of its result (for cancelled items, a CancelledError).
+    Otherwise, the first exception (in the order
+    of items) is raised as soon as it happens, and the rest of the
+    batch is cancelled.
+    
+    If the batch hasn't finished within timeout, the rest of it is
+    cancelled and concurrent.futures.TimeoutError is raised.
+    '''
+    batch = _Batch(list(items), loop, limit)
+    batch.submit()
+    
+    if return_exceptions:
+        return_when = concurrent.futures.ALL_COMPLETED
+    else:
+        return_when = concurrent.futures.FIRST_EXCEPTION
+    
+    done, pending = concurrent.futures.wait(
+        batch.futures,
+        timeout = timeout,
+        return_when = return_when
+    )
+    
+    if not return_exceptions:
+        for fut in batch.futures:
+            if fut in done:
+                exc = _outcome(fut)
+                if exc is not None:
+                    batch.cancel()
+                    raise exc
+    
+    if pending:
+        batch.cancel()
+        raise concurrent.futures.TimeoutError(
+            str(len(pending)) + ' of ' + str(len(batch.futures)) +
+            ' batched items did not finish within ' + str(timeout) + 's.'
+        )
+        
+    results = []
+    for fut in batch.futures:
+        exc = _outcome(fut)
+        if exc is None:
+            results.append(fut.result())
+        else:
+            results.append(exc)
+    
+    return results
+
+
+async def _fill_from_async(aiterable, channel):
+    ''' Runs within the loop. Copies everything from aiterable into the
+    channel, until either runs out.
+    '''
+    try:
+        async for item in aiterable:
+            await channel.put(item)
+            
+    except QueueClosed:
+        pass
+        
+    finally:
+        channel.close()
+        if hasattr(aiterable, 'aclose'):
+            await aiterable.aclose()
+        
+        
+def _check_buffer_size(buffer_size):
+    ''' A DualQueue with a maxsize of 0 is unbounded, which would defeat
+    the entire point of the iterator bridges' buffers.
+    '''
+    if buffer_size < 1:
+        raise ValueError('Buffer size must be at least 1.')
+        
+        
+def iterate_threadsafe(aiterable, loop, batch_size=100, buffer_size=1000):
+    ''' Iterates synchronously over an async iterable (for example, an
+    async generator) that is run within loop. Items are buffered (up to
+    buffer_size at a time, after which the async iterable must wait for
+    us to catch up), and are retrieved up to batch_size at a time.
+    
+    If we stop iterating early (ie, if this generator is closed), the
+    async iterable is cancelled and (if possible) closed within loop.
+    Any exception it raises is raised here, once we've consumed
+    everything it produced beforehand.
+    '''
+    # Check this now, instead of on the first iteration.
+    _check_buffer_size(buffer_size)
+    return _iterate_threadsafe(aiterable, loop, batch_size, buffer_size)
+    
+    
+def _iterate_threadsafe(aiterable, loop, batch_size, buffer_size):
+    ''' See iterate_threadsafe.
+    '''
+    # Note that queues imports us.
+    from .queues import DualQueue
+    
+    channel = DualQueue(buffer_size, loop=loop)
+    producer = run_coroutine_coalesced(
+        _fill_from_async(aiterable, channel),
+        loop
+    )
+    
+    try:
+        while True:
+            try:
+                batch = channel.get_many_threadsafe(batch_size)
+            except QueueClosed:
+                break
+            yield from batch
+            
+        producer.result()
+        
+    # If we stopped early, this interrupts the producer wherever it is (in
+    # the async iterable, or waiting on the channel); it cleans up after
+    # itself.
+    finally:
+        producer.cancel()
+        
+        
+class _ThreadedAsyncIterator:
+    ''' See aiterate_threadsafe.
+    '''
+    
+    def __init__(self, iterable, loop, batch_size, buffer_size):
+        # Note that queues imports us.
+        from .queues import DualQueue
+        
+        self._channel = DualQueue(buffer_size, loop=loop)
+        self._batch_size = batch_size
+        self._batch = collections.deque()
+        self._producer = loop.run_in_executor(None, self._fill, iterable)
+        
+    def _fill(self, iterable):
+        ''' Runs within the executor. Copies everything from iterable
+        into the channel, until either runs out.
+        '''
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                self._channel.put_threadsafe(item)
+                
+        except QueueClosed:
+            pass
+            
+        finally:
+            self._channel.close()
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        
+    def __aiter__(self):
+        return self
+        
+    async def __anext__(self):
+        if not self._batch:
+            try:
+                self._batch.extend(
+                    await self._channel.get_many(self._batch_size)
+                )
+                
+            except QueueClosed:
+                # Raise any exception from the iterable.
+                await self._producer
+                raise StopAsyncIteration
+                
+        return self._batch.popleft()
+        
+    async def aclose(self):
+        ''' Stops iterating early. The iterable is closed (if possible)
+        as soon as it produces its next item.
+        '''
+        self._channel.close()
+        
+    def __del__(self):
+        self._channel.close()
+        
+        
+def aiterate_threadsafe(iterable, loop=None, batch_size=100,
+                        buffer_size=1000):
+    ''' The reverse of iterate_threadsafe: returns an async iterator
+    over a synchronous iterable, which is run within loop's default
+    executor. Items are buffered (up to buffer_size at a time, after
+    which the iterable's thread blocks until we catch up), and are
+    retrieved up to batch_size at a time.
+    
+    Call aclose() on the returned iterator to stop early.
+    '''
+    # Check this before constructing the iterator, so that we never leave
+    # a half-built one behind for __del__ to trip over.
+    _check_buffer_size(buffer_size)
+    
+    if loop is None:
+        loop = asyncio.get_event_loop()
+        
+    return _ThreadedAsyncIterator(iterable, loop, batch_size, buffer_size)
+        
+        
+class HedgeStats:
+    ''' Counters for a Hedger.
+    
+    calls           Number of hedged calls made
+    hedged_calls    Number of calls that sent at least one hedge
+    hedges          Total number of hedges sent
+    hedge_wins      Number of calls answered by a hedge, instead of by
+                    the replica the call was first sent to
+    retries         Number of retries (after every replica in an
+                    attempt had failed)
+    failures        Number of calls that failed, even after retrying
+    '''
+    
+    def __init__(self):
+        self.calls = 0
+        self.hedged_calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.failures = 0
+        
+    @property
+    def hedge_rate(self):
+        ''' The fraction of calls that sent at least one hedge.
+        '''
+        if self.calls:
+            return self.hedged_calls / self.calls
+        else:
+            return 0.0
+        
+    def __repr__(self):
+        return (
+            type(self).__name__ + '(calls=' + str(self.calls) +
+            ', hedged_calls=' + str(self.hedged_calls) +
+            ', hedges=' + str(self.hedges) +
+            ', hedge_wins=' + str(self.hedge_wins) +
+            ', retries=' + str(self.retries) +
+            ', failures=' + str(self.failures) + ')'
+        )
+
+
+class Hedger:
+    ''' Makes hedged calls against a number of replicas, each of which
+    serves the same API from its own event loop (for example, several
+    identical threaded TaskLoopers). Each replica must have a _loop.
+    
+    Each call is sent to a single replica (chosen round-robin). If it
+    hasn't answered within hedge_delay, the call is also sent to the
+    next replica, and so on, up to max_hedges times. The first result
+    wins, and all of the other copies of the call are cancelled.
+    
+    If every copy of the call fails, the call is retried (starting with
+    the next replica) up to retries times, sleeping for backoff seconds
+    before the first retry, and multiplying that by backoff_factor
+    before every subsequent one. If timeout is not None, it limits
+    every individual copy of the call, and is enforced within the
+    replica's loop.
+    '''
+    
+    def __init__(self, replicas, hedge_delay, max_hedges=1, retries=0,
+                 backoff=.01, backoff_factor=2, timeout=None):
+        self.replicas = list(replicas)
+        if not self.replicas:
+            raise ValueError('Hedger requires at least one replica.')
+        
+        self.hedge_delay = hedge_delay
+        self.max_hedges = min(max_hedges, len(self.replicas) - 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.stats = HedgeStats()
+        self._round_robin = itertools.cycle(range(len(self.replicas)))
+        
+    async def call(self, coro_factory):
+        ''' Makes a hedged call. coro_factory is called with a replica
+        (once per copy of the call), and must return a coroutine to run
+        within the replica's loop. Returns the first result, or raises
+        the last exception if every attempt failed.
+        '''
+        self.stats.calls += 1
+        delay = self.backoff
+        # Set by _attempt if it hedges, so that a call which hedges during
+        # more than one attempt is still only counted once.
+        hedged = [False]
+        
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.stats.retries += 1
+                    await asyncio.sleep(delay)
+                    delay *= self.backoff_factor
+                
+                try:
+                    return (await self._attempt(coro_factory, hedged))
+                
+                # We were cancelled ourselves (copies cancelled within a
+                # replica are converted to RuntimeError), so don't retry.
+                except asyncio.CancelledError:
+                    raise
+                
+                except Exception:
+                    if attempt == self.retries:
+                        self.stats.failures += 1
+                        raise
+                        
+        finally:
+            if hedged[0]:
+                self.stats.hedged_calls += 1
+        
+    async def _attempt(self, coro_factory, hedged):
+        ''' Sends the call to one replica, and hedges it as needed.
+        hedged is the call's one-item list flag, set if we hedge.
+        '''
+        first = next(self._round_robin)
+        # Lookup for copy of the call -> replica index
+        pending = {}
+        sent = 0
+        exc = None
+        send = True
+        
+        try:
+            while True:
+                if send:
+                    index = (first + sent) % len(self.replicas)
+                    replica = self.replicas[index]
+                    copy = asyncio.ensure_future(await_coroutine_loopsafe(
+                        coro_factory(replica),
+                        loop = replica._loop,
+                        timeout = self.timeout
+                    ))
+                    pending[copy] = index
+                    
+                    if sent:
+                        hedged[0] = True
+                        self.stats.hedges += 1
+                    sent += 1
+                
+                # Every copy of the call has failed.
+                elif not pending:
+                    raise exc
+                
+                can_hedge = sent <= self.max_hedges
+                if can_hedge:
+                    timeout = self.hedge_delay
+                else:
+                    timeout = None
+                    
+                done, __ = await asyncio.wait(
+                    pending,
+                    timeout = timeout,
+                    return_when = asyncio.FIRST_COMPLETED
+                )
+                
+                for copy in done:
+                    index = pending.pop(copy)
+                    
+                    if copy.cancelled():
+                        exc = RuntimeError(
+                            'Call cancelled within replica: ' +
+                            repr(self.replicas[index])
+                        )
+                    elif copy.exception() is not None:
+                        exc = copy.exception()
+                    else:
+                        if index != first:
+                            self.stats.hedge_wins += 1
+                        return copy.result()
+                
+                # Hedge if nothing answered in time. If everything we sent has
+                # already failed, don't bother waiting out the hedge delay.
+                send = can_hedge and (not done or not pending)
+        
+        # Cancel all of the losers (or everything, if we were cancelled)
+        finally:
+            for copy in pending:
+                copy.cancel()
+                
+                
 def triplicated(func):
     ''' Decorator to make a threadsafe and loopsafe copy of the
     decorated function.
@@ -284,6 +1147,86 @@ def triplicated(func):
     func.__triplicate__ = True
     return func
     
+    
+def _call_threadsafe(coro, loop):
+    ''' Runs coro in loop and blocks until it finishes, returning its
+    result (or raising its exception). If we're already within loop,
+    blocking would deadlock, so coro is closed (without running any of
+    it) and RuntimeError is raised instead.
+    '''
+    if running_loop() is loop:
+        coro.close()
+        raise RuntimeError(
+            'Threadsafe calls cannot be made from within the target ' +
+            'event loop. Use the async or loopsafe version instead.'
+        )
+    else:
+        return run_coroutine_coalesced(coro, loop).result()
+        
+        
+async def _call_loopsafe(coro, loop):
+    ''' Runs coro in loop and waits for it to finish, without blocking
+    the current loop. If we're already within loop, just awaits coro.
+    '''
+    current_loop = running_loop()
+    
+    if current_loop is loop:
+        return (await coro)
+        
+    else:
+        return (await wrap_threaded_future(
+            run_coroutine_coalesced(coro, loop),
+            current_loop,
+            propagate_cancel = True
+        ))
+        
+        
+async def _gather_limited(coros, limit, return_exceptions=False):
+    ''' Runs coros within the current loop, no more than limit at a
+    time, and returns their results in order. If return_exceptions is
+    False, the first exception is raised as soon as it happens, and the
+    remaining coros are cancelled. Cancellation always propagates, and
+    is never returned as a result.
+    '''
+    results = [None] * len(coros)
+    jobs = enumerate(coros)
+    workers = []
+    
+    async def work():
+        for index, coro in jobs:
+            try:
+                results[index] = await coro
+            # Prior to 3.8, CancelledError is an Exception, and we need to
+            # stop instead of moving on to the next job.
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if return_exceptions:
+                    results[index] = exc
+                else:
+                    raise
+    
+    try:
+        if limit < 1:
+            raise ValueError('Concurrency limit must be at least 1.')
+            
+        workers.extend(
+            asyncio.ensure_future(work())
+            for __ in range(min(limit, len(coros)))
+        )
+        
+        if workers:
+            await asyncio.gather(*workers)
+        
+    finally:
+        for worker in workers:
+            worker.cancel()
+        # Close anything that never got started, to avoid warnings.
+        for index, coro in jobs:
+            coro.close()
+            
+    return results
+    
 
 # Note: if either Triplicate name, or type subclass changes, need to update
 # bottom of __new__
@@ -294,7 +1237,20 @@ class Triplicate(type):
     are therefore free to alter their metaclass as they'd like. BUT, as
     a flipside, subclasses must explicitly re-declare a Triplicate
     metaclass, if they want to.
+    
+    When called from within self._loop, the generated _loopsafe method
+    awaits the coro directly, and the generated _threadsafe method
+    raises RuntimeError without running any of the coro, since blocking
+    would deadlock the loop.
+    
+    Each triplicated function also gets bulk variants (name_many, plus
+    its _threadsafe and _loopsafe versions). These take an iterable of
+    argument tuples, and run the function for each of them within
+    self._loop, no more than limit (default MANY_LIMIT) at a time. The
+    results are returned as a list, in order, and the whole batch only
+    crosses between threads once.
     '''
+    MANY_LIMIT = 100
     
     def __new__(mcls, clsname, bases, namespace, *args, **kwargs):
         ''' Modify the existing namespace: create a triplicate API for
@@ -302,6 +1258,7 @@ class Triplicate(type):
         '''
         threadsafe_suffix = '_threadsafe'
         loopsafe_suffix = '_loopsafe'
+        many_suffix = '_many'
         
         triplicates = {}
         
@@ -315,9 +1272,9 @@ class Triplicate(type):
                     '''
                     # Note that, because the src_coro is unbound, we have to
                     # pass an explicit self.
-                    return await_coroutine_threadsafe(
-                        coro = src_coro(self, *args, **kwargs),
-                        loop = self._loop
+                    return _call_threadsafe(
+                        src_coro(self, *args, **kwargs),
+                        self._loop
                     )
                     
                 # Create a loopsafe version, memoizing the source coro.
@@ -327,17 +1284,70 @@ class Triplicate(type):
                     '''
                     # Note that, because the src_coro is unbound, we have to
                     # pass an explicit self.
-                    return (await await_coroutine_loopsafe(
-                        coro = src_coro(self, *args, **kwargs),
-                        target_loop = self._loop
+                    return (await _call_loopsafe(
+                        src_coro(self, *args, **kwargs),
+                        self._loop
+                    ))
+                    
+                # Create a bulk version, memoizing the source coro.
+                async def many(self, arg_tuples, limit=None,
+                               return_exceptions=False, src_coro=obj):
+                    ''' Auto-generated bulk function for a triplicate
+                    (async, threadsafe, loopsafe) API.
+                    '''
+                    if limit is None:
+                        limit = Triplicate.MANY_LIMIT
+                    
+                    coros = []
+                    try:
+                        for args in arg_tuples:
+                            coros.append(src_coro(self, *args))
+                    
+                    # Don't leave the ones we did create un-awaited.
+                    except BaseException:
+                        for coro in coros:
+                            coro.close()
+                        raise
+                    
+                    return (await _gather_limited(
+                        coros,
+                        limit,
+                        return_exceptions
+                    ))
+                    
+                # The bulk versions don't need to memoize anything, since they
+                # can just look up the bulk coro on self.
+                def many_threadsafe(self, *args, many_name=name + many_suffix,
+                                    **kwargs):
+                    ''' Auto-generated threadsafe bulk function for a
+                    triplicate (async, threadsafe, loopsafe) API.
+                    '''
+                    return _call_threadsafe(
+                        getattr(self, many_name)(*args, **kwargs),
+                        self._loop
+                    )
+                    
+                async def many_loopsafe(self, *args,
+                                        many_name=name + many_suffix,
+                                        **kwargs):
+                    ''' Auto-generated loopsafe bulk function for a
+                    triplicate (async, threadsafe, loopsafe) API.
+                    '''
+                    return (await _call_loopsafe(
+                        getattr(self, many_name)(*args, **kwargs),
+                        self._loop
                     ))
                     
                 # We can't update namespace while iterating over it, so put
                 # those into a temp dict.
                 threadsafe_name = name + threadsafe_suffix
                 loopsafe_name = name + loopsafe_suffix
+                many_name = name + many_suffix
                 triplicates[threadsafe_name] = threadsafe
                 triplicates[loopsafe_name] = loopsafe
+                triplicates[many_name] = many
+                triplicates[many_name + threadsafe_suffix] = many_threadsafe
+                triplicates[many_name + loopsafe_suffix] = many_loopsafe
         
         # Now that we're done iterating, add back in the rest of the API.
         namespace.update(triplicates)
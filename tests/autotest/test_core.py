@@ -35,10 +35,13 @@ import threading
 import queue
 import asyncio
 import atexit
+import time
 
 from loopa.core import _ThreadHelper
 from loopa.core import ManagedTask
 from loopa.core import TaskLooper
+from loopa.core import TickLooper
+from loopa.core import WakeLooper
 from loopa.core import TaskCommander
 
 
@@ -103,6 +106,51 @@ class ManagedTaskTester2(ManagedTask):
             self.flag2.set()
         
         
+class StartupStopper:
+    ''' Stands in for a LagMonitor, to stop the task while it's starting
+    up (after _run has started, but before the loop is running).
+    '''
+    
+    def __init__(self, task):
+        self.task = task
+        
+    def start(self, loop):
+        self.task.stop_threadsafe_nowait()
+        
+    def stop(self):
+        pass
+        
+        
+class HaltRemover(ManagedTask):
+    ''' Removes victim from the commander while stopping it.
+    '''
+    
+    async def task_run(self, commander, victim):
+        await asyncio.sleep(.01)
+        self.removal = asyncio.ensure_future(commander.remove_task(victim))
+        await asyncio.sleep(0)
+        commander.stop()
+        await asyncio.sleep(30)
+        
+        
+class ManagedTaskTester3(ManagedTask):
+    ''' Leaves an orphaned task behind when it exits.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orphan_cancelled = threading.Event()
+        
+    async def orphan(self):
+        try:
+            await asyncio.sleep(30)
+        finally:
+            self.orphan_cancelled.set()
+    
+    async def task_run(self):
+        asyncio.ensure_future(self.orphan())
+        
+        
 class TaskLooperTester1(TaskLooper):
     initter = None
     runner = None
@@ -175,6 +223,123 @@ class TaskLooperTester2(TaskLooper):
         self.stopper = self.initter
         
         
+class TaskLooperTester3(TaskLooperTester1):
+    ''' Same as TaskLooperTester1, but counts the number of times we
+    yield to the event loop.
+    '''
+    
+    async def loop_init(self, *args, **kwargs):
+        await super().loop_init(*args, **kwargs)
+        self.yields = 0
+        self._loop.call_soon(self._count_yield)
+        
+    async def loop_run(self):
+        # Record how many times we had yielded by the time we hit the limit.
+        if self.runner + 1 == self.limit:
+            self.yielded = self.yields
+        await super().loop_run()
+        
+    def _count_yield(self):
+        self.yields += 1
+        self._loop.call_soon(self._count_yield)
+        
+        
+class TickLooperTester1(TickLooper):
+    ''' Records the loop time of every tick, and optionally stalls for
+    a while on one of them.
+    '''
+    
+    async def loop_init(self, limit=10, stall_on=None, stall_for=0):
+        self.limit = limit
+        self.stall_on = stall_on
+        self.stall_for = stall_for
+        self.times = []
+        
+    async def loop_run(self):
+        self.times.append(self._loop.time())
+        
+        if len(self.times) == self.stall_on:
+            # Deliberately block the loop.
+            time.sleep(self.stall_for)
+            
+        if len(self.times) == self.limit:
+            self.stop()
+        
+        
+class WakeLooperTester1(WakeLooper):
+    ''' Counts iterations, and notifies a threading.Event after each.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.iterated = threading.Event()
+        self.runner = 0
+        
+    async def loop_run(self):
+        self.runner += 1
+        self.iterated.set()
+        
+        
+class WakeLooperTester2(WakeLooper):
+    ''' Gets woken by an event and a queue.
+    '''
+    
+    async def loop_init(self):
+        self.event = asyncio.Event(loop=self._loop)
+        self.queue = self.wake_queue()
+        self.wake_on_event(self.event)
+        self.received = []
+        self.runner = 0
+        
+        self._loop.call_later(.01, self.queue.put_nowait, 1)
+        self._loop.call_later(.01, self.queue.put_nowait, 2)
+        self._loop.call_later(.02, self.event.set)
+        
+    async def loop_run(self):
+        self.runner += 1
+        while not self.queue.empty():
+            self.received.append(self.queue.get_nowait())
+        
+        if self.runner == 2:
+            self.stop()
+        
+        
+class SlowInitTester(TaskLooper):
+    ''' Takes a while to init, records when, and then stops itself.
+    '''
+    
+    async def loop_init(self, delay=.05):
+        self.init_started = self._loop.time()
+        await asyncio.sleep(delay)
+        self.init_finished = self._loop.time()
+        
+    async def loop_run(self):
+        self.stop()
+        
+        
+class SlowStopTester(TaskLooper):
+    ''' Takes a while to stop, and records when.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = threading.Event()
+    
+    async def loop_init(self, delay=.05):
+        self.delay = delay
+        self.stop_started = None
+        self.stop_finished = None
+        
+    async def loop_run(self):
+        self.running.set()
+        await asyncio.sleep(30)
+        
+    async def loop_stop(self):
+        self.stop_started = self._loop.time()
+        await asyncio.sleep(self.delay)
+        self.stop_finished = self._loop.time()
+        
+        
 class TaskCommanderTester1(TaskLooper):
     ''' TaskLooper for testing the TaskCommander.
     '''
@@ -217,6 +382,18 @@ class ManagedTaskTest(unittest.TestCase):
         self.assertEqual(args2, args)
         self.assertEqual(kwargs2, kwargs)
         
+    def test_explicit_loop(self):
+        loop = asyncio.new_event_loop()
+        try:
+            lm = ManagedTaskTester1(loop=loop)
+            self.assertIs(lm._loop, loop)
+            
+            with self.assertRaises(ValueError):
+                ManagedTaskTester1(threaded=True, loop=loop)
+                
+        finally:
+            loop.close()
+        
     def test_background(self):
         lm = ManagedTaskTester1(threaded=True, reusable_loop=False, debug=True)
         
@@ -254,6 +431,23 @@ class ManagedTaskTest(unittest.TestCase):
         self.assertEqual(kwargs2, kwargs)
         self.assertTrue(lm._loop.is_closed())
         
+    def test_orphan_sweep(self):
+        lm = ManagedTaskTester3(threaded=True, reusable_loop=False)
+        lm.start()
+        lm._shutdown_complete_flag.wait(timeout=5)
+        
+        self.assertTrue(lm.orphan_cancelled.is_set())
+        self.assertTrue(lm._loop.is_closed())
+        
+    def test_startup_stop(self):
+        task = ManagedTaskTester2(threaded=True)
+        task.lag_monitor = StartupStopper(task)
+        task.start()
+        
+        # The task itself would run for 30 seconds, if not for the stop.
+        self.assertTrue(task._shutdown_complete_flag.wait(timeout=5))
+        self.assertFalse(task._stop_pending)
+        
         
 class TaskLooperTest(unittest.TestCase):
     ''' Test the TaskLooper.
@@ -296,6 +490,139 @@ class TaskLooperTest(unittest.TestCase):
         self.assertEqual(kwargs3, kwargs)
         self.assertEqual(lm.runner, limit)
         
+    def test_batched_iterations(self):
+        lm = TaskLooperTester3(
+            threaded = False,
+            reusable_loop = True,
+            batch_iterations = 4
+        )
+        
+        # Not a multiple of the batch size, so the stop() must end the batch
+        # early.
+        limit = 10
+        lm.start(limit=limit)
+        self.assertEqual(lm.runner, limit)
+        # We should be partway through the third batch.
+        self.assertLessEqual(lm.yielded, 3)
+        
+    def test_batched_duration(self):
+        lm = TaskLooperTester3(
+            threaded = False,
+            reusable_loop = True,
+            batch_iterations = None,
+            batch_duration = 30
+        )
+        
+        limit = 1000
+        lm.start(limit=limit)
+        self.assertEqual(lm.runner, limit)
+        self.assertLessEqual(lm.yielded, 1)
+        
+    def test_batched_invalid(self):
+        with self.assertRaises(ValueError):
+            TaskLooperTester1(batch_iterations=None, batch_duration=None)
+        with self.assertRaises(ValueError):
+            TaskLooperTester1(batch_iterations=0)
+            
+    def test_stop_deadline(self):
+        lm = SlowStopTester(threaded=True, stop_timeout=.05,
+                            death_timeout=.05)
+        lm.start(delay=30)
+        self.assertTrue(lm.running.wait(timeout=5))
+        
+        # The caller's timeout is much longer than the shutdown deadline.
+        t0 = time.monotonic()
+        lm.stop_threadsafe(timeout=10)
+        self.assertLess(time.monotonic() - t0, 1)
+        
+        self.assertTrue(lm._shutdown_complete_flag.is_set())
+        self.assertTrue(lm._stop_timed_out)
+        self.assertIn('loop_stop', lm._stop_diagnostics)
+        self.assertIsNone(lm.stop_finished)
+        
+        
+class TickLooperTest(unittest.TestCase):
+    ''' Test the fixed-rate TickLooper.
+    '''
+    
+    def test_rate(self):
+        lm = TickLooperTester1(threaded=False, reusable_loop=True, rate=100)
+        lm.start(limit=10)
+        
+        self.assertEqual(len(lm.times), 10)
+        self.assertEqual(lm.ticks_missed, 0)
+        # Ticks are anchored to the first one, so the jitter of individual
+        # ticks shouldn't accumulate. The first tick itself is recorded a
+        # little after its deadline, though, so allow for that.
+        elapsed = lm.times[-1] - lm.times[0]
+        self.assertGreaterEqual(elapsed, .089)
+        self.assertLess(elapsed, .15)
+        
+    def test_overrun_skip(self):
+        lm = TickLooperTester1(threaded=False, reusable_loop=True,
+                               period=.02, overrun='skip')
+        lm.start(limit=4, stall_on=2, stall_for=.07)
+        
+        # Tick 2 ran from .02 through .09, so the ticks at .04 and .06 are
+        # dropped, the tick at .08 is late, and then we're back on schedule.
+        self.assertEqual(lm.ticks_missed, 2)
+        elapsed = lm.times[-1] - lm.times[0]
+        self.assertGreaterEqual(elapsed, .1)
+        self.assertLess(elapsed, .14)
+        
+    def test_overrun_catchup(self):
+        lm = TickLooperTester1(threaded=False, reusable_loop=True,
+                               period=.02, overrun='catchup')
+        lm.start(limit=5, stall_on=2, stall_for=.07)
+        
+        # Same as above, but now the missed ticks run immediately.
+        self.assertEqual(lm.ticks_missed, 2)
+        catchup = lm.times[4] - lm.times[2]
+        self.assertLess(catchup, .02)
+        
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            TickLooperTester1()
+        with self.assertRaises(ValueError):
+            TickLooperTester1(rate=10, period=.1)
+        with self.assertRaises(ValueError):
+            TickLooperTester1(rate=10, overrun='sometimes')
+        
+        
+class WakeLooperTest(unittest.TestCase):
+    ''' Test the wake-on-signal WakeLooper.
+    '''
+    
+    def test_threadsafe(self):
+        lm = WakeLooperTester1(threaded=True, reusable_loop=False)
+        # This should be remembered until after startup.
+        lm.wake_threadsafe()
+        lm.start()
+        
+        try:
+            for ii in range(1, 4):
+                self.assertTrue(lm.iterated.wait(timeout=5))
+                lm.iterated.clear()
+                self.assertEqual(lm.runner, ii)
+                
+                # Make sure we stay parked until woken.
+                time.sleep(.01)
+                self.assertEqual(lm.runner, ii)
+                lm.wake_threadsafe()
+                
+        finally:
+            lm.stop_threadsafe(timeout=5)
+            
+        self.assertTrue(lm._loop.is_closed())
+        
+    def test_event_and_queue(self):
+        lm = WakeLooperTester2(threaded=False, reusable_loop=True)
+        lm.start()
+        
+        # The two puts happen at the same time, so they should coalesce.
+        self.assertEqual(lm.runner, 2)
+        self.assertEqual(lm.received, [1, 2])
+        
         
 class TaskCommanderTest(unittest.TestCase):
     def test_simple_nostop(self):
@@ -393,6 +720,216 @@ class TaskCommanderTest(unittest.TestCase):
         # appropriately. Instead, wait for the shutdown flag.
         com._shutdown_complete_flag.wait(timeout=30)
         
+    def test_ticker(self):
+        tm1 = TickLooperTester1(rate=100)
+        tm2 = TickLooperTester1(period=.02)
+        
+        com = TaskCommander(reusable_loop=True, debug=True)
+        com.register_task(tm1, limit=10)
+        com.register_task(tm2, limit=5)
+        com.start()
+        
+        for tm in (tm1, tm2):
+            self.assertEqual(tm.ticks, len(tm.times))
+            elapsed = tm.times[-1] - tm.times[0]
+            self.assertGreaterEqual(elapsed, .08)
+            self.assertLess(elapsed, .15)
+        
+    def test_live_add_remove(self):
+        tm1 = ManagedTaskTester2()
+        tm2 = ManagedTaskTester2()
+        tm3 = TaskLooperTester1()
+        
+        com = TaskCommander(threaded=True, reusable_loop=False, debug=True)
+        com.register_task(tm1)
+        com.start()
+        
+        try:
+            self.assertTrue(tm1.flag1.wait(timeout=5))
+            
+            com.add_task_threadsafe(tm2, 1, foo='bar')
+            self.assertTrue(tm2.flag1.wait(timeout=5))
+            self.assertEqual(tm2.output, ((1,), {'foo': 'bar'}))
+            self.assertIn(tm2, com._futures_by_mgmts)
+            
+            # This would never be started.
+            with self.assertRaises(RuntimeError):
+                com.register_task(ManagedTaskTester2())
+            
+            # This one stops itself, but the commander should keep running.
+            com.add_task_threadsafe(tm3, limit=5)
+            self.assertEqual(tm3.initter, (tuple(), {}))
+            
+            result = com.remove_task_threadsafe(tm1)
+            self.assertIsNone(result)
+            self.assertTrue(tm1.flag2.is_set())
+            self.assertFalse(tm2.flag2.is_set())
+            self.assertNotIn(tm1, com._futures_by_mgmts)
+            self.assertNotIn(tm1, com._to_start)
+            self.assertEqual(len(com._running), 2)
+            self.assertEqual(tm3.runner, 5)
+            
+        finally:
+            com.stop_threadsafe(timeout=5)
+        
+        self.assertTrue(tm2.flag2.wait(timeout=5))
+        self.assertTrue(com._loop.is_closed())
+        
+    def test_add_remove_stopped(self):
+        tm1 = ManagedTaskTester1()
+        tm2 = ManagedTaskTester1()
+        
+        com = TaskCommander(reusable_loop=True)
+        com.add_task_threadsafe(tm1)
+        com.add_task_threadsafe(tm2)
+        com.remove_task_threadsafe(tm1)
+        
+        with self.assertRaises(ValueError):
+            com.remove_task_threadsafe(tm1)
+        
+        com.start()
+        self.assertFalse(tm1.flag.is_set())
+        self.assertTrue(tm2.flag.is_set())
+        
+    def test_remove_during_halt(self):
+        victim = ManagedTaskTester2()
+        remover = HaltRemover()
+        
+        com = TaskCommander(reusable_loop=True)
+        com.register_task(victim)
+        com.register_task(remover, com, victim)
+        com.start()
+        
+        self.assertTrue(victim.flag2.is_set())
+        self.assertTrue(remover.removal.done())
+        self.assertIsNone(remover.removal.exception())
+        self.assertNotIn(victim, com._to_start)
+        
+    def test_parallel_startup(self):
+        tm1 = SlowInitTester()
+        tm2 = SlowInitTester()
+        tm3 = SlowInitTester()
+        tm4 = SlowInitTester()
+        
+        com = TaskCommander(reusable_loop=True, parallel_startup=True)
+        com.register_task(tm1)
+        com.register_task(tm2)
+        com.register_task(tm3, depends_on=[tm1])
+        com.register_task(tm4)
+        com.start()
+        
+        # These should all have started at once
+        started = [tm.init_started for tm in (tm1, tm2, tm4)]
+        self.assertLess(max(started) - min(started), .04)
+        # But this should have waited for tm1
+        self.assertGreaterEqual(tm3.init_started, tm1.init_finished)
+        # So we should have taken two init periods instead of four.
+        self.assertLess(tm3.init_finished - tm1.init_started, .15)
+        
+    def test_sequential_startup(self):
+        tm1 = SlowInitTester()
+        tm2 = SlowInitTester()
+        tm3 = SlowInitTester()
+        
+        com = TaskCommander(reusable_loop=True)
+        com.register_task(tm1)
+        com.register_task(tm2)
+        com.register_task(tm3, before_task=tm2)
+        com.start()
+        
+        self.assertGreaterEqual(tm3.init_started, tm1.init_finished)
+        self.assertGreaterEqual(tm2.init_started, tm3.init_finished)
+        
+    def test_remove_during_startup(self):
+        tm1 = SlowInitTester()
+        tm2 = ManagedTaskTester2()
+        tm3 = ManagedTaskTester2()
+        
+        com = TaskCommander(threaded=True, reusable_loop=False)
+        com.register_task(tm1, delay=.2)
+        com.register_task(tm2)
+        com.register_task(tm3)
+        com.start()
+        
+        try:
+            # tm1 is still in its init, so tm2 hasn't been started yet.
+            self.assertIsNone(com.remove_task_threadsafe(tm2))
+            # The rest of startup carries on without it.
+            self.assertTrue(tm3.flag1.wait(timeout=5))
+            self.assertFalse(tm2.flag1.is_set())
+            self.assertNotIn(tm2, com._futures_by_mgmts)
+            
+        finally:
+            com.stop_threadsafe(timeout=5)
+            
+    def test_dependency_errors(self):
+        tm1 = SlowInitTester()
+        tm2 = SlowInitTester()
+        tm3 = SlowInitTester()
+        
+        com = TaskCommander(reusable_loop=True)
+        com.register_task(tm1)
+        
+        # Not registered
+        with self.assertRaises(ValueError):
+            com.register_task(tm2, depends_on=[tm3])
+        
+        # Sequential startup means this would be circular.
+        with self.assertRaises(ValueError):
+            com.register_task(tm2, before_task=tm1, depends_on=[tm1])
+        self.assertEqual(com._to_start, [tm1])
+        self.assertNotIn(tm2, com._invocations)
+        
+    def test_parallel_shutdown(self):
+        tm1 = SlowStopTester()
+        tm2 = SlowStopTester()
+        tm3 = SlowStopTester()
+        tm4 = SlowStopTester()
+        
+        com = TaskCommander(threaded=True, parallel_startup=True)
+        com.register_task(tm1)
+        com.register_task(tm2)
+        com.register_task(tm3, depends_on=[tm1])
+        com.register_task(tm4)
+        com.start()
+        
+        for tm in (tm1, tm2, tm3, tm4):
+            self.assertTrue(tm.running.wait(timeout=5))
+        com.stop_threadsafe(timeout=5)
+        
+        # These should all have stopped at once
+        started = [tm.stop_started for tm in (tm2, tm3, tm4)]
+        self.assertLess(max(started) - min(started), .04)
+        # But this should have waited for tm3
+        self.assertGreaterEqual(tm1.stop_started, tm3.stop_finished)
+        
+        self.assertEqual(set(com.stop_report), {tm1, tm2, tm3, tm4})
+        for record in com.stop_report.values():
+            self.assertGreaterEqual(record.duration, .05)
+            self.assertFalse(record.timed_out)
+            
+    def test_stop_timeout(self):
+        tm1 = SlowStopTester(stop_timeout=.05)
+        tm2 = SlowStopTester()
+        
+        com = TaskCommander(threaded=True, parallel_startup=True)
+        com.register_task(tm1, delay=30)
+        com.register_task(tm2)
+        com.start()
+        
+        for tm in (tm1, tm2):
+            self.assertTrue(tm.running.wait(timeout=5))
+        com.stop_threadsafe(timeout=5)
+        
+        self.assertTrue(com._shutdown_complete_flag.is_set())
+        self.assertIsNone(tm1.stop_finished)
+        self.assertIsNotNone(tm2.stop_finished)
+        self.assertTrue(com.stop_report[tm1].timed_out)
+        self.assertIn('loop_stop', com.stop_report[tm1].diagnostics)
+        self.assertFalse(com.stop_report[tm2].timed_out)
+        self.assertIsNone(com.stop_report[tm2].diagnostics)
+        self.assertLess(com.stop_report[tm1].duration, 1)
+        
 
 if __name__ == "__main__":
     unittest.main()
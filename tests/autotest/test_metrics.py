@@ -0,0 +1,563 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Loopa: Arduino-esque event loop app framework.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+import os
+import unittest
+import unittest.mock
+import tempfile
+import asyncio
+import time
+
+from loopa.core import ManagedTask
+from loopa.core import TaskLooper
+from loopa.core import TaskCommander
+from loopa.metrics import Histogram
+from loopa.metrics import TaskMetrics
+from loopa.metrics import CPUAccount
+from loopa.metrics import LagMonitor
+from loopa.metrics import SlowCallbackDetector
+from loopa.metrics import SamplingProfiler
+from loopa.pool import LoopPool
+
+
+# ###############################################
+# "Paragon of adequacy" test fixtures
+# ###############################################
+
+
+class CountingLooper(TaskLooper):
+    ''' Runs limit iterations and then stops itself.
+    '''
+    
+    async def loop_init(self, limit=10, init_delay=0):
+        self.limit = limit
+        self.runner = 0
+        await asyncio.sleep(init_delay)
+        
+    async def loop_run(self):
+        self.runner += 1
+        if self.runner >= self.limit:
+            self.stop()
+            
+    async def loop_stop(self):
+        await asyncio.sleep(.01)
+        
+        
+class BlockingTask(ManagedTask):
+    ''' Blocks its loop for each of delays in turn, and then exits.
+    '''
+    
+    async def task_run(self, delays, interval):
+        for delay in delays:
+            await asyncio.sleep(interval)
+            time.sleep(delay)
+        await asyncio.sleep(interval * 2)
+        
+        
+class StallingLooper(TaskLooper):
+    ''' Blocks its loop during each of the iterations in stalls.
+    '''
+    
+    async def loop_init(self, stalls, stall_for, limit):
+        self.stalls = stalls
+        self.stall_for = stall_for
+        self.limit = limit
+        self.runner = 0
+        
+    async def loop_run(self):
+        self.runner += 1
+        if self.runner in self.stalls:
+            time.sleep(self.stall_for)
+        else:
+            await asyncio.sleep(.01)
+        
+        if self.runner >= self.limit:
+            self.stop()
+        
+        
+def burn(duration):
+    ''' Keeps the CPU busy for duration seconds.
+    '''
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        pass
+        
+        
+class BusyLooper(TaskLooper):
+    async def loop_run(self):
+        # Longer than the GIL switch interval, so that the profiler can
+        # catch us in the middle of it.
+        burn(.02)
+        
+        
+class GreedyLooper(TaskLooper):
+    ''' Keeps the CPU busy for burn_for seconds per iteration, for limit
+    iterations.
+    '''
+    
+    async def loop_init(self, burn_for, limit):
+        self.burn_for = burn_for
+        self.limit = limit
+        self.runner = 0
+        
+    async def loop_run(self):
+        self.runner += 1
+        burn(self.burn_for)
+        # Waiting shouldn't count against us.
+        await asyncio.sleep(.001)
+        
+        if self.runner >= self.limit:
+            self.stop()
+        
+        
+class FailingTask(ManagedTask):
+    async def task_run(self):
+        raise ValueError('Expected failure')
+        
+        
+# ###############################################
+# Testing
+# ###############################################
+        
+        
+class HistogramTest(unittest.TestCase):
+    def test_quantiles(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.quantile(.5))
+        
+        values = [ii * 1e-5 for ii in range(1, 1001)]
+        for value in values:
+            histogram.record(value)
+            
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.mean, sum(values) / 1000)
+        self.assertEqual(histogram.min, values[0])
+        self.assertEqual(histogram.max, values[-1])
+        
+        # Quantiles are bucket upper bounds, so they're never low, and
+        # never high by more than the bucket width.
+        for q in (.1, .5, .9, .99):
+            exact = values[int(q * 1000) - 1]
+            estimate = histogram.quantile(q)
+            self.assertGreaterEqual(estimate, exact)
+            self.assertLessEqual(estimate, exact * 1.25)
+            
+        self.assertEqual(histogram.quantile(1), values[-1])
+        
+    def test_extremes(self):
+        histogram = Histogram()
+        histogram.record(0)
+        histogram.record(1e-12)
+        histogram.record(1e6)
+        
+        self.assertEqual(histogram.buckets[0], 2)
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(histogram.quantile(1), 1e6)
+        
+    def test_merge(self):
+        first = Histogram()
+        second = Histogram()
+        for ii in range(10):
+            first.record(.001)
+            second.record(.1)
+            
+        combined = first.copy()
+        combined.merge(second)
+        
+        self.assertEqual(first.count, 10)
+        self.assertEqual(combined.count, 20)
+        self.assertEqual(combined.min, .001)
+        self.assertEqual(combined.max, .1)
+        self.assertLessEqual(combined.quantile(.5), .00125)
+        self.assertEqual(combined.quantile(.99), .1)
+        
+        
+class TaskMetricsTest(unittest.TestCase):
+    def test_disabled(self):
+        looper = CountingLooper(reusable_loop=True)
+        looper.start()
+        self.assertIsNone(looper.metrics)
+        
+    def test_looper(self):
+        looper = CountingLooper(
+            reusable_loop = True,
+            metrics = True,
+            batch_iterations = 3
+        )
+        looper.start(limit=25, init_delay=.01)
+        
+        metrics = looper.metrics
+        self.assertEqual(metrics.runs, 1)
+        self.assertEqual(metrics.exceptions, 0)
+        self.assertEqual(metrics.iterations, 25)
+        self.assertEqual(metrics.run_durations.count, 25)
+        self.assertGreaterEqual(metrics.init_duration, .01)
+        self.assertGreaterEqual(metrics.stop_duration, .01)
+        self.assertGreaterEqual(
+            metrics.task_duration,
+            metrics.init_duration + metrics.stop_duration
+        )
+        
+        since = metrics.since_last_iteration
+        self.assertGreater(since, 0)
+        time.sleep(.01)
+        self.assertGreater(metrics.since_last_iteration, since)
+        
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['iterations'], 25)
+        self.assertIsNot(snapshot['run_durations'], metrics.run_durations)
+        
+    def test_exception(self):
+        task = FailingTask(reusable_loop=True, metrics=True)
+        with self.assertRaises(ValueError):
+            task.start()
+            
+        self.assertEqual(task.metrics.runs, 1)
+        self.assertEqual(task.metrics.exceptions, 1)
+        self.assertIsNone(task.metrics.since_last_iteration)
+        
+    def test_commander(self):
+        loopers = [CountingLooper(metrics=True) for __ in range(3)]
+        untracked = CountingLooper()
+        commander = TaskCommander(reusable_loop=True)
+        
+        for ii, looper in enumerate(loopers):
+            commander.register_task(looper, limit=(ii + 1) * 10)
+        commander.register_task(untracked)
+        commander.start()
+        
+        snapshot = commander.metrics_snapshot()
+        self.assertEqual(set(snapshot['tasks']), set(loopers))
+        self.assertEqual(snapshot['tasks'][loopers[1]]['iterations'], 20)
+        
+        total = snapshot['total']
+        self.assertEqual(total['runs'], 3)
+        self.assertEqual(total['iterations'], 60)
+        self.assertEqual(total['run_durations'].count, 60)
+        self.assertEqual(
+            total['since_last_iteration'],
+            min(
+                task['since_last_iteration']
+                for task in snapshot['tasks'].values()
+            )
+        )
+        
+        empty = TaskMetrics.aggregate([])
+        self.assertEqual(empty['iterations'], 0)
+        self.assertIsNone(empty['since_last_iteration'])
+        
+        
+class CPUAccountTest(unittest.TestCase):
+    def test_commander(self):
+        greedy = GreedyLooper(cpu_account=True)
+        lazy = CountingLooper(cpu_account=True)
+        untracked = CountingLooper()
+        commander = TaskCommander(reusable_loop=True)
+        commander.register_task(greedy, burn_for=.01, limit=10)
+        commander.register_task(lazy, limit=10)
+        commander.register_task(untracked)
+        commander.start()
+        
+        self.assertIsNone(untracked.cpu_account)
+        cpu = commander.metrics_snapshot()['cpu']
+        self.assertEqual(set(cpu), {greedy, lazy})
+        
+        greedy_cpu = cpu[greedy]
+        lazy_cpu = cpu[lazy]
+        self.assertEqual(greedy_cpu['iteration_times'].count, 10)
+        self.assertEqual(lazy_cpu['iteration_times'].count, 10)
+        # Each iteration is at least two steps, because of the sleep.
+        self.assertGreaterEqual(greedy_cpu['steps'], 20)
+        # Being at the mercy of the OS scheduler, we can't expect to get
+        # every bit of the CPU time we asked for
+        self.assertGreater(greedy_cpu['cpu_time'], .05)
+        self.assertGreater(greedy_cpu['cpu_time'], lazy_cpu['cpu_time'] * 5)
+        self.assertGreater(greedy_cpu['share'], lazy_cpu['share'])
+        self.assertLess(lazy_cpu['iteration_times'].max, .01)
+        self.assertEqual(greedy_cpu['overruns'], 0)
+        self.assertFalse(greedy_cpu['over_budget'])
+        
+    def test_throttle(self):
+        account = CPUAccount(budget=.002, patience=2, throttle=True)
+        looper = GreedyLooper(reusable_loop=True, cpu_account=account)
+        
+        with self.assertLogs('loopa.core', level='WARNING') as logs:
+            looper.start(burn_for=.01, limit=5)
+            
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('CPU budget', logs.output[0])
+        self.assertEqual(account.overruns, 5)
+        self.assertTrue(account.over_budget)
+        # Four of the five iterations are throttled
+        self.assertGreater(account.throttled, 4 * .005)
+        
+    def test_budget(self):
+        account = CPUAccount(budget=1, patience=2, throttle=True)
+        self.assertEqual(account.record_iteration(2), 0)
+        self.assertFalse(account.over_budget)
+        self.assertEqual(account.record_iteration(4), 3)
+        self.assertTrue(account.over_budget)
+        self.assertEqual(account.record_iteration(.5), 0)
+        self.assertFalse(account.over_budget)
+        self.assertEqual(account.record_iteration(2), 0)
+        self.assertEqual(account.overruns, 3)
+        self.assertEqual(account.throttled, 3)
+        self.assertEqual(account.iteration_times.count, 4)
+        
+        untimed = CPUAccount()
+        self.assertEqual(untimed.record_iteration(100), 0)
+        self.assertEqual(untimed.overruns, 0)
+        self.assertEqual(untimed.share(), 0)
+        
+        with self.assertRaises(ValueError):
+            CPUAccount(budget=0)
+        with self.assertRaises(ValueError):
+            CPUAccount(throttle=True)
+        
+        
+class LagMonitorTest(unittest.TestCase):
+    def test_monitor(self):
+        monitor = LagMonitor(interval=.005, window=3)
+        crossings = []
+        monitor.add_threshold(.05, lambda mon, lag: crossings.append(lag))
+        monitor.add_threshold(10, lambda mon, lag: crossings.append(None))
+        
+        self.assertIsNone(monitor.max)
+        self.assertIsNone(monitor.percentile(.5))
+        
+        task = BlockingTask(reusable_loop=True, lag_monitor=monitor)
+        self.assertIs(task.lag_monitor, monitor)
+        task.start(delays=[0, .06, 0, 0], interval=.005)
+        self.assertFalse(monitor.running)
+        
+        self.assertEqual(len(crossings), 1)
+        self.assertGreaterEqual(crossings[0], .05)
+        self.assertGreaterEqual(monitor.samples, 4)
+        self.assertGreater(monitor.lag, 0)
+        
+        snapshot = monitor.snapshot()
+        self.assertEqual(snapshot['samples'], monitor.samples)
+        self.assertLessEqual(snapshot['p50'], snapshot['max'])
+        self.assertEqual(snapshot['max'], monitor.max)
+        self.assertEqual(snapshot['p99'], monitor.percentile(.99))
+        
+    def test_thresholds(self):
+        class FakeLoop:
+            now = 0
+            
+            def time(self):
+                return self.now
+                
+            def call_at(self, when, callback, *args):
+                return unittest.mock.Mock()
+        
+        loop = FakeLoop()
+        monitor = LagMonitor(interval=1)
+        crossings = []
+        monitor.add_threshold(.5, lambda mon, lag: crossings.append(lag))
+        monitor.start(loop)
+        
+        # Only the first of several late samples in a row counts.
+        for lag in [0, .6, .7, .1, .5, 0]:
+            monitor._fire(loop.now - lag)
+        monitor.stop()
+        
+        self.assertEqual(crossings, [.6, .5])
+        self.assertEqual(monitor.last, 0)
+        self.assertEqual(monitor.max, .7)
+        self.assertEqual(monitor.percentile(.5), .1)
+        
+    def test_default(self):
+        task = BlockingTask(reusable_loop=True)
+        self.assertIsNone(task.lag_monitor)
+        task = BlockingTask(reusable_loop=True, lag_monitor=True)
+        self.assertIsInstance(task.lag_monitor, LagMonitor)
+        
+        with self.assertRaises(ValueError):
+            LagMonitor(interval=0)
+        
+    def test_commander(self):
+        commander = TaskCommander(
+            reusable_loop = True,
+            lag_monitor = LagMonitor(interval=.001)
+        )
+        commander.register_task(CountingLooper(), limit=10, init_delay=.02)
+        commander.start()
+        
+        lag = commander.metrics_snapshot()['lag']
+        self.assertGreater(lag['samples'], 0)
+        self.assertIsNone(TaskCommander().metrics_snapshot()['lag'])
+        
+        
+class SlowCallbackTest(unittest.TestCase):
+    def test_detection(self):
+        detector = SlowCallbackDetector(threshold=.04, log_interval=60)
+        looper = StallingLooper(
+            reusable_loop = True,
+            slow_callback_detector = detector
+        )
+        
+        with self.assertLogs('loopa.metrics', level='WARNING') as logs:
+            looper.start(stalls={3, 5, 7}, stall_for=.1, limit=8)
+            
+        self.assertFalse(detector.running)
+        self.assertEqual(detector.count, 3)
+        
+        for record in detector.records:
+            self.assertGreaterEqual(record.duration, .04)
+            self.assertLess(record.duration, .2)
+            self.assertIs(record.owner, looper)
+            self.assertTrue(record.coroutine.endswith('task_run'))
+            self.assertIn('loop_run', record.stack)
+            self.assertIn('time.sleep', record.stack)
+            
+        # The first is reported right away; after that, they're summarized
+        # (here, when the detector stops).
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('1 slow loop step(s)', logs.output[0])
+        self.assertIn('2 slow loop step(s)', logs.output[1])
+        
+    def test_fast(self):
+        detector = SlowCallbackDetector(threshold=.05, capacity=1)
+        looper = StallingLooper(
+            reusable_loop = True,
+            slow_callback_detector = detector
+        )
+        looper.start(stalls=set(), stall_for=0, limit=10)
+        self.assertEqual(detector.count, 0)
+        self.assertEqual(len(detector.records), 0)
+        
+    def test_commander(self):
+        commander = TaskCommander(
+            reusable_loop = True,
+            slow_callback_detector = SlowCallbackDetector(threshold=.04)
+        )
+        looper = StallingLooper()
+        commander.register_task(looper, stalls={2}, stall_for=.1, limit=3)
+        
+        with self.assertLogs('loopa.metrics', level='WARNING'):
+            commander.start()
+            
+        slow_callbacks = commander.metrics_snapshot()['slow_callbacks']
+        self.assertEqual(len(slow_callbacks), 1)
+        self.assertIs(slow_callbacks[0].owner, looper)
+        
+        
+class SamplingProfilerTest(unittest.TestCase):
+    def test_profile(self):
+        looper = BusyLooper(threaded=True)
+        profiler = SamplingProfiler(rate=500)
+        profiler.attach(looper, label='busy')
+        looper.start()
+        
+        try:
+            with profiler:
+                self.assertTrue(profiler.running)
+                time.sleep(.2)
+        finally:
+            looper.stop_threadsafe(timeout=5)
+            
+        self.assertFalse(profiler.running)
+        self.assertGreater(profiler.samples, 10)
+        self.assertEqual(sum(profiler.counts.values()), profiler.samples)
+        
+        burning = [
+            stack for stack in profiler.counts
+            if stack.split(';')[-1].startswith('burn ')
+        ]
+        self.assertTrue(burning)
+        for stack in burning:
+            frames = stack.split(';')
+            self.assertEqual(frames[0], 'busy')
+            self.assertTrue(frames[1].startswith('BusyLooper@'))
+            self.assertTrue(frames[2].startswith('task:'))
+            self.assertIn('loop_run (test_metrics.py', stack)
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'profile.collapsed')
+            profiler.write_collapsed(path)
+            with open(path) as file:
+                lines = file.read().splitlines()
+                
+        self.assertEqual(len(lines), len(profiler.counts))
+        total = 0
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertEqual(profiler.counts[stack], int(count))
+            total += int(count)
+        self.assertEqual(total, profiler.samples)
+        
+        profiler.clear()
+        self.assertEqual(profiler.samples, 0)
+        self.assertEqual(profiler.collapsed(), '')
+        
+    def test_bounded(self):
+        looper = BusyLooper(threaded=True)
+        profiler = SamplingProfiler(rate=500, max_stacks=1, max_depth=3)
+        profiler.attach(looper)
+        looper.start()
+        
+        try:
+            with profiler:
+                time.sleep(.2)
+        finally:
+            looper.stop_threadsafe(timeout=5)
+            
+        self.assertLessEqual(len(profiler.counts), 2)
+        for stack in profiler.counts:
+            # Tags, plus at most max_depth frames
+            self.assertLessEqual(len(stack.split(';')), 3 + 3)
+        
+    def test_pool(self):
+        pool = LoopPool(2)
+        profiler = SamplingProfiler(rate=500)
+        profiler.attach(pool, label='pool')
+        pool.start()
+        
+        try:
+            for index in range(2):
+                pool.add_task(BusyLooper(), affinity=index)
+            with profiler:
+                time.sleep(.2)
+                profiler.detach(pool)
+                detached = profiler.samples
+                time.sleep(.05)
+        finally:
+            pool.stop_threadsafe(timeout=5)
+        
+        labels = {stack.split(';')[0] for stack in profiler.counts}
+        self.assertEqual(labels, {'pool-0', 'pool-1'})
+        self.assertEqual(profiler.samples, detached)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Loopa: Arduino-esque event loop app framework.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+import unittest
+import threading
+import asyncio
+import time
+
+from loopa.core import ManagedTask
+from loopa.core import TaskLooper
+from loopa.core import Aengel
+from loopa.pool import LoopPool
+
+
+# ###############################################
+# "Paragon of adequacy" test fixtures
+# ###############################################
+
+
+class PoolTaskTester1(ManagedTask):
+    ''' Records which thread it ran in, and then waits to be stopped.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    async def task_run(self, *args, **kwargs):
+        self.thread = threading.current_thread()
+        self.running.set()
+        try:
+            await asyncio.sleep(30)
+        finally:
+            self.stopped.set()
+            
+            
+class LoopBlocker(TaskLooper):
+    ''' Repeatedly blocks the event loop.
+    '''
+    
+    async def loop_run(self):
+        time.sleep(.02)
+        await asyncio.sleep(.005)
+
+
+# ###############################################
+# Testing
+# ###############################################
+        
+        
+class LoopPoolTest(unittest.TestCase):
+    def test_round_robin(self):
+        pool = LoopPool(3)
+        tasks = [PoolTaskTester1() for __ in range(6)]
+        pool.start()
+        
+        try:
+            indices = [pool.add_task(task) for task in tasks]
+            self.assertEqual(indices, [0, 1, 2, 0, 1, 2])
+            self.assertEqual(pool.task_counts, [2, 2, 2])
+            
+            for task in tasks:
+                self.assertTrue(task.running.wait(timeout=5))
+            
+            # Tasks on the same loop share a thread; everything else doesn't.
+            threads = [task.thread for task in tasks]
+            self.assertEqual(threads[:3], threads[3:])
+            self.assertEqual(len(set(threads)), 3)
+            self.assertNotIn(threading.main_thread(), threads)
+            
+            self.assertIsNone(pool.remove_task(tasks[0]))
+            self.assertTrue(tasks[0].stopped.is_set())
+            self.assertEqual(pool.task_counts, [1, 2, 2])
+            
+        finally:
+            pool.stop_threadsafe(timeout=5)
+            
+        for task in tasks:
+            self.assertTrue(task.stopped.is_set())
+        for loop in pool.loops:
+            self.assertTrue(loop.is_closed())
+            
+    def test_affinity(self):
+        pool = LoopPool(2, placement=lambda pool, task: 1)
+        tasks = [PoolTaskTester1() for __ in range(3)]
+        pool.start()
+        
+        try:
+            self.assertEqual(pool.add_task(tasks[0]), 1)
+            self.assertEqual(pool.add_task(tasks[1], affinity=0), 0)
+            self.assertEqual(pool.add_task(tasks[2]), 1)
+            self.assertEqual(pool.placement_of(tasks[1]), 0)
+            
+            with self.assertRaises(ValueError):
+                pool.add_task(tasks[0])
+            extra = PoolTaskTester1()
+            with self.assertRaises(ValueError):
+                pool.add_task(extra, affinity=2)
+            with self.assertRaises(ValueError):
+                pool.add_task(extra, affinity=-1)
+            with self.assertRaises(KeyError):
+                pool.placement_of(extra)
+            
+        finally:
+            pool.stop_threadsafe(timeout=5)
+            
+    def test_foreign_thread(self):
+        ''' Pools can be created from threads without an event loop.
+        '''
+        pools = []
+        creator = threading.Thread(target=lambda: pools.append(LoopPool(2)))
+        creator.start()
+        creator.join()
+        
+        pool, = pools
+        pool.start()
+        try:
+            task = PoolTaskTester1()
+            self.assertEqual(pool.add_task(task, affinity=1), 1)
+            self.assertTrue(task.running.wait(timeout=5))
+        finally:
+            pool.stop_threadsafe(timeout=5)
+            
+    def test_least_loaded(self):
+        pool = LoopPool(2, placement='least_loaded', probe_interval=.01)
+        pool.start()
+        
+        try:
+            pool.add_task(LoopBlocker(), affinity=0)
+            # Give the probes a chance to notice.
+            time.sleep(.2)
+            self.assertGreater(pool.lags[0], pool.lags[1])
+            snapshots = pool.lag_snapshots
+            self.assertGreater(snapshots[0]['max'], snapshots[1]['max'])
+            
+            for __ in range(3):
+                self.assertEqual(pool.add_task(PoolTaskTester1()), 1)
+            
+        finally:
+            pool.stop_threadsafe(timeout=5)
+
+    def test_aengel(self):
+        aengel = Aengel()
+        pool = LoopPool(2, aengel=aengel)
+        task = PoolTaskTester1()
+        pool.start()
+        pool.add_task(task)
+        
+        # This is what happens when the main thread exits.
+        aengel.stop()
+        self.assertTrue(task.stopped.wait(timeout=5))
+        pool.stop_threadsafe(timeout=5)
+        for loop in pool.loops:
+            self.assertTrue(loop.is_closed())
+        
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,333 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Loopa: Arduino-esque event loop app framework.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+import unittest
+import asyncio
+import os
+import multiprocessing
+
+from loopa.core import ManagedTask
+from loopa.core import TaskLooper
+from loopa.core import Aengel
+from loopa.process import ProcessTask
+from loopa.process import ShardedCommander
+
+
+# ###############################################
+# "Paragon of adequacy" test fixtures
+# ###############################################
+
+
+class ProcessTaskTester1(ProcessTask):
+    ''' Returns the PID it ran in, along with its args.
+    '''
+    
+    async def task_run(self, *args, **kwargs):
+        return os.getpid(), args, kwargs
+        
+        
+class ProcessTaskTester2(ProcessTask):
+    ''' Raises within the child.
+    '''
+    
+    async def task_run(self):
+        raise ValueError('Expected failure')
+        
+        
+class ProcessLooperTester(ProcessTask, TaskLooper):
+    ''' Burns CPU until stopped. Uses multiprocessing primitives to
+    report back.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = multiprocessing.Event()
+        self.stopped = multiprocessing.Event()
+        
+    async def loop_run(self):
+        sum(range(1000))
+        self.running.set()
+        
+    async def loop_stop(self):
+        self.stopped.set()
+        
+        
+class ShardTester1(ManagedTask):
+    ''' Returns the PID it ran in, along with its arg.
+    '''
+    
+    async def task_run(self, arg):
+        return os.getpid(), arg
+        
+        
+class ShardTester2(TaskLooper):
+    ''' Runs until stopped, and returns the PID it ran in.
+    '''
+    
+    async def loop_init(self):
+        self.pid = os.getpid()
+    
+    async def loop_run(self):
+        await asyncio.sleep(.01)
+        
+    async def loop_stop(self):
+        return self.pid
+        
+        
+class ShardTester3(ManagedTask):
+    ''' Raises within its shard.
+    '''
+    
+    async def task_run(self):
+        raise ValueError('Expected failure')
+        
+        
+class ShardedCommanderTester(ShardedCommander):
+    ''' Records the setup and teardown hooks, and collects the
+    results of _company_halt.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setups = 0
+        self.teardowns = 0
+        self.halt_results = None
+        
+    async def setup(self):
+        self.setups += 1
+        
+    async def teardown(self):
+        self.teardowns += 1
+        
+    async def _company_halt(self, tasks):
+        self.halt_results = await super()._company_halt(tasks)
+        return self.halt_results
+
+
+# ###############################################
+# Testing
+# ###############################################
+        
+        
+class ProcessTaskTest(unittest.TestCase):
+    def test_result(self):
+        pt = ProcessTaskTester1()
+        pt.start(1, 2, foo='bar')
+        pid, args, kwargs = pt.result(timeout=10)
+        
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(args, (1, 2))
+        self.assertEqual(kwargs, {'foo': 'bar'})
+        self.assertTrue(pt._shutdown_complete_flag.is_set())
+        self.assertTrue(pt._loop.is_closed())
+        
+    def test_exception(self):
+        pt = ProcessTaskTester2()
+        pt.start()
+        
+        with self.assertRaises(ValueError):
+            pt.result(timeout=10)
+            
+    def test_stop(self):
+        pt = ProcessLooperTester()
+        # Nothing to wait for yet, so this shouldn't block.
+        self.assertFalse(pt.wait_init_threadsafe())
+        pt.start()
+        
+        self.assertTrue(pt.wait_init_threadsafe(timeout=10))
+        self.assertTrue(pt.running.wait(timeout=10))
+        pt.stop_threadsafe(timeout=10)
+        
+        self.assertTrue(pt._shutdown_complete_flag.is_set())
+        self.assertTrue(pt.stopped.is_set())
+        self.assertIsNone(pt.result(timeout=0))
+        self.assertIsNone(pt.pid)
+        self.assertTrue(pt.wait_init_threadsafe())
+        
+    def test_aengel(self):
+        aengel = Aengel()
+        pt = ProcessLooperTester(aengel=aengel)
+        pt.start()
+        self.assertTrue(pt.running.wait(timeout=10))
+        
+        # This is what happens when the main thread exits.
+        aengel.stop()
+        self.assertTrue(pt._shutdown_complete_flag.wait(timeout=10))
+        self.assertTrue(pt.stopped.is_set())
+        
+        
+class ShardedCommanderTest(unittest.TestCase):
+    def test_results(self):
+        commander = ShardedCommanderTester(2, reusable_loop=True)
+        tasks = [ShardTester1() for __ in range(4)]
+        for ii, task in enumerate(tasks):
+            commander.register_task(task, ii)
+        
+        commander.start()
+        
+        self.assertEqual(commander.setups, 1)
+        self.assertEqual(commander.teardowns, 1)
+        self.assertEqual(set(commander.halt_results), set(tasks))
+        
+        pids = {}
+        for ii, task in enumerate(tasks):
+            pid, arg = commander.halt_results[task]
+            self.assertEqual(arg, ii)
+            self.assertNotEqual(pid, os.getpid())
+            pids.setdefault(commander.shard_of(task), set()).add(pid)
+        
+        # Round-robin, one process per shard
+        self.assertEqual(len(pids), 2)
+        self.assertEqual(len(pids[0] | pids[1]), 2)
+        for shard_pids in pids.values():
+            self.assertEqual(len(shard_pids), 1)
+            
+    def test_assignment(self):
+        commander = ShardedCommander(3)
+        t1 = ShardTester1()
+        t2 = ShardTester1()
+        t3 = ShardTester1()
+        t4 = ShardTester1()
+        
+        commander.register_task(t1, 1, shard=2)
+        commander.register_task(t2, 2, key='foo')
+        commander.register_task(t3, 3, key='foo')
+        
+        self.assertEqual(commander.shard_of(t1), 2)
+        self.assertEqual(commander.shard_of(t2), commander.shard_of(t3))
+        
+        with self.assertRaises(ValueError):
+            commander.register_task(t1, 1)
+        with self.assertRaises(ValueError):
+            commander.register_task(t4, 4, shard=0, key='foo')
+        with self.assertRaises(ValueError):
+            commander.register_task(t4, 4, shard=3)
+        with self.assertRaises(ValueError):
+            commander.register_task(t4, 4, shard=-1)
+        self.assertNotIn(t4, commander._shards_by_task)
+        with self.assertRaises(ValueError):
+            ShardedCommander(0)
+            
+    def test_add_remove(self):
+        commander = ShardedCommanderTester(2, reusable_loop=True)
+        t1 = ShardTester1()
+        t2 = ShardTester1()
+        t3 = ShardTester1()
+        
+        commander._loop.run_until_complete(
+            commander.add_task(t1, 1, shard=1)
+        )
+        commander.add_task_threadsafe(t2, 2, shard=0)
+        commander.register_task(t3, 3, shard=0)
+        self.assertEqual(commander.shard_of(t1), 1)
+        self.assertEqual(commander.shard_of(t2), 0)
+        
+        commander.remove_task_threadsafe(t2)
+        self.assertNotIn(t2, commander._shards_by_task)
+        self.assertNotIn(t2, commander._shards[0]._to_start)
+        with self.assertRaises(ValueError):
+            commander.remove_task_threadsafe(t2)
+        
+        commander.start()
+        # The shards ran everything, and the commander only its proxies.
+        self.assertEqual(len(commander._to_start), 2)
+        self.assertEqual(set(commander.halt_results), {t1, t3})
+            
+    def test_stop(self):
+        aengel = Aengel()
+        commander = ShardedCommanderTester(2, threaded=True, aengel=aengel)
+        tasks = [ShardTester2() for __ in range(4)]
+        for task in tasks:
+            commander.register_task(task)
+            
+        commander.start()
+        asyncio.run_coroutine_threadsafe(
+            commander.await_init(),
+            commander._loop
+        ).result(timeout=10)
+        self.assertEqual(commander.setups, 1)
+        
+        with self.assertRaises(RuntimeError):
+            commander.register_task(ShardTester2())
+        with self.assertRaises(RuntimeError):
+            commander.add_task_threadsafe(ShardTester2())
+        with self.assertRaises(RuntimeError):
+            commander.remove_task_threadsafe(tasks[0])
+        with self.assertRaises(RuntimeError):
+            asyncio.run_coroutine_threadsafe(
+                commander.add_task(ShardTester2()),
+                commander._loop
+            ).result(timeout=10)
+        with self.assertRaises(RuntimeError):
+            asyncio.run_coroutine_threadsafe(
+                commander.remove_task(tasks[0]),
+                commander._loop
+            ).result(timeout=10)
+        # Nothing was forwarded to the parent commander itself.
+        self.assertEqual(len(commander._to_start), 2)
+        
+        commander.stop_threadsafe(timeout=10)
+        self.assertTrue(commander._shutdown_complete_flag.is_set())
+        self.assertEqual(commander.teardowns, 1)
+        # The loopers were stopped, so none of them have results.
+        self.assertEqual(commander.halt_results, {})
+        
+        for shard in commander._shards:
+            self.assertIsNone(shard.pid)
+            
+    def test_exception(self):
+        commander = ShardedCommanderTester(2, reusable_loop=True)
+        commander.register_task(ShardTester3(), shard=0)
+        commander.register_task(ShardTester2(), shard=1)
+        
+        with self.assertRaises(ValueError):
+            commander.start()
+            
+        for shard in commander._shards:
+            self.assertIsNone(shard.pid)
+        
+    def test_suppressed_exception(self):
+        commander = ShardedCommanderTester(
+            2,
+            reusable_loop = True,
+            suppress_child_exceptions = True
+        )
+        t1 = ShardTester1()
+        commander.register_task(ShardTester3(), shard=0)
+        commander.register_task(t1, 1, shard=1)
+        commander.start()
+        
+        self.assertEqual(list(commander.halt_results), [t1])
+        
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Loopa: Arduino-esque event loop app framework.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+import unittest
+import threading
+import asyncio
+import queue
+import time
+
+from loopa.queues import DualQueue
+from loopa.exceptions import QueueClosed
+
+from autotest.test_utils import LoopThread
+
+
+# ###############################################
+# "Paragon of adequacy" test fixtures
+# ###############################################
+
+
+def run(loop, coro, timeout=5):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+    
+    
+# ###############################################
+# Testing
+# ###############################################
+        
+        
+class DualQueueTest(unittest.TestCase):
+    def test_nowait(self):
+        channel = DualQueue(2)
+        channel.put_nowait(1)
+        channel.put_nowait(2)
+        self.assertTrue(channel.full())
+        with self.assertRaises(queue.Full):
+            channel.put_nowait(3)
+            
+        self.assertEqual(channel.get_nowait(), 1)
+        self.assertEqual(channel.get_nowait(), 2)
+        self.assertTrue(channel.empty())
+        with self.assertRaises(queue.Empty):
+            channel.get_nowait()
+            
+    def test_close(self):
+        channel = DualQueue()
+        channel.put_many_threadsafe([1, 2])
+        channel.close()
+        
+        with self.assertRaises(QueueClosed):
+            channel.put_nowait(3)
+            
+        # Anything left is still retrievable
+        self.assertEqual(channel.get_many_threadsafe(5), [1, 2])
+        with self.assertRaises(QueueClosed):
+            channel.get_threadsafe()
+            
+    def test_timeout(self):
+        channel = DualQueue(1)
+        channel.put_threadsafe(1)
+        with self.assertRaises(queue.Full):
+            channel.put_threadsafe(2, timeout=.01)
+            
+        channel.get_threadsafe()
+        with self.assertRaises(queue.Empty):
+            channel.get_threadsafe(timeout=.01)
+            
+    def test_thread_to_loop(self):
+        channel = DualQueue(10)
+        peak = []
+        
+        async def consume():
+            results = []
+            while True:
+                peak.append(channel.qsize())
+                try:
+                    results.extend(await channel.get_many(7))
+                except QueueClosed:
+                    return results
+                # Give the producer a chance to fill us up.
+                await asyncio.sleep(0)
+        
+        def produce():
+            channel.put_many_threadsafe(range(500))
+            channel.close()
+        
+        with LoopThread() as loop:
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+            results = run(loop, consume())
+            producer.join()
+            
+        self.assertEqual(results, list(range(500)))
+        self.assertLessEqual(max(peak), 10)
+        
+    def test_loop_to_thread(self):
+        channel = DualQueue(10)
+        
+        async def produce():
+            for ii in range(50):
+                await channel.put_many(range(ii * 10, ii * 10 + 10))
+            channel.close()
+            
+        with LoopThread() as loop:
+            producer = asyncio.run_coroutine_threadsafe(produce(), loop)
+            results = []
+            while True:
+                try:
+                    results.extend(channel.get_many_threadsafe(3))
+                except QueueClosed:
+                    break
+                self.assertLessEqual(channel.qsize(), 10)
+            producer.result(timeout=5)
+            
+        self.assertEqual(results, list(range(500)))
+        
+    def test_coalesced_wakeups(self):
+        channel = DualQueue()
+        blocked = threading.Event()
+        unblock = threading.Event()
+        
+        def block():
+            blocked.set()
+            unblock.wait()
+        
+        with LoopThread() as loop:
+            getter = asyncio.run_coroutine_threadsafe(
+                channel.get_many(1000),
+                loop
+            )
+            # Make sure the getter is waiting before we block the loop.
+            while not channel._getters:
+                time.sleep(.001)
+            loop.call_soon_threadsafe(block)
+            blocked.wait()
+            
+            wakeups = []
+            original = loop.call_soon_threadsafe
+            def counting(*args):
+                wakeups.append(args)
+                return original(*args)
+            
+            loop.call_soon_threadsafe = counting
+            try:
+                for ii in range(100):
+                    channel.put_nowait(ii)
+            finally:
+                del loop.call_soon_threadsafe
+                unblock.set()
+                
+            self.assertEqual(getter.result(timeout=5), list(range(100)))
+            self.assertEqual(len(wakeups), 1)
+            
+    def test_binding(self):
+        channel = DualQueue()
+        # Can be used before binding to any loop
+        channel.put_nowait(1)
+        
+        with LoopThread() as loop1, LoopThread() as loop2:
+            self.assertEqual(run(loop1, channel.get()), 1)
+            with self.assertRaises(RuntimeError):
+                run(loop2, channel.get())
+                
+    def test_cancellation(self):
+        channel = DualQueue()
+        
+        with LoopThread() as loop:
+            first = asyncio.run_coroutine_threadsafe(channel.get(), loop)
+            second = asyncio.run_coroutine_threadsafe(channel.get(), loop)
+            while len(channel._getters) < 2:
+                time.sleep(.001)
+                
+            first.cancel()
+            while len(channel._getters) > 1:
+                time.sleep(.001)
+                
+            channel.put_nowait('item')
+            self.assertEqual(second.result(timeout=5), 'item')
+            self.assertTrue(channel.empty())
+            
+    def test_close_wakes(self):
+        channel = DualQueue(1)
+        channel.put_nowait(1)
+        
+        with LoopThread() as loop:
+            putter = asyncio.run_coroutine_threadsafe(channel.put(2), loop)
+            blocked = []
+            
+            def put():
+                try:
+                    channel.put_threadsafe(3)
+                except QueueClosed as exc:
+                    blocked.append(exc)
+            
+            thread = threading.Thread(target=put, daemon=True)
+            thread.start()
+            while not channel._putters:
+                time.sleep(.001)
+                
+            channel.close()
+            thread.join(timeout=5)
+            with self.assertRaises(QueueClosed):
+                putter.result(timeout=5)
+                
+        self.assertEqual(len(blocked), 1)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
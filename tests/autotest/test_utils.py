@@ -0,0 +1,908 @@
+'''
+LICENSING
+-------------------------------------------------
+
+Loopa: Arduino-esque event loop app framework.
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+
+import unittest
+import threading
+import asyncio
+import concurrent.futures
+import time
+
+from loopa.utils import wrap_threaded_future
+from loopa.utils import await_coroutine_loopsafe
+from loopa.utils import run_coroutine_loopsafe
+from loopa.utils import submit_many_threadsafe
+from loopa.utils import gather_threadsafe
+from loopa.utils import Hedger
+from loopa.utils import wait_threadsafe
+from loopa.utils import wait_all_threadsafe
+from loopa.utils import wait_any_threadsafe
+from loopa.utils import as_completed_threadsafe
+from loopa.utils import triplicated
+from loopa.utils import Triplicate
+from loopa.utils import iterate_threadsafe
+from loopa.utils import aiterate_threadsafe
+from loopa.utils import call_soon_coalesced
+from loopa.utils import run_coroutine_coalesced
+from loopa.utils import current_task
+from loopa.utils import all_tasks
+
+
+# ###############################################
+# "Paragon of adequacy" test fixtures
+# ###############################################
+
+
+class LoopThread:
+    ''' Runs an event loop forever in a background thread.
+    '''
+    
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target = self._run,
+            daemon = True,
+            name = 'test-loop'
+        )
+        
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        
+    def __enter__(self):
+        self.thread.start()
+        return self.loop
+        
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(
+            self._cancel_all(),
+            self.loop
+        ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        
+    async def _cancel_all(self):
+        this_task = current_task(self.loop)
+        others = [
+            task for task in all_tasks(self.loop)
+            if task is not this_task
+        ]
+        for task in others:
+            task.cancel()
+        if others:
+            await asyncio.wait(others)
+        
+        
+async def double(value, delay=0):
+    await asyncio.sleep(delay)
+    return value * 2
+    
+    
+async def fail():
+    raise ValueError('Expected failure')
+    
+    
+async def record_cancellation(started, cancelled, delay=5):
+    started.set()
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+    
+    
+class Counter:
+    ''' Async iterator over range(stop), optionally failing at the end.
+    '''
+    
+    def __init__(self, stop, fail=False):
+        self.stop = stop
+        self.fail = fail
+        self.produced = 0
+        self.closed = False
+        
+    def __aiter__(self):
+        return self
+        
+    async def __anext__(self):
+        if self.produced >= self.stop:
+            if self.fail:
+                raise ValueError('Expected failure')
+            raise StopAsyncIteration
+            
+        await asyncio.sleep(0)
+        self.produced += 1
+        return self.produced - 1
+        
+    async def aclose(self):
+        self.closed = True
+        
+        
+def count_sync(stop, record, fail=False):
+    try:
+        for ii in range(stop):
+            record.append(ii)
+            yield ii
+            
+        if fail:
+            raise ValueError('Expected failure')
+        
+    finally:
+        record.append('closed')
+    
+    
+class Replica:
+    ''' Answers after a delay (or fails), within its own loop.
+    '''
+    
+    def __init__(self, loop, delay=0, fail=False):
+        self._loop = loop
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.cancelled = threading.Event()
+        
+    async def get(self, value):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled.set()
+            raise
+            
+        if self.fail:
+            raise ValueError('Expected failure')
+        return self, value
+    
+    
+class TriplicateTester(metaclass=Triplicate):
+    ''' Has a triplicated API bound to self._loop.
+    '''
+    
+    def __init__(self, loop):
+        self._loop = loop
+        
+    @triplicated
+    async def add(self, a, b):
+        return a + b
+        
+    @triplicated
+    async def add_later(self, a, b):
+        await asyncio.sleep(0)
+        return a + b
+        
+    @triplicated
+    async def fail(self):
+        raise ValueError('Expected failure')
+        
+    @triplicated
+    async def track(self, value, running, peak):
+        running.append(value)
+        peak.append(len(running))
+        await asyncio.sleep(.001)
+        running.remove(value)
+        
+        if value < 0:
+            raise ValueError('Expected failure')
+        
+        return value * 2
+
+
+# ###############################################
+# Testing
+# ###############################################
+        
+        
+class BridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        
+    def tearDown(self):
+        self.loop.close()
+        
+    def test_wrap_threaded_future(self):
+        async def bridge(fut, complete):
+            wrapped = wrap_threaded_future(fut, loop=self.loop)
+            self.assertFalse(wrapped.done())
+            # Complete it from a different thread.
+            threading.Thread(target=complete, args=(fut,)).start()
+            return (await wrapped)
+        
+        fut = concurrent.futures.Future()
+        result = self.loop.run_until_complete(
+            bridge(fut, lambda fut: fut.set_result(7))
+        )
+        self.assertEqual(result, 7)
+        
+        fut = concurrent.futures.Future()
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(
+                bridge(fut, lambda fut: fut.set_exception(ValueError()))
+            )
+        
+        fut = concurrent.futures.Future()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(
+                bridge(fut, lambda fut: fut.cancel())
+            )
+        
+    def test_wrap_completed(self):
+        fut = concurrent.futures.Future()
+        fut.set_result(7)
+        wrapped = wrap_threaded_future(fut, loop=self.loop)
+        self.assertEqual(self.loop.run_until_complete(wrapped), 7)
+        
+    def test_await_coroutine_loopsafe(self):
+        with LoopThread() as other_loop:
+            result = self.loop.run_until_complete(
+                await_coroutine_loopsafe(double(4), loop=other_loop)
+            )
+            self.assertEqual(result, 8)
+            
+            with self.assertRaises(ValueError):
+                self.loop.run_until_complete(
+                    await_coroutine_loopsafe(fail(), loop=other_loop)
+                )
+            
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(
+                    await_coroutine_loopsafe(
+                        double(4, delay=1),
+                        loop = other_loop,
+                        timeout = .01
+                    )
+                )
+        
+    def test_local_cancellation(self):
+        started = threading.Event()
+        cancelled = threading.Event()
+        
+        async def cancel_locally(other_loop):
+            fut = await run_coroutine_loopsafe(
+                record_cancellation(started, cancelled),
+                other_loop
+            )
+            await self.loop.run_in_executor(None, started.wait)
+            fut.cancel()
+        
+        with LoopThread() as other_loop:
+            self.loop.run_until_complete(cancel_locally(other_loop))
+            self.assertTrue(cancelled.wait(timeout=5))
+            
+    def test_remote_cancellation(self):
+        started = threading.Event()
+        cancelled = threading.Event()
+        
+        async def cancel_remotely(other_loop):
+            thread_future = asyncio.run_coroutine_threadsafe(
+                record_cancellation(started, cancelled),
+                other_loop
+            )
+            fut = wrap_threaded_future(
+                thread_future,
+                loop = self.loop,
+                propagate_cancel = True
+            )
+            await self.loop.run_in_executor(None, started.wait)
+            thread_future.cancel()
+            await fut
+            
+        with LoopThread() as other_loop:
+            with self.assertRaises(asyncio.CancelledError):
+                self.loop.run_until_complete(cancel_remotely(other_loop))
+            self.assertTrue(cancelled.wait(timeout=5))
+            
+    def test_remote_timeout(self):
+        started = threading.Event()
+        cancelled = threading.Event()
+        
+        with LoopThread() as other_loop:
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(
+                    await_coroutine_loopsafe(
+                        record_cancellation(started, cancelled),
+                        loop = other_loop,
+                        timeout = .01
+                    )
+                )
+            # This must happen within the other loop, without any help from
+            # LoopThread's cleanup.
+            self.assertTrue(cancelled.wait(timeout=5))
+            
+            
+class WaitTest(unittest.TestCase):
+    def test_wait_threadsafe(self):
+        with LoopThread() as loop:
+            fut = asyncio.run_coroutine_threadsafe(
+                asyncio.sleep(.01, result=7, loop=loop),
+                loop
+            )
+            self.assertEqual(
+                wait_threadsafe(wrap_threaded_future(fut, loop=loop)),
+                7
+            )
+            
+            fut = asyncio.run_coroutine_threadsafe(fail(), loop)
+            with self.assertRaises(ValueError):
+                wait_threadsafe(wrap_threaded_future(fut, loop=loop))
+                
+            fut = asyncio.run_coroutine_threadsafe(double(1, 5), loop)
+            with self.assertRaises(concurrent.futures.TimeoutError):
+                wait_threadsafe(
+                    wrap_threaded_future(fut, loop=loop),
+                    timeout = .01
+                )
+                
+    def make_futures(self, loop, delays):
+        ''' Returns asyncio futures within loop that complete after each
+        of the delays.
+        '''
+        async def make():
+            return [
+                asyncio.ensure_future(double(ii, delay))
+                for ii, delay in enumerate(delays)
+            ]
+        
+        return asyncio.run_coroutine_threadsafe(make(), loop).result()
+                
+    def test_wait_all(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            futs = self.make_futures(loop1, [.01, .02, 0])
+            futs.extend(self.make_futures(loop2, [.01, 0]))
+            # Also mix in a threaded future
+            futs.append(asyncio.run_coroutine_threadsafe(double(5), loop2))
+            
+            done, pending = wait_all_threadsafe(futs, timeout=5)
+            self.assertEqual(done, set(futs))
+            self.assertFalse(pending)
+            self.assertEqual(
+                [fut.result() for fut in futs],
+                [0, 2, 4, 0, 2, 10]
+            )
+            
+            futs = self.make_futures(loop1, [0, 5])
+            done, pending = wait_all_threadsafe(futs, timeout=.05)
+            self.assertEqual(done, {futs[0]})
+            self.assertEqual(pending, {futs[1]})
+            
+    def test_wait_any(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            futs = self.make_futures(loop1, [5, 5])
+            futs.extend(self.make_futures(loop2, [.01]))
+            
+            done, pending = wait_any_threadsafe(futs, timeout=5)
+            self.assertEqual(done, {futs[2]})
+            self.assertEqual(pending, set(futs[:2]))
+            
+            done, pending = wait_any_threadsafe(futs[:2], timeout=.01)
+            self.assertFalse(done)
+            
+    def test_as_completed(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            futs = self.make_futures(loop1, [.1, 0])
+            futs.extend(self.make_futures(loop2, [.05]))
+            
+            ordered = list(as_completed_threadsafe(futs, timeout=5))
+            self.assertEqual(ordered, [futs[1], futs[2], futs[0]])
+            
+            futs = self.make_futures(loop1, [0, 5])
+            completed = []
+            with self.assertRaises(concurrent.futures.TimeoutError):
+                for fut in as_completed_threadsafe(futs, timeout=.05):
+                    completed.append(fut)
+            self.assertEqual(completed, [futs[0]])
+            
+            
+class HedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        
+    def tearDown(self):
+        self.loop.close()
+        
+    def call(self, hedger, value):
+        return self.loop.run_until_complete(
+            hedger.call(lambda replica: replica.get(value))
+        )
+        
+    def test_fast_primary(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            replicas = [Replica(loop1), Replica(loop2)]
+            hedger = Hedger(replicas, hedge_delay=1)
+            
+            self.assertEqual(self.call(hedger, 1), (replicas[0], 1))
+            self.assertEqual(self.call(hedger, 2), (replicas[1], 2))
+            
+        self.assertEqual(hedger.stats.calls, 2)
+        self.assertEqual(hedger.stats.hedged_calls, 0)
+        self.assertEqual(hedger.stats.hedge_rate, 0)
+        
+    def test_hedge(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            replicas = [Replica(loop1, delay=5), Replica(loop2)]
+            hedger = Hedger(replicas, hedge_delay=.01)
+            
+            self.assertEqual(self.call(hedger, 1), (replicas[1], 1))
+            # The loser must be cancelled within its own loop.
+            self.assertTrue(replicas[0].cancelled.wait(timeout=5))
+            
+        self.assertEqual(hedger.stats.calls, 1)
+        self.assertEqual(hedger.stats.hedged_calls, 1)
+        self.assertEqual(hedger.stats.hedges, 1)
+        self.assertEqual(hedger.stats.hedge_wins, 1)
+        self.assertEqual(hedger.stats.hedge_rate, 1)
+        
+    def test_failover(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            replicas = [Replica(loop1, fail=True), Replica(loop2)]
+            # The failure shouldn't wait out the hedge delay.
+            hedger = Hedger(replicas, hedge_delay=5)
+            
+            self.assertEqual(self.call(hedger, 1), (replicas[1], 1))
+        
+    def test_retry(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            replicas = [Replica(loop1, fail=True), Replica(loop2, fail=True)]
+            hedger = Hedger(
+                replicas,
+                hedge_delay = 1,
+                max_hedges = 0,
+                retries = 2,
+                backoff = .001
+            )
+            
+            with self.assertRaises(ValueError):
+                self.call(hedger, 1)
+            
+        self.assertEqual(replicas[0].calls + replicas[1].calls, 3)
+        self.assertEqual(hedger.stats.retries, 2)
+        self.assertEqual(hedger.stats.failures, 1)
+        
+    def test_retry_hedged(self):
+        with LoopThread() as loop1, LoopThread() as loop2:
+            replicas = [Replica(loop1, fail=True), Replica(loop2, fail=True)]
+            hedger = Hedger(replicas, hedge_delay=1, retries=2, backoff=.001)
+            
+            with self.assertRaises(ValueError):
+                self.call(hedger, 1)
+        
+        # Every attempt hedged, but it's still just the one call.
+        self.assertEqual(hedger.stats.hedges, 3)
+        self.assertEqual(hedger.stats.hedged_calls, 1)
+        self.assertEqual(hedger.stats.hedge_rate, 1)
+        
+    def test_timeout(self):
+        with LoopThread() as loop1:
+            replica = Replica(loop1, delay=5)
+            hedger = Hedger([replica], hedge_delay=1, timeout=.01)
+            
+            with self.assertRaises(asyncio.TimeoutError):
+                self.call(hedger, 1)
+            self.assertTrue(replica.cancelled.wait(timeout=5))
+            
+            
+class TriplicateTest(unittest.TestCase):
+    def test_threadsafe(self):
+        with LoopThread() as loop:
+            tester = TriplicateTester(loop)
+            self.assertEqual(tester.add_threadsafe(1, 2), 3)
+            self.assertEqual(tester.add_later_threadsafe(1, 2), 3)
+            with self.assertRaises(ValueError):
+                tester.fail_threadsafe()
+                
+    def test_loopsafe(self):
+        loop = asyncio.new_event_loop()
+        try:
+            with LoopThread() as other_loop:
+                tester = TriplicateTester(other_loop)
+                self.assertEqual(
+                    loop.run_until_complete(tester.add_later_loopsafe(1, 2)),
+                    3
+                )
+                with self.assertRaises(ValueError):
+                    loop.run_until_complete(tester.fail_loopsafe())
+        finally:
+            loop.close()
+            
+    def test_same_loop(self):
+        loop = asyncio.new_event_loop()
+        tester = TriplicateTester(loop)
+        
+        async def call_all():
+            results = [
+                (await tester.add_loopsafe(1, 2)),
+                (await tester.add_later_loopsafe(1, 2)),
+            ]
+            
+            # These would deadlock if they blocked, and shouldn't run any of
+            # the coro (even if it could finish without suspending).
+            running = []
+            with self.assertRaises(RuntimeError):
+                tester.track_threadsafe(1, running, [])
+            self.assertEqual(running, [])
+            with self.assertRaises(RuntimeError):
+                tester.add_later_threadsafe(1, 2)
+                
+            return results
+            
+        try:
+            self.assertEqual(loop.run_until_complete(call_all()), [3, 3])
+        finally:
+            loop.close()
+
+    def test_many(self):
+        running = []
+        peak = []
+        args = [(ii, running, peak) for ii in range(20)]
+        expected = [ii * 2 for ii in range(20)]
+        loop = asyncio.new_event_loop()
+        
+        try:
+            with LoopThread() as other_loop:
+                tester = TriplicateTester(other_loop)
+                self.assertEqual(
+                    tester.track_many_threadsafe(args, limit=4),
+                    expected
+                )
+                self.assertEqual(max(peak), 4)
+                
+                self.assertEqual(
+                    loop.run_until_complete(
+                        tester.track_many_loopsafe(iter(args))
+                    ),
+                    expected
+                )
+                self.assertEqual(max(peak), 20)
+                
+                results = tester.track_many_threadsafe(
+                    [(1, running, peak), (-1, running, peak)],
+                    return_exceptions = True
+                )
+                self.assertEqual(results[0], 2)
+                self.assertIsInstance(results[1], ValueError)
+                
+                with self.assertRaises(ValueError):
+                    tester.track_many_threadsafe(
+                        [(-1, running, peak)] + args
+                    )
+                with self.assertRaises(ValueError):
+                    tester.track_many_threadsafe(args, limit=0)
+                    
+                self.assertEqual(tester.add_many_threadsafe([]), [])
+                
+            tester = TriplicateTester(loop)
+            self.assertEqual(
+                loop.run_until_complete(tester.add_many([(1, 2), (3, 4)])),
+                [3, 7]
+            )
+                
+        finally:
+            loop.close()
+            
+    def test_many_cancel(self):
+        running = []
+        peak = []
+        args = [(ii, running, peak) for ii in range(20)]
+        loop = asyncio.new_event_loop()
+        tester = TriplicateTester(loop)
+        
+        async def cancel_many():
+            task = asyncio.ensure_future(
+                tester.track_many(args, limit=2, return_exceptions=True)
+            )
+            # Let the first two jobs get started.
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            task.cancel()
+            
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # Give anything we failed to stop a chance to keep going.
+            await asyncio.sleep(.01)
+            
+        try:
+            loop.run_until_complete(cancel_many())
+        finally:
+            loop.close()
+            
+        self.assertEqual(len(peak), 2)
+        
+        
+class BatchTest(unittest.TestCase):
+    def test_gather(self):
+        with LoopThread() as loop:
+            items = [double(ii) for ii in range(50)]
+            items.append(lambda: 'sync')
+            items.append(lambda: double(3))
+            results = gather_threadsafe(items, loop)
+            
+        self.assertEqual(
+            results,
+            [ii * 2 for ii in range(50)] + ['sync', 6]
+        )
+        
+    def test_exceptions(self):
+        with LoopThread() as loop:
+            results = gather_threadsafe(
+                [double(1), fail(), double(2)],
+                loop,
+                return_exceptions = True
+            )
+            self.assertEqual(results[0], 2)
+            self.assertIsInstance(results[1], ValueError)
+            self.assertEqual(results[2], 4)
+            
+            with self.assertRaises(ValueError):
+                gather_threadsafe([double(1), fail(), double(2)], loop)
+        
+    def test_cancellation(self):
+        async def cancelled():
+            raise asyncio.CancelledError()
+            
+        with LoopThread() as loop:
+            # An item cancelling itself mustn't take the rest of the batch
+            # (or, with a limit, the worker running it) down with it.
+            results = gather_threadsafe(
+                [double(1), cancelled(), double(2)],
+                loop,
+                limit = 1,
+                return_exceptions = True
+            )
+            self.assertEqual(results[0], 2)
+            self.assertIsInstance(
+                results[1],
+                concurrent.futures.CancelledError
+            )
+            self.assertEqual(results[2], 4)
+            
+            with self.assertRaises(concurrent.futures.CancelledError):
+                gather_threadsafe([double(1), cancelled()], loop)
+            
+            # Cancelling a running item cancels it within the loop.
+            started = threading.Event()
+            was_cancelled = threading.Event()
+            futures = submit_many_threadsafe(
+                [record_cancellation(started, was_cancelled), double(3)],
+                loop,
+                limit = 1
+            )
+            self.assertTrue(started.wait(timeout=5))
+            self.assertTrue(futures[0].cancel())
+            self.assertTrue(was_cancelled.wait(timeout=5))
+            self.assertEqual(futures[1].result(timeout=5), 6)
+            self.assertTrue(futures[0].cancelled())
+        
+    def test_limit(self):
+        running = []
+        peak = []
+        
+        async def track():
+            running.append(None)
+            peak.append(len(running))
+            await asyncio.sleep(.001)
+            running.pop()
+        
+        with LoopThread() as loop:
+            futures = submit_many_threadsafe(
+                [track() for __ in range(20)],
+                loop,
+                limit = 3
+            )
+            concurrent.futures.wait(futures, timeout=5)
+            
+        self.assertTrue(all(fut.done() for fut in futures))
+        self.assertEqual(max(peak), 3)
+        
+        with self.assertRaises(ValueError):
+            submit_many_threadsafe([], None, limit=0)
+            
+    def test_timeout(self):
+        with LoopThread() as loop:
+            started = time.monotonic()
+            futures = submit_many_threadsafe(
+                [double(1), double(2, delay=5), double(3, delay=5)],
+                loop,
+                limit = 2
+            )
+            futures[1].cancel()
+            self.assertEqual(futures[0].result(timeout=5), 2)
+            
+            with self.assertRaises(concurrent.futures.TimeoutError):
+                gather_threadsafe(
+                    [double(1), double(2, delay=5), double(3, delay=5)],
+                    loop,
+                    limit = 1,
+                    timeout = .05
+                )
+            
+            self.assertLess(time.monotonic() - started, 1)
+        
+        
+class CoalescedTest(unittest.TestCase):
+    def test_order_and_wakeups(self):
+        results = []
+        blocked = threading.Event()
+        unblock = threading.Event()
+        
+        def block():
+            blocked.set()
+            unblock.wait()
+        
+        with LoopThread() as loop:
+            loop.call_soon_threadsafe(block)
+            blocked.wait()
+            
+            wakeups = []
+            original = loop.call_soon_threadsafe
+            def counting(*args):
+                wakeups.append(args)
+                return original(*args)
+            
+            loop.call_soon_threadsafe = counting
+            try:
+                for ii in range(100):
+                    call_soon_coalesced(loop, results.append, ii)
+            finally:
+                del loop.call_soon_threadsafe
+                unblock.set()
+                
+            fut = run_coroutine_coalesced(double(4), loop)
+            self.assertEqual(fut.result(timeout=5), 8)
+            
+        self.assertEqual(results, list(range(100)))
+        self.assertEqual(len(wakeups), 1)
+        
+    def test_exception(self):
+        errors = []
+        results = []
+        
+        def boom():
+            raise ValueError('Expected failure')
+        
+        with LoopThread() as loop:
+            loop.set_exception_handler(
+                lambda loop, context: errors.append(context['exception'])
+            )
+            call_soon_coalesced(loop, boom)
+            call_soon_coalesced(loop, results.append, 1)
+            run_coroutine_coalesced(double(1), loop).result(timeout=5)
+            
+        self.assertEqual(results, [1])
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+        
+        with self.assertRaises(RuntimeError):
+            call_soon_coalesced(loop, results.append, 2)
+            
+        
+class IterateTest(unittest.TestCase):
+    def test_iterate(self):
+        with LoopThread() as loop:
+            counter = Counter(250)
+            self.assertEqual(
+                list(iterate_threadsafe(counter, loop, batch_size=7)),
+                list(range(250))
+            )
+            self.assertTrue(counter.closed)
+            
+    def test_iterate_early_stop(self):
+        with LoopThread() as loop:
+            counter = Counter(10000)
+            iterator = iterate_threadsafe(counter, loop, buffer_size=10)
+            for ii in iterator:
+                if ii == 5:
+                    break
+            iterator.close()
+            
+            deadline = time.monotonic() + 5
+            while not counter.closed and time.monotonic() < deadline:
+                time.sleep(.001)
+                
+            self.assertTrue(counter.closed)
+            # Backpressure: the producer can't get far ahead of us.
+            self.assertLessEqual(counter.produced, 6 + 10 + 1)
+            
+    def test_iterate_exception(self):
+        with LoopThread() as loop:
+            results = []
+            with self.assertRaises(ValueError):
+                for item in iterate_threadsafe(Counter(5, fail=True), loop):
+                    results.append(item)
+                    
+        self.assertEqual(results, list(range(5)))
+        
+    def test_buffer_size(self):
+        # Unbounded buffers would remove all backpressure.
+        with self.assertRaises(ValueError):
+            iterate_threadsafe(Counter(5), None, buffer_size=0)
+        with self.assertRaises(ValueError):
+            aiterate_threadsafe(range(5), None, buffer_size=0)
+        
+    def arun(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+            
+    def test_aiterate(self):
+        async def consume(iterable):
+            results = []
+            async for item in aiterate_threadsafe(iterable, batch_size=7):
+                results.append(item)
+            return results
+            
+        record = []
+        self.assertEqual(
+            self.arun(consume(count_sync(250, record))),
+            list(range(250))
+        )
+        self.assertEqual(record[-1], 'closed')
+        
+    def test_aiterate_early_stop(self):
+        record = []
+        
+        async def consume():
+            iterator = aiterate_threadsafe(
+                count_sync(10000, record),
+                buffer_size = 10
+            )
+            async for item in iterator:
+                if item == 5:
+                    break
+            await iterator.aclose()
+            
+            deadline = time.monotonic() + 5
+            while 'closed' not in record and time.monotonic() < deadline:
+                await asyncio.sleep(.001)
+        
+        self.arun(consume())
+        self.assertEqual(record[-1], 'closed')
+        # Backpressure: the iterable can't get far ahead of us.
+        self.assertLessEqual(len(record), 6 + 10 + 2 + 1)
+        
+    def test_aiterate_exception(self):
+        results = []
+        
+        async def consume():
+            async for item in aiterate_threadsafe(
+                count_sync(5, [], fail=True)
+            ):
+                results.append(item)
+                
+        with self.assertRaises(ValueError):
+            self.arun(consume())
+        self.assertEqual(results, list(range(5)))
+        
+        
+if __name__ == "__main__":
+    unittest.main()
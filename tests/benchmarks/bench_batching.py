@@ -0,0 +1,101 @@
+'''
+Benchmark: batched vs per-iteration yielding in TaskLooper.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import time
+
+from loopa import TaskLooper
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+class CountingLooper(TaskLooper):
+    ''' Does (nearly) nothing in loop_run, so that the cost of the
+    looping machinery itself dominates.
+    '''
+    
+    async def loop_init(self, limit):
+        self.limit = limit
+        self.count = 0
+        
+    async def loop_run(self):
+        self.count += 1
+        if self.count == self.limit:
+            self.stop()
+            
+            
+def run_once(limit, **kwargs):
+    ''' Returns iterations per second for a single run.
+    '''
+    looper = CountingLooper(reusable_loop=True, **kwargs)
+    start = time.perf_counter()
+    looper.start(limit=limit)
+    elapsed = time.perf_counter() - start
+    assert looper.count == limit
+    return limit / elapsed
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    configs = [
+        ('per-iteration yield (default)', {}),
+        ('batch_iterations=16', {'batch_iterations': 16}),
+        ('batch_iterations=256', {'batch_iterations': 256}),
+        ('batch_duration=2ms', {'batch_iterations': None,
+                                'batch_duration': .002}),
+    ]
+    
+    baseline = None
+    for name, kwargs in configs:
+        rate = max(
+            run_once(args.iterations, **kwargs) for __ in range(args.repeat)
+        )
+        if baseline is None:
+            baseline = rate
+        print('{:<32} {:>12,.0f} it/s  ({:.2f}x)'.format(
+            name, rate, rate / baseline
+        ))
+        
+    asyncio.get_event_loop().close()
@@ -0,0 +1,187 @@
+'''
+Benchmark: cross-loop future bridging, legacy vs direct.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+import time
+import tracemalloc
+
+from loopa.utils import wrap_threaded_future
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+class _LegacyEvent(asyncio.Event):
+    ''' The event-based bridge that wrap_threaded_future used to use.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__result = None
+        self.__exc = None
+        
+    def set(self, result, exc):
+        self.__result = result
+        self.__exc = exc
+        super().set()
+        
+    async def wait(self):
+        await super().wait()
+        
+        if self.__exc is not None:
+            raise self.__exc
+        else:
+            return self.__result
+
+
+def legacy_wrap(fut, loop=None):
+    ''' The previous implementation of wrap_threaded_future.
+    '''
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    source_event = _LegacyEvent(loop=loop)
+    
+    def callback(fut, loop=loop, source_event=source_event):
+        exc = None
+        result = None
+        
+        try:
+            exc = fut.exception()
+            if exc is None:
+                result = fut.result()
+        except concurrent.futures.CancelledError as cancelled:
+            exc = cancelled
+        finally:
+            loop.call_soon_threadsafe(source_event.set, result, exc)
+        
+    fut.add_done_callback(callback)
+    return asyncio.ensure_future(source_event.wait(), loop=loop)
+    
+    
+async def noop():
+    pass
+    
+    
+def start_remote_loop():
+    ''' Returns a loop running forever in a daemon thread.
+    '''
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+    
+    
+async def round_trips(wrap, remote_loop, calls):
+    ''' Sequentially runs calls no-op coroutines in remote_loop.
+    '''
+    loop = asyncio.get_event_loop()
+    for __ in range(calls):
+        await wrap(
+            asyncio.run_coroutine_threadsafe(noop(), remote_loop),
+            loop
+        )
+        
+        
+async def bridge_only(wrap, calls):
+    ''' Sequentially bridges already-completed threaded futures, so that
+    only the bridge itself is measured.
+    '''
+    loop = asyncio.get_event_loop()
+    for __ in range(calls):
+        fut = concurrent.futures.Future()
+        fut.set_result(None)
+        await wrap(fut, loop)
+        
+        
+async def footprint(wrap, calls):
+    ''' Returns the traced memory (in bytes) held per in-flight bridged
+    call.
+    '''
+    loop = asyncio.get_event_loop()
+    sources = [concurrent.futures.Future() for __ in range(calls)]
+    
+    tracemalloc.start()
+    try:
+        before, __ = tracemalloc.get_traced_memory()
+        wrapped = [wrap(fut, loop) for fut in sources]
+        # Let any tasks created by the wrapper start waiting.
+        await asyncio.sleep(0)
+        after, __ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    for fut in sources:
+        fut.set_result(None)
+    await asyncio.gather(*wrapped)
+    
+    return (after - before) / calls
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+    
+    loop = asyncio.get_event_loop()
+    remote_loop = start_remote_loop()
+    
+    print('{:<10} {:>18} {:>18} {:>18}'.format(
+        '', 'round trips/s', 'bridges/s', 'bytes/call'
+    ))
+    
+    for name, wrap in [('legacy', legacy_wrap),
+                       ('direct', wrap_threaded_future)]:
+        t0 = time.perf_counter()
+        loop.run_until_complete(round_trips(wrap, remote_loop, args.calls))
+        trips = args.calls / (time.perf_counter() - t0)
+        
+        t0 = time.perf_counter()
+        loop.run_until_complete(bridge_only(wrap, args.calls))
+        bridges = args.calls / (time.perf_counter() - t0)
+        
+        size = loop.run_until_complete(footprint(wrap, args.calls))
+        
+        print('{:<10} {:>18.0f} {:>18.0f} {:>18.0f}'.format(
+            name, trips, bridges, size
+        ))
+        
+    remote_loop.call_soon_threadsafe(remote_loop.stop)
+    loop.close()
@@ -0,0 +1,128 @@
+'''
+Benchmark: cross-thread callbacks, direct vs coalesced wakeups.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import threading
+import time
+
+from loopa.utils import call_soon_coalesced
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+def direct(loop, callback, *args):
+    loop.call_soon_threadsafe(callback, *args)
+    
+    
+def start_loop():
+    ''' Returns a loop running forever in a daemon thread, along with a
+    list that counts writes to its self-pipe (one syscall apiece).
+    '''
+    loop = asyncio.new_event_loop()
+    writes = []
+    original = loop._write_to_self
+    
+    def counting():
+        writes.append(None)
+        original()
+    
+    loop._write_to_self = counting
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop, writes
+    
+    
+def contend(call, threads, calls):
+    ''' Has threads threads each make calls cross-thread calls into a
+    fresh loop, as fast as they can. Returns the elapsed time, the
+    number of self-pipe writes, and the sorted latencies (from calling
+    to running) of every call.
+    '''
+    loop, writes = start_loop()
+    latencies = []
+    done = threading.Event()
+    remaining = [threads * calls]
+    
+    def record(started):
+        latencies.append(time.perf_counter() - started)
+        remaining[0] -= 1
+        if not remaining[0]:
+            done.set()
+    
+    def hammer():
+        for __ in range(calls):
+            call(loop, record, time.perf_counter())
+    
+    workers = [
+        threading.Thread(target=hammer, daemon=True)
+        for __ in range(threads)
+    ]
+    
+    t0 = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    done.wait()
+    elapsed = time.perf_counter() - t0
+    
+    loop.call_soon_threadsafe(loop.stop)
+    return elapsed, len(writes), sorted(latencies)
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+    
+    total = args.threads * args.calls
+    print('{:<10} {:>14} {:>14} {:>14} {:>14}'.format(
+        '', 'calls/s', 'writes/call', 'p50 (us)', 'p99 (us)'
+    ))
+    
+    for name, call in [('direct', direct),
+                       ('coalesced', call_soon_coalesced)]:
+        elapsed, writes, latencies = contend(call, args.threads, args.calls)
+        print('{:<10} {:>14.0f} {:>14.3f} {:>14.1f} {:>14.1f}'.format(
+            name,
+            total / elapsed,
+            writes / total,
+            latencies[total // 2] * 1e6,
+            latencies[int(total * .99)] * 1e6
+        ))
@@ -0,0 +1,118 @@
+'''
+Benchmark: ShardedCommander throughput vs number of processes.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import time
+
+from loopa import ManagedTask
+from loopa import TaskCommander
+from loopa import ShardedCommander
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+class Cruncher(ManagedTask):
+    ''' Does a fixed amount of CPU-bound work, yielding to the loop
+    between chunks.
+    '''
+    
+    async def task_run(self, chunks, chunk_size):
+        total = 0
+        for __ in range(chunks):
+            total += sum(range(chunk_size))
+            await asyncio.sleep(0)
+        return total
+        
+        
+def run_once(commander, tasks, chunks, chunk_size):
+    ''' Returns the elapsed time for the commander to run all tasks to
+    completion.
+    '''
+    for __ in range(tasks):
+        commander.register_task(Cruncher(), chunks, chunk_size)
+    
+    t0 = time.perf_counter()
+    commander.start()
+    return time.perf_counter() - t0
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--tasks', type=int, default=16)
+    parser.add_argument('--chunks', type=int, default=100)
+    parser.add_argument('--chunk-size', type=int, default=20000)
+    parser.add_argument(
+        '--processes',
+        type = int,
+        nargs = '+',
+        default = [1, 2, 4, 8]
+    )
+    args = parser.parse_args()
+    
+    work = args.tasks * args.chunks
+    print('{} tasks x {} chunks of sum(range({}))'.format(
+        args.tasks, args.chunks, args.chunk_size
+    ))
+    
+    elapsed = run_once(
+        TaskCommander(reusable_loop=True),
+        args.tasks,
+        args.chunks,
+        args.chunk_size
+    )
+    print('{:<24} {:>8.1f}ms {:>10.0f} chunks/s'.format(
+        'TaskCommander', elapsed * 1000, work / elapsed
+    ))
+    
+    for processes in args.processes:
+        elapsed = run_once(
+            ShardedCommander(processes, reusable_loop=True),
+            args.tasks,
+            args.chunks,
+            args.chunk_size
+        )
+        print('{:<24} {:>8.1f}ms {:>10.0f} chunks/s'.format(
+            'ShardedCommander(' + str(processes) + ')',
+            elapsed * 1000,
+            work / elapsed
+        ))
+        
+    asyncio.get_event_loop().close()
@@ -0,0 +1,115 @@
+'''
+Benchmark: sequential vs dependency-graph TaskCommander startup.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import time
+
+from loopa import TaskLooper
+from loopa import TaskCommander
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+class SlowInit(TaskLooper):
+    ''' Simulates a loop_init that has to (for example) open a
+    connection.
+    '''
+    
+    async def loop_init(self, latency):
+        await asyncio.sleep(latency)
+        
+    async def loop_run(self):
+        self.stop()
+        
+        
+class TimedCommander(TaskCommander):
+    ''' Records how long it took for all inits to complete.
+    '''
+    
+    async def setup(self):
+        self.startup_time = time.perf_counter() - self.t0
+        
+        
+def run_once(children, latency, layers, parallel):
+    ''' Returns the startup time for a single commander. If layers > 1,
+    the children are split into that many layers, each of which depends
+    upon the entire previous layer.
+    '''
+    commander = TimedCommander(reusable_loop=True, parallel_startup=parallel)
+    per_layer = max(children // layers, 1)
+    previous_layer = []
+    layer = []
+    
+    for ii in range(children):
+        child = SlowInit()
+        commander.register_task(child, latency, depends_on=previous_layer)
+        layer.append(child)
+        
+        if len(layer) == per_layer:
+            previous_layer = layer
+            layer = []
+    
+    commander.t0 = time.perf_counter()
+    commander.start()
+    return commander.startup_time
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--children', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=.01)
+    args = parser.parse_args()
+    
+    print('{} children, {:.0f}ms simulated init latency'.format(
+        args.children, args.latency * 1000
+    ))
+    
+    configs = [
+        ('sequential', 1, False),
+        ('parallel, no dependencies', 1, True),
+        ('parallel, 4 dependency layers', 4, True),
+    ]
+    
+    for name, layers, parallel in configs:
+        elapsed = run_once(args.children, args.latency, layers, parallel)
+        print('{:<32} {:>8.1f}ms'.format(name, elapsed * 1000))
+        
+    asyncio.get_event_loop().close()
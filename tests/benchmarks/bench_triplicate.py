@@ -0,0 +1,128 @@
+'''
+Benchmark: Triplicate-generated _loopsafe/_threadsafe call paths.
+
+LICENSING
+-------------------------------------------------
+
+    Copyright (C) 2016 Muterra, Inc.
+    
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+'''
+import argparse
+import asyncio
+import threading
+import time
+
+from loopa.utils import triplicated
+from loopa.utils import Triplicate
+from loopa.utils import wrap_threaded_future
+
+
+# ###############################################
+# Fixtures
+# ###############################################
+
+
+class Target(metaclass=Triplicate):
+    ''' Has a trivial triplicated method.
+    '''
+    
+    def __init__(self, loop):
+        self._loop = loop
+        
+    @triplicated
+    async def echo(self, value):
+        return value
+        
+        
+async def bounce(target, value):
+    ''' What the generated loopsafe method used to do, regardless of
+    which loop it was called from (less its target_loop bug).
+    '''
+    return (await wrap_threaded_future(
+        asyncio.run_coroutine_threadsafe(target.echo(value), target._loop),
+        asyncio.get_event_loop()
+    ))
+    
+    
+async def call_loopsafe(target, calls):
+    for ii in range(calls):
+        await target.echo_loopsafe(ii)
+        
+        
+async def call_bounce(target, calls):
+    for ii in range(calls):
+        await bounce(target, ii)
+        
+        
+def call_threadsafe(target, calls):
+    for ii in range(calls):
+        target.echo_threadsafe(ii)
+        
+        
+def timed(func, *args):
+    ''' Returns how long (in seconds) func took to run.
+    '''
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+    
+    
+# ###############################################
+# Benchmark
+# ###############################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+    calls = args.calls
+    
+    loop = asyncio.get_event_loop()
+    remote_loop = asyncio.new_event_loop()
+    threading.Thread(target=remote_loop.run_forever, daemon=True).start()
+    
+    local = Target(loop)
+    remote = Target(remote_loop)
+    
+    configs = [
+        ('same loop, _loopsafe', lambda: loop.run_until_complete(
+            call_loopsafe(local, calls))),
+        ('same loop, bounced', lambda: loop.run_until_complete(
+            call_bounce(local, calls))),
+        ('cross loop, _loopsafe', lambda: loop.run_until_complete(
+            call_loopsafe(remote, calls))),
+        ('sync thread, _threadsafe', lambda: call_threadsafe(remote, calls)),
+        ('sync thread, _many_threadsafe', lambda: remote.echo_many_threadsafe(
+            [(ii,) for ii in range(calls)])),
+    ]
+    
+    for name, func in configs:
+        elapsed = timed(func)
+        print('{:<32} {:>12.0f} calls/s'.format(name, calls / elapsed))
+        
+    remote_loop.call_soon_threadsafe(remote_loop.stop)
+    loop.close()